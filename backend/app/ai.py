@@ -0,0 +1,222 @@
+import asyncio, hashlib, json, unicodedata
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, AsyncIterator
+
+from openai import AsyncOpenAI
+
+from app.core import metrics
+from app.core.cache import TTLCache
+from app.core.config import settings
+
+MODEL = "gpt-3.5-turbo"
+SYSTEM_PROMPT = (
+    "You are a helpful assistant."
+    "Generate a short response."
+    "Use Markdown where applicable for better readability."
+)
+
+# Lazy initialization for pytest
+client = None
+def get_openai_client() -> AsyncOpenAI:
+    global client
+    if client is None:
+        client = AsyncOpenAI()
+    return client
+
+
+@dataclass
+class Usage:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached: bool = False  # Served from the cache or another prompt's call, the tokens were not billed again
+
+
+async def stream_upstream(message: str, *, model: str, usage: Usage) -> AsyncIterator[str]:
+    """
+    Yield the answer to `message` piece by piece, as OpenAI streams it, and fill in `usage`.
+    Closing or cancelling the generator closes the upstream response. OpenAI only reports usage
+    at the end, so a stream cut short counts one completion token per piece and no prompt tokens.
+    """
+    response = await get_openai_client().chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": message},
+        ],
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    try:
+        async for chunk in response:
+            if chunk.usage:  # Last chunk, without choices
+                usage.prompt_tokens = chunk.usage.prompt_tokens
+                usage.completion_tokens = chunk.usage.completion_tokens
+            if chunk.choices and chunk.choices[0].delta.content:
+                usage.completion_tokens += 1
+                yield chunk.choices[0].delta.content
+    finally:
+        await response.close()
+
+
+def normalize_prompt(message: str) -> str:
+    # Full-width and half-width forms, and runs of whitespace, ask the same question.
+    # Only for the cache key: upstream gets the prompt as typed, newlines and indentation included.
+    return " ".join(unicodedata.normalize("NFKC", message).split())
+
+
+def prompt_key(message: str, model: str) -> str:
+    return hashlib.sha256(json.dumps([model, SYSTEM_PROMPT, normalize_prompt(message)]).encode()).hexdigest()
+
+
+@dataclass
+class CachedAnswer:
+    pieces: tuple[str, ...]
+    prompt_tokens: int
+    completion_tokens: int
+
+
+class _Flight:
+    """
+    One upstream call, read by its own task so that any number of identical prompts can follow it
+    and none of them cancelling stops the others.
+    """
+
+    def __init__(self) -> None:
+        self.pieces: list[str] = []
+        self.usage = Usage()
+        self.done = False
+        self.error: BaseException | None = None
+        self.followers = 0
+        self.task: asyncio.Task | None = None
+        self._changed = asyncio.Event()
+
+    def notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self) -> AsyncIterator[str]:
+        self.followers += 1
+        try:
+            sent = 0
+            while True:
+                changed = self._changed
+                while sent < len(self.pieces):
+                    yield self.pieces[sent]
+                    sent += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            self.followers -= 1
+            if not self.followers and not self.done and self.task is not None:
+                self.task.cancel()  # Nobody is listening any more
+
+
+class ResponseCache:
+    """
+    Exact-match cache of complete answers, keyed by a hash of the model and the normalised prompt.
+    Hits are replayed piece by piece like a live answer. Identical prompts arriving while one is
+    streaming follow that call instead of starting another.
+    """
+
+    def __init__(self, *, maxsize: int, ttl: float) -> None:
+        self.answers: TTLCache[str, CachedAnswer] = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._flights: dict[str, _Flight] = {}
+        self.coalesced = 0
+        self.saved_tokens = 0
+
+    async def _fetch(self, key: str, message: str, model: str, flight: _Flight) -> None:
+        try:
+            async for piece in stream_upstream(message, model=model, usage=flight.usage):
+                flight.pieces.append(piece)
+                flight.notify()
+            self.answers.set(
+                key,
+                CachedAnswer(tuple(flight.pieces), flight.usage.prompt_tokens, flight.usage.completion_tokens),
+            )
+        except (asyncio.CancelledError, Exception) as e:
+            flight.error = e  # Raised in every follower, nothing is cached
+        finally:
+            flight.done = True
+            flight.notify()
+            del self._flights[key]
+
+    async def stream(self, message: str, *, model: str = MODEL, usage: Usage | None = None) -> AsyncIterator[str]:
+        usage = usage if usage is not None else Usage()
+        key = prompt_key(message, model)
+        if (answer := self.answers.get(key)) is not None:
+            usage.prompt_tokens = answer.prompt_tokens
+            usage.completion_tokens = answer.completion_tokens
+            usage.cached = True
+            self.saved_tokens += answer.prompt_tokens + answer.completion_tokens
+            for piece in answer.pieces:
+                yield piece
+            return
+
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.create_task(self._fetch(key, message, model, flight))
+            leader = True
+        else:
+            self.coalesced += 1
+            leader = False
+        try:
+            async for piece in flight.follow():
+                yield piece
+        finally:
+            # Only the call that went upstream is billed
+            usage.prompt_tokens = flight.usage.prompt_tokens
+            usage.completion_tokens = flight.usage.completion_tokens
+            usage.cached = not leader
+            if not leader:
+                self.saved_tokens += usage.prompt_tokens + usage.completion_tokens
+
+    def stats(self) -> dict[str, Any]:
+        return {**self.answers.stats(), "coalesced": self.coalesced, "saved_tokens": self.saved_tokens}
+
+
+response_cache = ResponseCache(maxsize=settings.AI_CACHE_MAX_SIZE, ttl=settings.AI_CACHE_TTL_SECONDS)
+metrics.register("ai_cache", response_cache.stats)
+
+
+async def stream_completion(message: str, *, model: str = MODEL, usage: Usage | None = None) -> AsyncIterator[str]:
+    """
+    Yield the answer to `message` piece by piece, from the cache when it was asked before.
+    Closing or cancelling the generator stops the upstream call unless another prompt follows it.
+    """
+    async for piece in response_cache.stream(message, model=model, usage=usage):
+        yield piece
+
+
+class PromptLimiter:
+    """
+    Caps the prompts answered at once per user, across all their sockets on this worker.
+    """
+
+    def __init__(self, *, max_per_user: int) -> None:
+        self.max_per_user = max_per_user
+        self.in_flight: defaultdict[Any, int] = defaultdict(int)
+        self.rejected = 0
+
+    def try_acquire(self, user_id: Any) -> bool:
+        if self.in_flight[user_id] >= self.max_per_user:
+            self.rejected += 1
+            return False
+        self.in_flight[user_id] += 1
+        return True
+
+    def release(self, user_id: Any) -> None:
+        self.in_flight[user_id] -= 1
+        if not self.in_flight[user_id]:
+            del self.in_flight[user_id]
+
+    def stats(self) -> dict[str, Any]:
+        return {"in_flight": sum(self.in_flight.values()), "users": len(self.in_flight), "rejected": self.rejected}
+
+
+prompt_limiter = PromptLimiter(max_per_user=settings.AI_MAX_PROMPTS_PER_USER)
+metrics.register("ai_prompts", prompt_limiter.stats)
@@ -0,0 +1,180 @@
+import asyncio, logging
+from collections import defaultdict
+from dataclasses import dataclass, fields
+from datetime import date
+from typing import Any
+from uuid import UUID
+
+from tortoise import timezone as tz
+from tortoise.exceptions import IntegrityError
+from tortoise.expressions import F
+
+from app import ai
+from app.core import metrics
+from app.core.config import settings
+from app.models.db_models import AiUsage
+
+logger = logging.getLogger(__name__)
+
+UsageKey = tuple[UUID, date]
+
+
+def today() -> date:
+    return tz.now().date()
+
+
+@dataclass
+class UsageTotals:
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+
+    @property
+    def billed_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, other: "UsageTotals") -> None:
+        for field in fields(self):
+            setattr(self, field.name, getattr(self, field.name) + getattr(other, field.name))
+
+    def to_fields(self) -> dict[str, int]:
+        return {field.name: getattr(self, field.name) for field in fields(self)}
+
+
+def totals_from_usage(usage: ai.Usage) -> UsageTotals:
+    tokens = usage.prompt_tokens + usage.completion_tokens
+    if usage.cached:
+        return UsageTotals(requests=1, cached_tokens=tokens)
+    return UsageTotals(requests=1, prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+
+
+class UsageRecorder:
+    """
+    Token usage per user per day. record() only touches memory; the totals are merged into
+    ai_usage every `flush_interval` seconds, one row per user and day.
+
+    Quotas are checked against an in-memory count of today's billed tokens: the user's row as of
+    the last flush (so it includes the other workers) plus what this worker has not flushed yet.
+    """
+
+    def __init__(self, *, flush_interval: float, daily_quota: int) -> None:
+        self.flush_interval = flush_interval
+        self.daily_quota = daily_quota
+        self.flushed_rows = 0
+        self.failed = 0
+        self.rejected = 0
+        self._pending: defaultdict[UsageKey, UsageTotals] = defaultdict(UsageTotals)
+        self._flushing: dict[UsageKey, UsageTotals] = {}  # Taken from _pending by the running flush
+        self._stored: dict[UsageKey, int] = {}  # Billed tokens in the DB at the last read
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def record(self, user_id: UUID, usage: ai.Usage) -> None:
+        self._pending[(user_id, today())].add(totals_from_usage(usage))
+
+    def _used(self, key: UsageKey) -> int:
+        used = self._stored.get(key, 0)
+        for unwritten in (self._pending, self._flushing):
+            if key in unwritten:
+                used += unwritten[key].billed_tokens
+        return used
+
+    async def used_today(self, user_id: UUID) -> int:
+        key = (user_id, today())
+        if key not in self._stored:
+            # First prompt of the day on this worker
+            row = await AiUsage.get_or_none(user_id=user_id, day=key[1])
+            self._stored[key] = row.prompt_tokens + row.completion_tokens if row else 0
+        return self._used(key)
+
+    async def within_quota(self, user_id: UUID) -> bool:
+        if self.daily_quota <= 0:
+            return True
+        if await self.used_today(user_id) < self.daily_quota:
+            return True
+        self.rejected += 1
+        return False
+
+    async def _merge(self, key: UsageKey, totals: UsageTotals) -> None:
+        """
+        Add `totals` to the user's row for the day.
+        """
+        user_id, day = key
+        increments = {name: F(name) + value for name, value in totals.to_fields().items()}
+        rows = AiUsage.filter(user_id=user_id, day=day)
+        if not await rows.update(**increments):
+            try:
+                await AiUsage.create(user_id=user_id, day=day, **totals.to_fields())
+            except IntegrityError:
+                await rows.update(**increments)  # Another worker created the row first
+
+    async def _read_stored(self, key: UsageKey) -> int:
+        user_id, day = key
+        prompt_tokens, completion_tokens = await AiUsage.filter(user_id=user_id, day=day).first() \
+            .values_list("prompt_tokens", "completion_tokens")
+        return prompt_tokens + completion_tokens
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            self._flushing, self._pending = self._pending, defaultdict(UsageTotals)
+            current_day = today()
+            self._stored = {key: tokens for key, tokens in self._stored.items() if key[1] == current_day}
+            for key, totals in list(self._flushing.items()):
+                try:
+                    await self._merge(key, totals)
+                except Exception:
+                    # Back to pending, the next flush retries it and quotas keep counting it meanwhile
+                    logger.exception("Could not write AI usage of user %s", key[0])
+                    self.failed += 1
+                    self._pending[key].add(totals)
+                    del self._flushing[key]
+                    continue
+                self.flushed_rows += 1
+                if key[1] == current_day:
+                    try:
+                        self._stored[key] = await self._read_stored(key)
+                    except Exception:
+                        # Written already: forget the stale count, used_today() reads the row again
+                        logger.exception("Could not read AI usage of user %s", key[0])
+                        self._stored.pop(key, None)
+                del self._flushing[key]
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("AI usage flush failed")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._flush_lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            async with self._flush_lock:  # Never cancel a flush halfway through
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "pending_rows": len(self._pending) + len(self._flushing),
+            "flushed_rows": self.flushed_rows,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+
+usage_recorder = UsageRecorder(
+    flush_interval=settings.AI_USAGE_FLUSH_INTERVAL_SECONDS,
+    daily_quota=settings.AI_DAILY_TOKEN_QUOTA,
+)
+metrics.register("ai_usage", usage_recorder.stats)
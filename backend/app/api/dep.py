@@ -10,6 +10,7 @@ from pydantic import ValidationError
 from tortoise.exceptions import DoesNotExist
 
 from app.core import security
+from app.core.cache import user_cache
 from app.core.config import settings
 from app.models.db_models import User
 from app.models.general_models import TokenPayLoad
@@ -24,6 +25,17 @@ from app.models.general_models import TokenPayLoad
 reusable_oauth2 = OAuth2PasswordBearer(tokenUrl=f"{settings.API_V1_STR}/login/access-token")
 TokenDep = Annotated[str, Depends(reusable_oauth2)]
 
+async def get_user_by_id(user_id: str) -> User:
+    """
+    Fetch an authenticated user, served from the in-process cache when possible.
+    Routes that change a user must call `user_cache.invalidate(str(user.id))`.
+    """
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await User.get(id=user_id)
+        user_cache.set(user_id, user)
+    return user
+
 async def get_current_user(token: TokenDep) -> User:
     try:
         payload = jwt.decode(
@@ -33,7 +45,7 @@ async def get_current_user(token: TokenDep) -> User:
             options={"verify_exp": True},  # Ensure expiration is verified
         )
         token_data = TokenPayLoad(**payload)
-        user = await User.get(id=token_data.sub)
+        user = await get_user_by_id(token_data.sub)
         if not user.is_active:
             raise HTTPException(status_code=400, detail="Inactive user")
 
@@ -62,7 +74,7 @@ async def get_totp_user(token: TokenDep) -> User:
             token, settings.SECRET_KEY, algorithms=[security.ALGORITHM], options={"verify_exp": True}
             )
         token_data = TokenPayLoad(**payload)
-        user = await User.get(id=token_data.sub)
+        user = await get_user_by_id(token_data.sub)
         if not user.is_active:
             raise HTTPException(status_code=400, detail="Inactive user")
 
@@ -97,7 +109,7 @@ async def get_socket_token(token: Annotated[str | None, Query()] = None) -> User
             options={"verify_exp": True},  # Ensure expiration is verified
         )
         token_data = TokenPayLoad(**payload)
-        user = await User.get(id=token_data.sub)
+        user = await get_user_by_id(token_data.sub)
         if not user.is_active:
             raise HTTPException(status_code=400, detail="Inactive user")
 
@@ -1,19 +1,28 @@
-import boto3, time, secrets, string, json
-from typing import Annotated
+import io, os, time, secrets, string, json, logging, zipfile
+from datetime import datetime, timezone
+from typing import Annotated, AsyncIterator
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Path
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Path, Query, Request, Response, Header
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError
 from cryptography.fernet import Fernet
+from tortoise import timezone as tz
 
-from app import crud, utils
+from app import crud, transfer_objects, upload_sessions, utils
 from app.api.dep import get_current_user, CurrentUser
 from app.core.config import settings
-from app.core.security import decode_jwt_token
-from app.models.db_models import TempUser
+from app.core.security import decode_jwt_token, get_secret_hash_async, hashing_pool, pwd_context, verify_secret
+from app.core.storage import StoredObject, UploadTooLarge, storage
+from app.models.db_models import TempUser, TransferObject, UploadSession
 from app.models.general_models import Token, Message
-from app.models.file_transfer import ResponseURL, PromptUrl, S3Object, DownloadUrl, TempUserPublic
+from app.models.file_transfer import (
+    ResponseURL, PromptUrl, S3Object, DownloadUrl, TempUserPublic, PresignUpload, PresignedUpload, CompleteUpload,
+    BulkDelete, BulkDeleteResult, CreateUploadSession, UploadSessionPublic,
+)
+
+logger = logging.getLogger(__name__)
 
 # Token dependency
 reusable_oauth2 = OAuth2PasswordBearer(tokenUrl=f"{settings.API_V1_STR}/file-transfer/login/access-token")
@@ -24,25 +33,34 @@ async def check_temp_user(token: TokenDep):
     if not payload:
         raise HTTPException(status_code=401, detail="Invalid token")
     temp_user = await crud.get_or_404(TempUser, id=payload["sub"])
+    if temp_user.expires_at < tz.now():
+        raise HTTPException(status_code=401, detail="Link expired")
     return temp_user
 
 router = APIRouter(prefix="/file-transfer", tags=["file-transfer"])
-s3_client = boto3.client('s3')
 prefix = "transfer" #Parent Dir in S3
 cipher = Fernet(settings.CIPHER_KEY)
 
-def generate_random_url(exp_hours: int, customer_id: UUID) -> str:
+def url_expiration_time(exp_hours: int) -> int:
+    current_time = int(time.time())
+    exp_in_seconds = exp_hours * 60 * 60  # Convert hours to seconds
+    return current_time + exp_in_seconds
+
+def generate_random_url(expiration_time: int, customer_id: UUID) -> str:
     """
     Generate a secure, encrypted URL with an expiration timestamp.
     """
-    current_time = int(time.time())
-    exp_in_seconds = exp_hours * 60 * 60  # Convert hours to seconds
-    expiration_time = current_time + exp_in_seconds
     payload = {"exp": expiration_time, "user": str(customer_id)} 
     payload_bytes = json.dumps(payload).encode()
     encrypted_payload = cipher.encrypt(payload_bytes).decode()
     return f"{settings.FILE_TRANSFER_URL}?token={encrypted_payload}"
 
+def verify_temp_password(plain_password: str, stored_password: str) -> bool:
+    if pwd_context.identify(stored_password) is None:
+        # Rows created before passwords were hashed, gone once they expire
+        return secrets.compare_digest(plain_password.encode(), stored_password.encode())
+    return verify_secret(plain_password, stored_password)
+
 def generate_random_string(length: int=10) -> str:
     """
     Generate a random string for username and password.
@@ -50,6 +68,21 @@ def generate_random_string(length: int=10) -> str:
     characters = string.ascii_letters + string.digits + string.punctuation.replace('"', '').replace('/', '').replace('\\', '')
     return ''.join(secrets.choice(characters) for _ in range(length))
 
+async def upload_to_storage(key: str, file: UploadFile) -> int:
+    """
+    Stream an uploaded file to storage part by part instead of reading it whole.
+    """
+    if file.size is not None and file.size > settings.UPLOAD_MAX_SIZE_BYTES:
+        raise UploadTooLarge(settings.UPLOAD_MAX_SIZE_BYTES)
+    return await storage.upload_file(
+        key,
+        file,
+        content_type=file.content_type,
+        part_size=settings.UPLOAD_PART_SIZE_BYTES,
+        concurrency=settings.UPLOAD_PART_CONCURRENCY,
+        max_size=settings.UPLOAD_MAX_SIZE_BYTES,
+    )
+
 @router.post(
         "/generate-url",
         dependencies=[Depends(get_current_user)],
@@ -58,15 +91,17 @@ def generate_random_string(length: int=10) -> str:
 async def generate_url(info_for_url: PromptUrl):
     username = generate_random_string()
     password = generate_random_string()
+    expiration_time = url_expiration_time(info_for_url.expiry_hours)
     uploader = await TempUser.create(
         name=username,
-        pwd=password,
+        pwd=await get_secret_hash_async(password),
         company_name=info_for_url.company_name,
         type=info_for_url.type,
         file_name=info_for_url.file_name,
+        expires_at=datetime.fromtimestamp(expiration_time, tz=timezone.utc),
     )
     url = generate_random_url(
-        exp_hours=info_for_url.expiry_hours, 
+        expiration_time=expiration_time, 
         customer_id=uploader.id, 
         )
     return ResponseURL(
@@ -110,11 +145,12 @@ async def login_access_token(
     """
     OAuth2 compatible token login, get an access token for future requests
     """
-    temp_user = await TempUser.get_or_none(
-        name=form_data.username, 
-        pwd=form_data.password,
-    )
-    if temp_user is None:
+    temp_user = await TempUser.get_or_none(name=form_data.username)
+    if (
+        temp_user is None
+        or temp_user.expires_at < tz.now()
+        or not await hashing_pool.run(verify_temp_password, form_data.password, temp_user.pwd)
+    ):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     # Generate tokens
     access_token = utils.generate_utils_token(
@@ -132,19 +168,17 @@ async def upload_file_to_customer(
     Endpoint to upload a file to customer.
     """
     try:
-        # Read the file content
-        file_content = await file.read()
         file_location = f"{prefix}/to_customer/{current_user.username.split()[0]}/{file.filename}"
-        # Upload the file to S3
-        s3_client.put_object(
-            Bucket=settings.S3_BUCKET_NAME,
-            Key=file_location,
-            Body=file_content,
-            ContentType=file.content_type
+        # Stream the file to S3
+        size = await upload_to_storage(file_location, file)
+        await transfer_objects.record_object(
+            key=file_location, size=size, content_type=file.content_type, uploader=current_user.username
         )
 
         return Message(message="File uploaded successfully")
 
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except NoCredentialsError:
         raise HTTPException(status_code=500, detail="AWS credentials not found")
     except PartialCredentialsError:
@@ -164,46 +198,234 @@ async def upload_file_from_customer(
     if current_temp_user.type != "upload":
         raise HTTPException(status_code=403, detail="Unauthorized")
     try:
-        # Read the file content
-        file_content = await file.read()
         file_location = f"{prefix}/from_customer/{current_temp_user.company_name}/{file.filename}"
-        # Upload the file to S3
-        s3_client.put_object(
-            Bucket=settings.S3_BUCKET_NAME,
-            Key=file_location,
-            Body=file_content,
-            ContentType=file.content_type
+        # Stream the file to S3
+        size = await upload_to_storage(file_location, file)
+        await transfer_objects.record_object(
+            key=file_location, size=size, content_type=file.content_type, uploader=current_temp_user.name
         )
         await current_temp_user.delete()
         return Message(message="File uploaded successfully")
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception:
         raise HTTPException(status_code=500, detail="Please try again later")
 
+def customer_upload_key(temp_user: TempUser, file_name: str) -> str:
+    name = os.path.basename(file_name.replace("\\", "/"))
+    if name in ("", ".", ".."):
+        raise HTTPException(status_code=400, detail="Invalid file name")
+    return f"{prefix}/from_customer/{temp_user.company_name}/{name}"
+
+@router.post("/upload/from-customer/presign", response_model=PresignedUpload)
+async def presign_upload_from_customer(
+    current_temp_user: Annotated[TempUser, Depends(check_temp_user)],
+    upload_in: PresignUpload,
+) -> PresignedUpload:
+    """
+    For outside company.
+    Form fields to POST the file straight to S3, scoped to its company folder.
+    Call /upload/from-customer/complete once the POST succeeded.
+    """
+    if current_temp_user.type != "upload":
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    key = customer_upload_key(current_temp_user, upload_in.file_name)
+    presigned = await storage.presigned_post(
+        key,
+        expires_in=settings.UPLOAD_PRESIGN_EXPIRY_SECONDS,
+        max_size=settings.UPLOAD_MAX_SIZE_BYTES,
+        content_type=upload_in.content_type,
+    )
+    return PresignedUpload(
+        url=presigned["url"],
+        fields=presigned["fields"],
+        key=key,
+        expires_in=settings.UPLOAD_PRESIGN_EXPIRY_SECONDS,
+    )
+
+@router.post("/upload/from-customer/complete", response_model=Message)
+async def complete_upload_from_customer(
+    current_temp_user: Annotated[TempUser, Depends(check_temp_user)],
+    upload_in: CompleteUpload,
+) -> Message:
+    """
+    For outside company.
+    Confirm a direct upload: the object must exist, then the temp user is used up.
+    """
+    if current_temp_user.type != "upload":
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    if upload_in.key != customer_upload_key(current_temp_user, upload_in.key):
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    uploaded = await storage.head_object(upload_in.key)
+    if uploaded is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    logger.info("%s uploaded %s (%d bytes)", current_temp_user.company_name, uploaded.key, uploaded.size)
+    await transfer_objects.record_object(
+        key=uploaded.key,
+        size=uploaded.size,
+        content_type=uploaded.content_type,
+        uploader=current_temp_user.name,
+        last_modified=uploaded.last_modified,
+    )
+    await current_temp_user.delete()
+    return Message(message="File uploaded successfully")
+
+def to_s3_object(transfer_object: TransferObject) -> S3Object:
+    return S3Object(
+        Key='/'.join(transfer_object.key.split('/')[-3:]),  # /transfer/folder/name/file -> folder/name/file
+        LastModified=transfer_object.last_modified,
+        Size=transfer_object.size,
+    )
+
+TUS_HEADERS = {"Tus-Resumable": "1.0.0"}
+
+async def get_upload_session(session_id: UUID, temp_user: TempUser) -> UploadSession:
+    session = await UploadSession.get_or_none(id=session_id, temp_user_id=temp_user.id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return session
+
+@router.post("/uploads", status_code=201, response_model=UploadSessionPublic)
+async def create_upload(
+    current_temp_user: Annotated[TempUser, Depends(check_temp_user)],
+    upload_in: CreateUploadSession,
+    response: Response,
+) -> UploadSession:
+    """
+    For outside company.
+    Start a resumable upload. Send the file with PATCH from the returned offset,
+    and ask for the offset with HEAD after an interruption.
+    """
+    if current_temp_user.type != "upload":
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    if upload_in.size > settings.UPLOAD_MAX_SIZE_BYTES:
+        raise HTTPException(status_code=413, detail=str(UploadTooLarge(settings.UPLOAD_MAX_SIZE_BYTES)))
+    session = await upload_sessions.create_session(
+        temp_user=current_temp_user,
+        key=customer_upload_key(current_temp_user, upload_in.file_name),
+        size=upload_in.size,
+        content_type=upload_in.content_type,
+    )
+    response.headers.update({"Location": f"{settings.API_V1_STR}/file-transfer/uploads/{session.id}", **TUS_HEADERS})
+    return session
+
+@router.head("/uploads/{session_id}")
+async def get_upload_offset(
+    current_temp_user: Annotated[TempUser, Depends(check_temp_user)],
+    session_id: UUID,
+) -> Response:
+    """
+    For outside company.
+    Current offset of a resumable upload.
+    """
+    session = await get_upload_session(session_id, current_temp_user)
+    return Response(
+        headers={
+            "Upload-Offset": str(session.offset),
+            "Upload-Length": str(session.size),
+            "Cache-Control": "no-store",
+            **TUS_HEADERS,
+        }
+    )
+
+@router.patch("/uploads/{session_id}", status_code=204)
+async def append_upload(
+    current_temp_user: Annotated[TempUser, Depends(check_temp_user)],
+    session_id: UUID,
+    request: Request,
+    upload_offset: Annotated[int, Header()],
+) -> Response:
+    """
+    For outside company.
+    Append the body at Upload-Offset. The response's Upload-Offset says how much is stored,
+    which is less than sent when the body does not end on a part boundary.
+    The last PATCH completes the upload and uses up the temp user.
+    """
+    session = await get_upload_session(session_id, current_temp_user)
+    if request.headers.get("content-type") != "application/offset+octet-stream":
+        raise HTTPException(status_code=415, detail="Content-Type must be application/offset+octet-stream")
+    if upload_offset != session.offset:
+        raise HTTPException(status_code=409, detail=f"Upload offset is {session.offset}")
+    try:
+        await upload_sessions.append(session, request.stream())
+    except upload_sessions.OffsetConflict:
+        raise HTTPException(status_code=409, detail="Upload offset changed, ask for it again")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if session.offset == session.size:
+        await upload_sessions.complete(session, uploader=current_temp_user.name)
+        await current_temp_user.delete()
+    return Response(status_code=204, headers={"Upload-Offset": str(session.offset), **TUS_HEADERS})
+
+@router.delete("/uploads/{session_id}", status_code=204)
+async def abort_upload(
+    current_temp_user: Annotated[TempUser, Depends(check_temp_user)],
+    session_id: UUID,
+) -> Response:
+    """
+    For outside company.
+    Give up a resumable upload and discard its parts.
+    """
+    session = await get_upload_session(session_id, current_temp_user)
+    await upload_sessions.abort(session)
+    return Response(status_code=204, headers=TUS_HEADERS)
+
 @router.get(
         "/files/{folder}",
         dependencies=[Depends(get_current_user)], 
         response_model=list[S3Object],
         )
-async def list_files(folder: str):
-    try:
-        # Request to the S3
-        response = s3_client.list_objects_v2(
-            Bucket=settings.S3_BUCKET_NAME,
-            Prefix=f"{prefix}/{folder}/"
+async def list_files(
+    folder: str,
+    response: Response,
+    limit: int | None = Query(None, ge=1, le=1000),
+    continuation_token: str | None = None,
+):
+    """
+    Served from transfer_objects, kept in sync by the upload and delete endpoints.
+    Without limit every file is returned. With limit one page is returned,
+    and the X-Continuation-Token header carries the token of the next page, if any.
+    """
+    query = TransferObject.filter(folder=folder).order_by("key")
+    if continuation_token:
+        try:
+            query = query.filter(key__gt=transfer_objects.decode_key_cursor(continuation_token))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if limit is not None:
+        query = query.limit(limit + 1)
+    rows = await query
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Continuation-Token"] = transfer_objects.encode_key_cursor(rows[-1].key)
+    return [to_s3_object(row) for row in rows]
+
+@router.get(
+        "/search",
+        dependencies=[Depends(get_current_user)],
+        response_model=list[S3Object],
         )
-        object_details = [
-            S3Object(
-                Key='/'.join(obj['Key'].split('/')[-3:]),  # /transfer/folder/name/file -> folder/name/file
-                LastModified=obj['LastModified'],
-                Size=obj['Size']
-            )
-            for obj in response.get('Contents', [])
-            if obj['Size'] > 0
-        ]
-        return object_details
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
-    
+async def search_files(
+    company: str | None = None,
+    file_name: str | None = None,
+    folder: str | None = None,
+    limit: int = Query(100, ge=1, le=1000),
+):
+    """
+    Find files by exact company and/or file name prefix, newest first.
+    """
+    if not company and not file_name:
+        raise HTTPException(status_code=400, detail="Provide company or file_name")
+    query = TransferObject.all()
+    if company:
+        query = query.filter(company=company)
+    if file_name:
+        query = query.filter(file_name__startswith=file_name)
+    if folder:
+        query = query.filter(folder=folder)
+    rows = await query.order_by("-last_modified").limit(limit)
+    return [to_s3_object(row) for row in rows]
+
 @router.get("/download/myfile")
 async def download_own_file(
     current_temp_user: Annotated[TempUser, Depends(check_temp_user)], 
@@ -217,14 +439,9 @@ async def download_own_file(
         raise HTTPException(status_code=403, detail="Unauthorized")
     try:
         # Fetch the url from S3
-        url = s3_client.generate_presigned_url(
-            "get_object",
-            Params={
-                "Bucket": settings.S3_BUCKET_NAME, 
-                "Key": f"{prefix}/{current_temp_user.file_name}",
-                "ResponseContentDisposition": "attachment"
-                },
-            ExpiresIn=30 # Expire in 30s
+        url = await storage.presigned_url(
+            f"{prefix}/{current_temp_user.file_name}",
+            expires_in=30 # Expire in 30s
             )
         await current_temp_user.delete()
         
@@ -247,15 +464,7 @@ async def download_file(
     """
     try:
         # Fetch the url from S3
-        url = s3_client.generate_presigned_url(
-            "get_object",
-            Params={
-                "Bucket": settings.S3_BUCKET_NAME, 
-                "Key": f"{prefix}/{file_name}",
-                "ResponseContentDisposition": "attachment"
-                },
-            ExpiresIn=30
-            )
+        url = await storage.presigned_url(f"{prefix}/{file_name}", expires_in=30)
         
         # Return the url to the client
         return DownloadUrl(
@@ -278,13 +487,107 @@ async def delete_file(
     """ 
     try:
         # Fetch the file from S3
-        s3_client.delete_object(
-            Bucket=settings.S3_BUCKET_NAME, 
-            Key=f"{prefix}/{file_name}"
-            )
+        await storage.delete_object(f"{prefix}/{file_name}")
+        await transfer_objects.forget_object(f"{prefix}/{file_name}")
        
         # Stream the file to the client
         return Message(message="Successfully deleted")
     except Exception as e:
         return {"error": str(e)}
-    
\ No newline at end of file
+
+@router.post("/delete", response_model=BulkDeleteResult)
+async def delete_files(
+    current_user: CurrentUser,
+    delete_in: BulkDelete,
+) -> BulkDeleteResult:
+    """
+    For operator.
+    Delete many files at once, up to 1000 keys per S3 request.
+    file_names: folder/name/file -> Key: transfer/folder/name/file
+    """
+    keys = list(dict.fromkeys(f"{prefix}/{file_name}" for file_name in delete_in.file_names))
+    failed = await storage.delete_objects(keys)
+    failed_keys = set(failed)
+    deleted = [key for key in keys if key not in failed_keys]
+    for start in range(0, len(deleted), 1000):
+        await TransferObject.filter(key__in=deleted[start:start + 1000]).delete()
+    return BulkDeleteResult(
+        deleted=len(deleted),
+        failed=['/'.join(key.split('/')[1:]) for key in failed],
+    )
+
+
+class ZipSink(io.RawIOBase):
+    """
+    Unseekable sink zipfile writes into, drained into the response as it fills.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def zip_objects(objects: AsyncIterator[StoredObject], strip: int) -> AsyncIterator[bytes]:
+    """
+    Build a zip on the fly from object streams, one chunk in memory at a time.
+    Entries are stored uncompressed; transferred files are mostly compressed already.
+    """
+    sink = ZipSink()
+    # An unseekable sink makes zipfile write data descriptors instead of seeking back
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as archive:
+        async for obj in objects:
+            info = zipfile.ZipInfo(obj.key[strip:], date_time=max(obj.last_modified.timetuple()[:6], (1980, 1, 1, 0, 0, 0)))
+            info.file_size = obj.size  # Lets zipfile decide on zip64 up front
+            with archive.open(info, "w") as entry:
+                async for chunk in storage.iter_object(obj.key):
+                    entry.write(chunk)
+                    if data := sink.drain():
+                        yield data
+            if data := sink.drain():
+                yield data
+    if data := sink.drain():
+        yield data
+
+
+@router.get("/download-folder/{folder:path}")
+async def download_folder(
+    current_user: CurrentUser,
+    folder: str = Path(...),
+) -> StreamingResponse:
+    """
+    For operator.
+    Download every file of a folder as a zip, streamed while it is built.
+    folder: folder/name -> Prefix: transfer/folder/name/
+    """
+    folder_prefix = f"{prefix}/{folder.strip('/')}/"
+    page, token = await storage.list_objects(folder_prefix)
+    if not any(obj.size > 0 for obj in page):
+        raise HTTPException(status_code=404, detail="Folder not found")
+
+    async def objects(page: list[StoredObject], token: str | None) -> AsyncIterator[StoredObject]:
+        while True:
+            for obj in page:
+                if obj.size > 0:
+                    yield obj
+            if token is None:
+                return
+            page, token = await storage.list_objects(folder_prefix, continuation_token=token)
+
+    file_name = f"{folder.strip('/').split('/')[-1]}.zip".replace('"', '')
+    return StreamingResponse(
+        zip_objects(objects(page, token), strip=len(folder_prefix)),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{file_name}"'},
+    )
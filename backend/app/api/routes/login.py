@@ -6,8 +6,10 @@ from fastapi.security import OAuth2PasswordRequestForm
 
 from app import crud, utils
 from app.core import security
+from app.core.cache import user_cache
 from app.core.config import settings
 from app.api.dep import TotpUser
+from app.email_outbox import EmailNotConfigured, email_outbox_worker, enqueue_email
 from app.models.db_models import User
 from app.models.general_models import Token, Message, NewPassword, TOTPToken
 
@@ -22,7 +24,7 @@ async def login_access_token(
     OAuth2 compatible token login, get an access token for future requests
     """
     user = await crud.get_or_404(User, email=form_data.username)
-    if not user or not security.verify_secret(form_data.password, user.hashed_password):
+    if not user or not await security.verify_secret_async(form_data.password, user.hashed_password):
         raise HTTPException(status_code=400, detail="Incorrect email or password")
     elif not user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
@@ -150,16 +152,15 @@ async def recover_password(email: str) -> Message:
     email_data = utils.generate_resetup_password_email(
         email_to=user.email, email=email, token=password_reset_token, action="reset"
     )
-    email_response = await utils.send_email(
-        email_to=user.email,
-        subject=email_data.subject,
-        html_content=email_data.html_content,
-        )
-    if not email_response:
-        raise HTTPException(
-            status_code=500,
-            detail="Mail is not sent successfully, probably mail server issue",
+    try:
+        await enqueue_email(
+            email_to=user.email,
+            subject=email_data.subject,
+            html_content=email_data.html_content,
         )
+    except EmailNotConfigured as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    email_outbox_worker.wake()
     return Message(message="Password recovery email sent")
 
 @router.post("/reset-password")
@@ -173,9 +174,10 @@ async def reset_password(body: NewPassword) -> Message:
     user = await crud.get_or_404(User, email=email)
     if not user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
-    hashed_password = security.get_secret_hash(body.new_password)
+    hashed_password = await security.get_secret_hash_async(body.new_password)
     user.hashed_password = hashed_password
     await user.save()
+    user_cache.invalidate(str(user.id))
     return Message(message="Password updated successfully")
 
 @router.post("/setup-password")
@@ -189,17 +191,19 @@ async def set_up_password(body: NewPassword) -> Message:
     user = await crud.get_or_404(User, email=email)
     if not user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
-    hashed_password = security.get_secret_hash(body.new_password)
+    hashed_password = await security.get_secret_hash_async(body.new_password)
     user.hashed_password = hashed_password
     await user.save()
+    user_cache.invalidate(str(user.id))
 
     if settings.emails_enabled and user.email:
         email_data = utils.generate_new_account_email(
             email_to=user.email, username=user.email
         )
-        await utils.send_email(
+        await enqueue_email(
             email_to=user.email,
             subject=email_data.subject,
             html_content=email_data.html_content,
-        )   
+        )
+        email_outbox_worker.wake()
     return Message(message="Password set up is successful")
\ No newline at end of file
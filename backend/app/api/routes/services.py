@@ -1,14 +1,18 @@
+from datetime import datetime
+from typing import Literal
 from uuid import UUID
 
 from tortoise.exceptions import IntegrityError
-from fastapi import APIRouter, Depends, HTTPException
+from tortoise.expressions import Q
+from fastapi import APIRouter, Depends, HTTPException, Query
 
-from app import crud, utils
+from app import crud, rollups, service_status
 from app.api.dep import CurrentUser, get_current_active_superuser
+from app.log_ingestion import LogEntry, log_ingestor
 from app.models.db_models import Service, User, Log
 from app.models.user_models import Usernames
 from app.models.general_models import Message
-from app.models.service_models import ServiceCreate, ServiceUpdate, ServicePublic, ServicesPublic, AlertConfigCreate, PublishConfigCreate, ServiceConfig, ServiceLogs
+from app.models.service_models import ServiceCreate, ServiceUpdate, ServicePublic, ServicesPublic, AlertConfigCreate, PublishConfigCreate, ServiceConfig, ServiceLogs, LogsBulkCreate, ServiceStats, ServicesOverview
 
 router = APIRouter(prefix="/services", tags=["services"])
 
@@ -26,19 +30,29 @@ async def get_services(current_user: CurrentUser, skip: int = 0, limit: int = 10
     return ServicesPublic(data=services, count=count)
 
 
+@router.get("/overview", response_model=ServicesOverview)
+async def get_services_overview(current_user: CurrentUser) -> ServicesOverview:
+    """
+    List every visible service with its latest check status
+    """
+    if current_user.is_superuser:
+        query = Service.all()
+    else:
+        query = Service.filter(users__id=current_user.id)
+    services = await query.select_related("status").order_by("name", "sub_name")
+    return ServicesOverview(data=services, count=len(services))
+
+
 @router.get("/{service_id}", response_model=ServicePublic)
 async def get_service(current_user: CurrentUser, service_id: UUID) -> ServicePublic:
     """
     List a user that can edit the service
     """
-    service = await crud.get_or_404(Service, id=service_id)
-    can_read = await utils.check_privileges(
+    service = await crud.get_service_or_404(
         user=current_user, 
         service_id=service_id, 
         privilege="read"
         )
-    if not can_read:
-        raise HTTPException(status_code=403, detail="Not enough privileges")
     return service
 
 @router.get("/{service_id}/users", response_model=Usernames)
@@ -46,21 +60,15 @@ async def get_service_users(current_user: CurrentUser, service_id: UUID) -> User
     """
     List service users
     """
-    service = await crud.get_or_404(
-        Service, 
-        id=service_id, 
-        prefetch_related=["users"]
-        )
-    can_read = await utils.check_privileges(
+    await crud.get_service_or_404(
         user=current_user, 
         service_id=service_id, 
         privilege="read"
         )
-    if not can_read:
-        raise HTTPException(status_code=403, detail="Not enough privileges")
     # Only fetch who can edit
-    users = await service.users.filter(can_edit=True).all() + await User.filter(is_superuser=True).all()
-    usernames = [user.username for user in users]
+    usernames = await User.filter(
+        Q(services__id=service_id, can_edit=True) | Q(is_superuser=True)
+        ).distinct().values_list("username", flat=True)
     return Usernames(usernames=usernames)
 
 @router.post(
@@ -85,17 +93,16 @@ async def update_service(
     """
     Update a service
     """
-    service = await crud.get_or_404(model=Service, id=service_id)
-
-    can_write = await utils.check_privileges(
+    service = await crud.get_service_or_404(
         user=current_user, 
         service_id=service_id, 
         privilege="write"
         )
-    if not can_write:
-        raise HTTPException(status_code=403, detail="Not enough privileges")
-    
+    old_key = (service.name, service.sub_name)
     service = await crud.update_instance(instance=service, data_in=service_in)
+    # Logs are matched to services by (name, sub_name), drop both mappings
+    log_ingestor.service_ids.invalidate(old_key)
+    log_ingestor.service_ids.invalidate((service.name, service.sub_name))
 
     return service
     
@@ -104,16 +111,18 @@ async def update_service(
         dependencies=[Depends(get_current_active_superuser)], 
         response_model=Message
         )
-async def delete_service(service_id: UUID) -> Message:
+async def delete_service(service_id: UUID, current_user: CurrentUser) -> Message:
     """
     Delete a service
     """
-    service = await crud.get_or_404(
-        Service, 
-        id=service_id, 
-        prefetch_related=["users"])
+    service = await crud.get_service_or_404(
+        user=current_user, 
+        service_id=service_id, 
+        privilege="write"
+        )
 
     await service.delete()
+    log_ingestor.service_ids.invalidate((service.name, service.sub_name))
     
     return Message(message="Successfully deleted the service.")
     
@@ -122,19 +131,12 @@ async def get_service_config(service_id: UUID, current_user: CurrentUser) -> Ser
     """
     Read a service's config
     """
-    service_with_config = await crud.get_or_404(
-        Service, 
-        id=service_id, 
-        select_related=["alert_config", "publish_config"]
-        )
-
-    can_read = await utils.check_privileges(
+    service_with_config = await crud.get_service_or_404(
         user=current_user, 
         service_id=service_id, 
-        privilege="read"
+        privilege="read",
+        select_related=["alert_config", "publish_config"]
         )
-    if not can_read:
-        raise HTTPException(status_code=403, detail="Not enough privileges")
 
     return ServiceConfig(
         **service_with_config.__dict__,
@@ -151,19 +153,11 @@ async def update_service_alert_config(
     """
     Update service's config (Alert)
     """
-    service = await crud.get_or_404(
-        Service, 
-        id=service_id, 
-        prefetch_related=["alert_config"]
-        )
-
-    can_write = await utils.check_privileges(
+    service = await crud.get_service_or_404(
         user=current_user, 
         service_id=service_id, 
-        privilege="write")
-    if not can_write:
-        raise HTTPException(status_code=403, detail="Not enough privileges")
-    
+        privilege="write"
+        )
     await crud.create_or_update_config(service=service, config_data=config_in)
     return Message(message="Alert config updated successfully")
 
@@ -176,19 +170,11 @@ async def update_service_publish_config(
     """
     Update service's config (Alert)
     """
-    service = await crud.get_or_404(
-        Service, 
-        id=service_id, 
-        prefetch_related=["publish_config"]
-        )
-
-    can_write = await utils.check_privileges(
+    service = await crud.get_service_or_404(
         user=current_user, 
         service_id=service_id, 
-        privilege="write")
-    if not can_write:
-        raise HTTPException(status_code=403, detail="Not enough privileges")
-    
+        privilege="write"
+        )
     await crud.create_or_update_config(service=service, config_data=config_in)
     return Message(message="Alert config updated successfully")
 
@@ -199,27 +185,103 @@ async def update_service_publish_config(
 async def get_service_logs(
     current_user: CurrentUser, 
     service_id: UUID, 
-    skip: int = 0, 
-    limit: int = 100):
+    cursor: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    order: Literal["asc", "desc"] = "desc",
+    skip: int | None = Query(None, ge=0, description="Legacy offset pagination, prefer `cursor`"),
+    limit: int = Query(100, ge=1, le=1000)):
     """
-    Retrieve logs for a specific service.
+    Retrieve logs for a specific service, newest first by default.
+    Follow `next_cursor` to page; `since` is inclusive, `until` exclusive.
     """
-    service = await crud.get_or_404(
-        Service, 
-        id=service_id, 
-        prefetch_related=["logs"]
-        )
-    
-    can_read = await utils.check_privileges(
+    service = await crud.get_service_or_404(
         user=current_user,
         service_id=service_id,
         privilege="read"
     )
-    if not can_read:
-        raise HTTPException(status_code=403, detail="Not enough privileges")
 
-    # Apply skip and limit manually (as get_or_404 retrieves a single instance by default)
-    logs_data = await Log.filter(service_id=service_id).offset(skip).limit(limit).all()
+    logs_data, next_cursor = await crud.get_logs_page(
+        service_id=service_id,
+        limit=limit,
+        cursor=cursor,
+        since=since,
+        until=until,
+        order=order,
+        skip=skip,
+    )
     # if not logs_data:
     #     raise HTTPException(status_code=404, detail="No logs found for this service.")
-    return ServiceLogs(**service.__dict__, logs=logs_data)
\ No newline at end of file
+    return ServiceLogs(**service.__dict__, logs=logs_data, next_cursor=next_cursor)
+
+@router.get(
+        "/{service_id}/stats", 
+        response_model=ServiceStats
+        )
+async def get_service_stats(
+    current_user: CurrentUser, 
+    service_id: UUID, 
+    window: Literal["1h", "24h", "7d", "30d", "90d"] = "24h") -> ServiceStats:
+    """
+    Uptime and response time summary for a service.
+    Windows longer than an hour are served from the hourly/daily rollups.
+    """
+    await crud.get_service_or_404(
+        user=current_user,
+        service_id=service_id,
+        privilege="read"
+    )
+    aggregate, source = await rollups.get_stats(service_id=service_id, window=window)
+    return ServiceStats(
+        window=window,
+        source=source,
+        count=aggregate.count,
+        failures=aggregate.failures,
+        uptime=(aggregate.count - aggregate.failures) / aggregate.count if aggregate.count else None,
+        elapsed_min=aggregate.elapsed_min,
+        elapsed_max=aggregate.elapsed_max,
+        elapsed_mean=aggregate.elapsed_sum / aggregate.timed_count if aggregate.timed_count else None,
+        elapsed_p50=aggregate.percentile(0.50),
+        elapsed_p95=aggregate.percentile(0.95),
+        elapsed_p99=aggregate.percentile(0.99),
+    )
+
+@router.post(
+        "/logs/bulk", 
+        status_code=202,
+        response_model=Message
+        )
+async def create_service_logs_bulk(logs_in: LogsBulkCreate, current_user: CurrentUser) -> Message:
+    """
+    Push check results for one or more services in a single call.
+    Entries are queued and written in batches.
+    """
+    if not current_user.is_superuser and not current_user.can_edit:
+        raise HTTPException(status_code=403, detail="Not enough privileges")
+
+    keys = {(log.service_name, log.service_sub_name) for log in logs_in.logs}
+    service_ids = await log_ingestor.resolve_service_ids(keys)
+    unknown = keys - service_ids.keys()
+    if not current_user.is_superuser:
+        allowed = set(
+            await current_user.services.filter(id__in=set(service_ids.values())).values_list("id", flat=True)
+        )
+        # Unknown services get the same answer as forbidden ones, so names cannot be probed
+        if unknown or allowed != set(service_ids.values()):
+            raise HTTPException(status_code=403, detail="Not enough privileges")
+    elif unknown:
+        names = ", ".join(f"{name}/{sub_name}" for name, sub_name in sorted(unknown))
+        raise HTTPException(status_code=404, detail=f"Service not found: {names}")
+
+    await log_ingestor.enqueue([
+        LogEntry(
+            service_id=service_ids[(log.service_name, log.service_sub_name)],
+            start_time=log.start_time,
+            end_time=log.end_time,
+            is_ok=log.is_ok,
+            screenshot=log.screenshot,
+            content=log.content,
+        )
+        for log in logs_in.logs
+    ])
+    return Message(message=f"{len(logs_in.logs)} log entries queued")
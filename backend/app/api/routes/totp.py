@@ -3,6 +3,7 @@ from fastapi import APIRouter, Depends, HTTPException
 
 from app import crud
 from app.api.dep import CurrentUser, get_current_active_superuser
+from app.core.cache import user_cache
 from app.core.security import create_totp, verify_totp
 from app.models.db_models import User
 from app.models.general_models import QRUri, Message, TOTPToken
@@ -24,6 +25,7 @@ async def enable_totp(current_user: CurrentUser) -> QRUri:
     totp_secret, qr_uri = create_totp(user.username)
     user.totp_secret = totp_secret
     await user.save()
+    user_cache.invalidate(str(user.id))
 
     return QRUri(uri=qr_uri)
 
@@ -42,6 +44,7 @@ async def totp_login_verify(current_user: CurrentUser, totp_data: TOTPToken) ->
         raise HTTPException(status_code=400, detail="Invalid TOTP token.")
     user.is_totp_enabled = True
     await user.save()
+    user_cache.invalidate(str(user.id))
     
     return Message(message="2FA is enabled successfully")
 
@@ -59,6 +62,7 @@ async def disable_totp(current_user: CurrentUser) -> Message:
     user.totp_secret = None
     user.is_totp_enabled = False
     await user.save()
+    user_cache.invalidate(str(user.id))
     
     return Message(message="TOTP has been disabled successfully.")
 
@@ -79,5 +83,6 @@ async def admin_disable_totp(user_id: UUID) -> Message:
     user.totp_secret = None
     user.is_totp_enabled = False
     await user.save()
+    user_cache.invalidate(str(user.id))
     
     return Message(message="TOTP has been disabled successfully for the user.")
@@ -6,7 +6,9 @@ from fastapi import APIRouter, Depends, HTTPException
 
 from app import utils, crud
 from app.api.dep import CurrentUser, get_current_active_superuser
-from app.core.security import get_secret_hash, verify_secret
+from app.core.cache import user_cache
+from app.core.security import get_secret_hash_async, verify_secret_async
+from app.email_outbox import EmailNotConfigured, email_outbox_worker, enqueue_email
 from app.models.db_models import User
 from app.models.general_models import Message
 from app.models.user_models import UserPublic, UsersPublic, UserRegister, UserCreate, UpdatePassword, UserUpdate
@@ -73,36 +75,35 @@ async def register_user(user_in: UserRegister) -> Message:
             email_to=user.email, email=user.email, token=password_setup_token, action="setup"
         )
 
-        # Attempt to send email
-        email_response = await utils.send_email(
-            email_to=user.email,
-            subject=email_data.subject,
-            html_content=email_data.html_content,
+        # Committed with the user, sent by the outbox worker
+        try:
+            await enqueue_email(
+                email_to=user.email,
+                subject=email_data.subject,
+                html_content=email_data.html_content,
+                using_db=transaction,
             )
-        
-        # If email sending fails, raise an exception to roll back the transaction
-        if not email_response:
-            await transaction.rollback()
-            raise HTTPException(
-                status_code=500,
-                detail="Mail server error, try again later",
-            )
-        return Message(message="Password set up email sent")
+        except EmailNotConfigured as e:
+            # Rolls the user back: without the email they could never set a password
+            raise HTTPException(status_code=503, detail=str(e))
+    email_outbox_worker.wake()
+    return Message(message="Password set up email sent")
 
 @router.patch("/me/password", response_model=Message)
 async def update_password_me(body: UpdatePassword, current_user: CurrentUser) -> Any:
     """
     Update own password.
     """
-    if not verify_secret(body.current_password, current_user.hashed_password):
+    if not await verify_secret_async(body.current_password, current_user.hashed_password):
         raise HTTPException(status_code=400, detail="Incorrect password")
     if body.current_password == body.new_password:
         raise HTTPException(
             status_code=400, detail="New password cannot be the same as the current one"
         )
-    hashed_password = get_secret_hash(body.new_password)
+    hashed_password = await get_secret_hash_async(body.new_password)
     current_user.hashed_password = hashed_password
     await current_user.save()
+    user_cache.invalidate(str(current_user.id))
     return Message(message="Password updated successfully")
 
 @router.patch(
@@ -124,6 +125,7 @@ async def update_user(
             status_code=403, detail="Super users are not allowed to update themselves"
         )
     user_updated = await crud.update_instance(instance=user_update, data_in=user_in)
+    user_cache.invalidate(str(user_id))
     return user_updated
 
 @router.delete("/{user_id}", dependencies=[Depends(get_current_active_superuser)])
@@ -137,5 +139,6 @@ async def delete_user(current_user: CurrentUser, user_id: UUID) -> Message:
             status_code=403, detail="Super users are not allowed to delete themselves"
         )
     await user.delete()
+    user_cache.invalidate(str(user_id))
     return Message(message="User deleted successfully")
 
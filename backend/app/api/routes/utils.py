@@ -1,9 +1,15 @@
-from datetime import datetime
-from fastapi import APIRouter, Depends
+from datetime import date, datetime
+from typing import Any
+from fastapi import APIRouter, Depends, HTTPException
 from pydantic.networks import EmailStr
+from tortoise.functions import Sum
 
 from app import crud
+from app.ai_usage import today, usage_recorder
 from app.api.dep import get_current_active_superuser, CurrentUser
+from app.core import metrics
+from app.models.ai import AiUsageOut, AiUsageReport
+from app.models.db_models import AiUsage
 from app.models.general_models import Message
 from app.utils import generate_test_email, send_email
 
@@ -42,4 +48,56 @@ async def test_email(email_to: EmailStr, current_user: CurrentUser) -> Message:
 
 @router.get("/health-check")
 async def health_check() -> bool:
-    return True
\ No newline at end of file
+    return True
+
+
+@router.get(
+    "/metrics",
+    dependencies=[Depends(get_current_active_superuser)]
+)
+async def get_metrics() -> dict[str, dict[str, Any]]:
+    """
+    In-process counters of this worker (caches, pools, background jobs).
+    """
+    return metrics.snapshot()
+
+
+@router.get(
+    "/ai-usage",
+    dependencies=[Depends(get_current_active_superuser)],
+    response_model=AiUsageReport,
+)
+async def get_ai_usage(start: date | None = None, end: date | None = None) -> AiUsageReport:
+    """
+    AI assistant token usage per user between start and end (UTC days, inclusive), heaviest first.
+    """
+    start = start or today()
+    end = end or start
+    if end < start:
+        raise HTTPException(status_code=400, detail="end must not be before start")
+    await usage_recorder.flush()  # Include this worker's unwritten usage
+    rows = await AiUsage.filter(day__gte=start, day__lte=end) \
+        .annotate(
+            total_requests=Sum("requests"),
+            total_prompt_tokens=Sum("prompt_tokens"),
+            total_completion_tokens=Sum("completion_tokens"),
+            total_cached_tokens=Sum("cached_tokens"),
+        ) \
+        .group_by("user_id", "user__username") \
+        .values(
+            "user_id", "user__username", "total_requests",
+            "total_prompt_tokens", "total_completion_tokens", "total_cached_tokens",
+        )
+    data = [
+        AiUsageOut(
+            user_id=row["user_id"],
+            username=row["user__username"],
+            requests=row["total_requests"],
+            prompt_tokens=row["total_prompt_tokens"],
+            completion_tokens=row["total_completion_tokens"],
+            cached_tokens=row["total_cached_tokens"],
+        )
+        for row in rows
+    ]
+    data.sort(key=lambda usage: usage.prompt_tokens + usage.completion_tokens, reverse=True)
+    return AiUsageReport(start=start, end=end, data=data)
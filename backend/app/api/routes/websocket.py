@@ -1,63 +1,180 @@
-from openai import AsyncOpenAI
+import asyncio, json, logging
 
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from typing import AsyncGenerator, NoReturn
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, status
+from typing import Any, AsyncGenerator, Awaitable, Callable, Literal, NoReturn
+
+from app import ai
+from app.ai_usage import usage_recorder
 from app.api.dep import SocketUser
+from app.core.config import settings
 
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/ws", tags=["websocket"])
 
-# Lazy initialization for pytest
-client = None
-def get_openai_client():
-    global client
-    if client is None:
-        client = AsyncOpenAI()
-    return client
+# full: every frame is the whole answer so far (what older clients expect)
+# delta: {"type": "delta", "content": ...} frames with the new text only, then {"type": "done"}
+# mux: JSON in both directions, every frame carries the id of its prompt, see MuxSession
+StreamMode = Literal["full", "delta", "mux"]
+
+# Frames are formatted by hand: json.dumps per delta would cost more CPU than the full mode saves
+encode_json = json.JSONEncoder(ensure_ascii=False).encode
+DELTA_FRAME = '{"type":"delta","content":%s}'
+DONE_FRAME = '{"type":"done"}'
+MUX_DELTA_FRAME = '{"id":%s,"type":"delta","content":%s}'
+
+MAX_REQUEST_ID_LENGTH = 64
+QUOTA_EXCEEDED = "Daily token quota exceeded"
+
 
-async def get_ai_response(message: str) -> AsyncGenerator[str, None]:
+async def get_ai_response(message: str, usage: ai.Usage | None = None) -> AsyncGenerator[str, None]:
     """
-    OpenAI Response
+    OpenAI Response, the whole answer so far on every chunk
     """
-    client = get_openai_client()
-    response = await client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    "You are a helpful assistant."
-                    "Generate a short response."
-                    "Use Markdown where applicable for better readability."
-                ),
-            },
-            {
-                "role": "user",
-                "content": message,
-            },
-        ],
-        stream=True
-    )
-
     all_content = ""
-    async for chunk in response:
-        content = chunk.choices[0].delta.content
-        if content:
-            all_content += content
-            yield all_content
+    async for content in ai.stream_completion(message, usage=usage):
+        all_content += content
+        yield all_content
+
+
+async def send_ai_response(
+    send_text: Callable[[str], Awaitable[None]], message: str, mode: StreamMode, usage: ai.Usage | None = None
+) -> None:
+    if mode == "full":
+        async for text in get_ai_response(message, usage):
+            await send_text(text)
+        return
+    async for content in ai.stream_completion(message, usage=usage):
+        await send_text(DELTA_FRAME % encode_json(content))
+    await send_text(DONE_FRAME)
+
+
+class MuxSession:
+    """
+    One socket, several prompts answered at once.
+
+    Client: {"type": "prompt", "id": "...", "content": "..."} and {"type": "cancel", "id": "..."}
+    Server: {"id", "type": "delta", "content"}, then {"id", "type": "done"}, {"id", "type": "cancelled"}
+    or {"id", "type": "error", "detail"}.
+
+    Prompts in flight are capped per user, so a connection holds at most that many upstream streams,
+    each with one frame pending: sends are serialised and wait for the socket to take the frame.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: Any) -> None:
+        self.websocket = websocket
+        self.user_id = user_id
+        self.tasks: dict[str, asyncio.Task] = {}
+        self.send_lock = asyncio.Lock()
+
+    async def send(self, frame: str) -> None:
+        async with self.send_lock:
+            await self.websocket.send_text(frame)
+
+    async def send_frame(self, request_id: str | None, kind: str, **fields: Any) -> None:
+        await self.send(json.dumps({"id": request_id, "type": kind, **fields}, ensure_ascii=False))
+
+    async def send_last_frame(self, request_id: str, kind: str, **fields: Any) -> None:
+        # Sent while the prompt ends, possibly because the socket is gone: then there is nobody to tell
+        try:
+            await self.send_frame(request_id, kind, **fields)
+        except Exception:
+            logger.debug("Dropped the %s frame of %s, the socket is closed", kind, request_id)
+
+    async def answer(self, request_id: str, content: str) -> None:
+        usage = ai.Usage()
+        try:
+            encoded_id = encode_json(request_id)
+            async for delta in ai.stream_completion(content, usage=usage):
+                await self.send(MUX_DELTA_FRAME % (encoded_id, encode_json(delta)))
+            await self.send_frame(request_id, "done")
+        except asyncio.CancelledError:
+            # Cancelled by the client, or the socket is gone and nobody is listening
+            if request_id in self.tasks:
+                await self.send_last_frame(request_id, "cancelled")
+            raise
+        except WebSocketDisconnect:
+            pass
+        except Exception:
+            logger.exception("AI response %s failed", request_id)
+            await self.send_last_frame(request_id, "error", detail="AI response failed")
+        finally:
+            usage_recorder.record(self.user_id, usage)
+
+    def finished(self, request_id: str) -> None:
+        # A done callback rather than a finally: a task cancelled before it started never runs its body
+        self.tasks.pop(request_id, None)
+        ai.prompt_limiter.release(self.user_id)
+
+    async def handle(self, raw: str) -> None:
+        try:
+            frame = json.loads(raw)
+            kind, request_id = frame["type"], frame["id"]
+        except (ValueError, TypeError, KeyError):
+            return await self.send_frame(None, "error", detail="Invalid frame")
+        if not isinstance(request_id, str) or not 0 < len(request_id) <= MAX_REQUEST_ID_LENGTH:
+            return await self.send_frame(None, "error", detail="Invalid id")
+
+        if kind == "cancel":
+            if task := self.tasks.get(request_id):
+                task.cancel()
+            return
+        if kind != "prompt":
+            return await self.send_frame(request_id, "error", detail="Unknown type")
+        content = frame.get("content")
+        if not isinstance(content, str) or not 0 < len(content) <= settings.AI_MAX_PROMPT_CHARS:
+            return await self.send_frame(request_id, "error", detail="Invalid content")
+        if request_id in self.tasks:
+            return await self.send_frame(request_id, "error", detail="Duplicate id")
+        if not await usage_recorder.within_quota(self.user_id):
+            return await self.send_frame(request_id, "error", detail=QUOTA_EXCEEDED)
+        if not ai.prompt_limiter.try_acquire(self.user_id):
+            return await self.send_frame(request_id, "error", detail="Too many prompts in flight")
+        task = asyncio.create_task(self.answer(request_id, content))
+        task.add_done_callback(lambda _: self.finished(request_id))
+        self.tasks[request_id] = task
+
+    async def close(self) -> None:
+        tasks = list(self.tasks.values())
+        self.tasks.clear()  # Nobody left to tell about the cancellation
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run(self) -> None:
+        try:
+            while True:
+                await self.handle(await self.websocket.receive_text())
+        except WebSocketDisconnect:
+            pass
+        finally:
+            await self.close()
+
 
 @router.websocket("/{user_id}")
-async def websocket_openai(websocket: WebSocket, current_user: SocketUser) -> NoReturn:
+async def websocket_openai(websocket: WebSocket, current_user: SocketUser, mode: StreamMode = "full") -> NoReturn:
     """
-    Websocket for AI responses
+    Websocket for AI responses, streamed as chosen by ?mode= when connecting
     """
     await websocket.accept()
+    if mode == "mux":
+        return await MuxSession(websocket, current_user.id).run()
     # try:
     while True:
         try:
             message = await websocket.receive_text()
-            async for text in get_ai_response(message):
-                await websocket.send_text(text)
+            if not await usage_recorder.within_quota(current_user.id):
+                if mode == "full":
+                    # Every text frame is an answer in this mode, so say it with the close code
+                    await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=QUOTA_EXCEEDED)
+                    return None
+                await websocket.send_text(encode_json({"type": "error", "detail": QUOTA_EXCEEDED}))
+                continue
+            usage = ai.Usage()
+            try:
+                await send_ai_response(websocket.send_text, message, mode, usage)
+            finally:
+                usage_recorder.record(current_user.id, usage)
 
         except WebSocketDisconnect:
-            return None
\ No newline at end of file
+            return None
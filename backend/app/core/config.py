@@ -23,6 +23,26 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 15  # Minutes
     REFRESH_TOKEN_EXPIRE_HOURS: int = 1  # Hours
     FILE_TRANSFER_TOKEN_EXPIRY_HOURS: int = 9 # Hours
+    USER_CACHE_MAX_SIZE: int = 1024
+    USER_CACHE_TTL_SECONDS: int = 30  # Max staleness on the other workers
+    HASH_POOL_KIND: Literal["thread", "process"] = "thread"
+    HASH_POOL_WORKERS: int = 2
+    HASH_MAX_IN_FLIGHT: int = 16  # Hashing calls beyond this get a 503
+    LOG_INGEST_BATCH_SIZE: int = 500
+    LOG_INGEST_FLUSH_INTERVAL_SECONDS: float = 1.0
+    LOG_INGEST_MAX_BUFFER: int = 10000  # Producers flush inline beyond this
+    SERVICE_ID_CACHE_TTL_SECONDS: int = 300
+    LOG_RETENTION_DAYS: int = 30  # Default hot retention, per-service override on the service
+    LOG_RETENTION_BATCH_SIZE: int = 1000
+    LOG_RETENTION_INTERVAL_SECONDS: int = 3600
+    LOG_RETENTION_LEASE_SECONDS: int = 600  # Per service, renewed before each batch
+    LOG_ARCHIVE_BACKEND: Literal["local", "s3"] = "local"
+    LOG_ARCHIVE_DIR: str = "log-archive"
+    LOG_ARCHIVE_S3_PREFIX: str = "archive/service_logs"
+    FCM_BATCH_SIZE: int = 500  # FCM's limit per send_each call
+    FCM_MAX_CONCURRENT_BATCHES: int = 4
+    FCM_ROUNDTRIP_TIMEOUT_SECONDS: int = 30
+    FCM_ROUNDTRIP_REQUIRED_OS: list[str] = ["Android", "iOS"]  # The check ends once all of them answered
     FRONTEND_HOST: str = "http://localhost:5173"
     ENVIRONMENT: Literal["testing", "local", "staging", "production"] = "testing"
 
@@ -32,8 +52,24 @@ class Settings(BaseSettings):
         return self.ENVIRONMENT.lower() == "local"
 
     OPENAI_API_KEY: str | None = None
+    AI_MAX_PROMPTS_PER_USER: int = 3  # Answered at once, over all of a user's sockets
+    AI_MAX_PROMPT_CHARS: int = 4000
+    AI_CACHE_MAX_SIZE: int = 512  # Complete answers kept for repeated prompts
+    AI_CACHE_TTL_SECONDS: int = 3600
+    AI_DAILY_TOKEN_QUOTA: int = 200000  # Billed tokens per user per UTC day, 0: unlimited
+    AI_USAGE_FLUSH_INTERVAL_SECONDS: float = 5.0
     CIPHER_KEY: str = Fernet.generate_key()
     S3_BUCKET_NAME: str | None = None
+    S3_MAX_POOL_CONNECTIONS: int = 32  # Also the number of threads running S3 calls
+    STORAGE_BACKEND: Literal["s3", "local"] = "s3"
+    STORAGE_LOCAL_DIR: str = "storage"  # Root of the local backend
+    UPLOAD_PART_SIZE_BYTES: int = 8 * 1024 * 1024  # S3 requires at least 5 MiB
+    UPLOAD_PART_CONCURRENCY: int = 4  # Memory per upload is bounded by part size * concurrency
+    UPLOAD_MAX_SIZE_BYTES: int = 5 * 1024 * 1024 * 1024
+    TEMP_USER_SWEEP_BATCH_SIZE: int = 500
+    TEMP_USER_SWEEP_INTERVAL_SECONDS: int = 600
+    TRANSFER_RECONCILE_INTERVAL_SECONDS: int = 3600  # Also runs once at startup
+    UPLOAD_PRESIGN_EXPIRY_SECONDS: int = 3600  # Lifetime of direct-to-S3 upload forms
     FILE_TRANSFER_URL: str | None = None
 
     
@@ -68,23 +104,24 @@ class Settings(BaseSettings):
             )
         return None
     
-    # REDIS_DB: str = "0"
-    # REDIS_PORT: int = 6379
-    
-    # @computed_field  # type: ignore[prop-decorator]
-    # @property
-    # def REDIS_DATABASE_URI(self) -> str | None:
-    #     if self.ENVIRONMENT != "testing":
-    #         url = MultiHostUrl.build(
-    #             scheme="redis",
-    #             username=self.MYSQL_USER,
-    #             password=self.MYSQL_PASSWORD,
-    #             host=self.MYSQL_SERVER,
-    #             port=self.REDIS_PORT,
-    #             path=self.REDIS_DB,
-    #         )
-    #         return str(url)
-    #     return None
+    REDIS_SERVER: str | None = None  # Unset: silent-push acks are tracked in process, single worker only
+    REDIS_PASSWORD: str | None = None
+    REDIS_DB: str = "0"
+    REDIS_PORT: int = 6379
+
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def REDIS_DATABASE_URI(self) -> str | None:
+        if self.ENVIRONMENT != "testing" and self.REDIS_SERVER:
+            url = MultiHostUrl.build(
+                scheme="redis",
+                password=self.REDIS_PASSWORD,
+                host=self.REDIS_SERVER,
+                port=self.REDIS_PORT,
+                path=self.REDIS_DB,
+            )
+            return str(url)
+        return None
 
     @property
     def TORTOISE_ORM(self) -> dict:
@@ -110,6 +147,13 @@ class Settings(BaseSettings):
     EMAIL_PASS_SET_UP_TOKEN_EXPIRE_HOURS: int = 24
     EMAIL_PASS_RESET_TOKEN_EXPIRE_MINUTES: int = 30
     SENDGRID_API_KEY: str | None = None
+    SENDGRID_API_URL: str = "https://api.sendgrid.com/v3/mail/send"  # Point at a stub to test
+    EMAIL_MAX_CONNECTIONS: int = 10
+    EMAIL_SEND_TIMEOUT_SECONDS: float = 10.0
+    EMAIL_OUTBOX_BATCH_SIZE: int = 50
+    EMAIL_OUTBOX_POLL_INTERVAL_SECONDS: float = 5.0
+    EMAIL_MAX_ATTEMPTS: int = 8
+    EMAIL_RETRY_BACKOFF_SECONDS: int = 30  # Doubled after every failed attempt
 
 
     @computed_field  # type: ignore[prop-decorator]
@@ -1,4 +1,4 @@
-import aioredis, firebase_admin
+import firebase_admin
 from fastapi import FastAPI
 from firebase_admin import credentials
 from contextlib import asynccontextmanager
@@ -8,7 +8,17 @@ from tortoise.exceptions import IntegrityError
 from tortoise.contrib.fastapi import RegisterTortoise
 
 from app import crud
+from app.ai_usage import usage_recorder
 from app.core.config import settings
+from app.core.mailer import mailer
+from app.core.security import hashing_pool
+from app.core.storage import storage
+from app.email_outbox import email_outbox_worker
+from app.log_ingestion import log_ingestor
+from app.push_monitor import round_trip_monitor
+from app.retention import retention_engine
+from app.temp_user_sweeper import temp_user_sweeper
+from app.transfer_objects import transfer_reconciler
 from app.models.db_models import User
 from app.models.user_models import UserCreate
 
@@ -48,7 +58,10 @@ async def lifespan_test(app: FastAPI) -> AsyncGenerator[None, None]:
         generate_schemas=True
     ):
         await ensure_superuser_exists()
+        log_ingestor.start()
         yield
+        await log_ingestor.stop()
+    hashing_pool.shutdown()
     await Tortoise._drop_databases()
 
 @asynccontextmanager
@@ -62,15 +75,27 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
         firebase_admin.initialize_app(cred)
         await Tortoise.init(config=settings.TORTOISE_ORM)
         await ensure_superuser_exists()
-        # app.state.redis = aioredis.from_url(
-        #     settings.REDIS_DATABASE_URI, 
-        #     encoding="utf-8", 
-        #     decode_responce=True)
+        log_ingestor.start()
+        retention_engine.start()
+        temp_user_sweeper.start()
+        transfer_reconciler.start()
+        usage_recorder.start()
+        if settings.emails_enabled:
+            email_outbox_worker.start()
         try:
             yield
         finally:
             # Close Redis
-            # if app.state.redis:
-            #     await app.state.redis.close()
+            await round_trip_monitor.store.close()
+            await retention_engine.stop()
+            await temp_user_sweeper.stop()
+            await transfer_reconciler.stop()
+            await usage_recorder.stop()
+            await email_outbox_worker.stop()
+            await mailer.close()
+            # Write out buffered logs before closing the connections
+            await log_ingestor.stop()
             # Close Tortoise connections
-            await Tortoise.close_connections()
\ No newline at end of file
+            await Tortoise.close_connections()
+            hashing_pool.shutdown()
+            storage.close()
\ No newline at end of file
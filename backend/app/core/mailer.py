@@ -0,0 +1,88 @@
+from typing import Any
+
+import httpx
+
+from app.core import metrics
+from app.core.config import settings
+
+
+class MailError(Exception):
+    def __init__(self, detail: str, *, retryable: bool) -> None:
+        super().__init__(detail)
+        self.retryable = retryable
+
+
+class Mailer:
+    """
+    Sends mail through SendGrid's v3 API on one pooled async HTTP client.
+    `api_url` and `transport` can point it at a local stub.
+    """
+
+    def __init__(
+        self,
+        *,
+        api_url: str,
+        api_key: str | None,
+        from_email: str | None,
+        max_connections: int,
+        timeout: float,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ) -> None:
+        self.api_url = api_url
+        self.api_key = api_key
+        self.from_email = from_email
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.transport = transport
+        self.latency = metrics.LatencyStats()
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Created on first use, inside the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                limits=httpx.Limits(max_connections=self.max_connections),
+                timeout=self.timeout,
+                transport=self.transport,
+            )
+        return self._client
+
+    async def send(self, *, email_to: str, subject: str, html_content: str) -> int:
+        """
+        Returns the HTTP status. Raises MailError, retryable for network errors, 429 and 5xx.
+        """
+        payload = {
+            "personalizations": [{"to": [{"email": email_to}]}],
+            "from": {"email": self.from_email},
+            "subject": subject,
+            "content": [{"type": "text/html", "value": html_content}],
+        }
+        with self.latency.time():
+            try:
+                response = await self.client.post(self.api_url, json=payload)
+            except httpx.TransportError as e:
+                raise MailError(f"{type(e).__name__}: {e}", retryable=True) from e
+            if response.status_code >= 400:
+                retryable = response.status_code == 429 or response.status_code >= 500
+                raise MailError(f"{response.status_code}: {response.text[:500]}", retryable=retryable)
+        return response.status_code
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict[str, Any]:
+        return self.latency.snapshot()
+
+
+mailer = Mailer(
+    api_url=settings.SENDGRID_API_URL,
+    api_key=settings.SENDGRID_API_KEY,
+    from_email=settings.EMAILS_FROM_EMAIL,
+    max_connections=settings.EMAIL_MAX_CONNECTIONS,
+    timeout=settings.EMAIL_SEND_TIMEOUT_SECONDS,
+)
+metrics.register("mailer", mailer.stats)
@@ -0,0 +1,53 @@
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+# name -> callable returning a JSON serialisable snapshot
+_providers: dict[str, Callable[[], dict[str, Any]]] = {}
+
+
+def register(name: str, provider: Callable[[], dict[str, Any]]) -> None:
+    """
+    Register a stats provider to be exposed through /utils/metrics.
+    """
+    _providers[name] = provider
+
+
+def snapshot() -> dict[str, dict[str, Any]]:
+    return {name: provider() for name, provider in _providers.items()}
+
+
+class LatencyStats:
+    """
+    Call count, error count and latency (ms) of one operation.
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, elapsed_ms: float) -> None:
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.errors += 1
+            raise
+        finally:
+            self.record((time.perf_counter() - started) * 1000)
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 2),
+        }
@@ -1,10 +1,14 @@
-import jwt, pyotp
-from typing import Any
+import asyncio, jwt, pyotp
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
 from datetime import datetime, timedelta, timezone
 from passlib.context import CryptContext
 
+from app.core import metrics
 from app.core.config import settings
 
+T = TypeVar("T")
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
@@ -35,6 +39,83 @@ def verify_secret(plain_secret: str, hashed_secret: str) -> bool:
 def get_secret_hash(secret: str) -> str:
     return pwd_context.hash(secret)
 
+
+class HashingPoolFull(Exception):
+    def __init__(self) -> None:
+        super().__init__("Server is busy, try again later")
+
+
+class HashingPool:
+    """
+    Runs bcrypt off the event loop on a bounded executor.
+    Calls beyond `max_in_flight` raise HashingPoolFull instead of queueing up.
+    """
+
+    def __init__(self, *, kind: str, workers: int, max_in_flight: int) -> None:
+        self.kind = kind
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._executor: Executor | None = None
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="hashing"
+                )
+        return self._executor
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        if self.in_flight >= self.max_in_flight:
+            self.rejected += 1
+            raise HashingPoolFull()
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._get_executor(), func, *args)
+        except BaseException:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        self.completed += 1
+        return result
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+
+hashing_pool = HashingPool(
+    kind=settings.HASH_POOL_KIND,
+    workers=settings.HASH_POOL_WORKERS,
+    max_in_flight=settings.HASH_MAX_IN_FLIGHT,
+)
+metrics.register("hashing_pool", hashing_pool.stats)
+
+async def verify_secret_async(plain_secret: str, hashed_secret: str) -> bool:
+    return await hashing_pool.run(verify_secret, plain_secret, hashed_secret)
+
+async def get_secret_hash_async(secret: str) -> str:
+    return await hashing_pool.run(get_secret_hash, secret)
+
 def create_totp(username: str) -> tuple[str, str]:
     """
     Generate a TOTP secret and its provisioning URI for QR code generation.
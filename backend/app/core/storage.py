@@ -0,0 +1,524 @@
+import abc, asyncio, functools, hashlib, logging, mimetypes, os, shutil, uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, TypeVar
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from fastapi import UploadFile
+
+from app.core import metrics
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+DELETE_BATCH_SIZE = 1000  # S3 DeleteObjects limit
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, max_size: int) -> None:
+        super().__init__(f"File exceeds the {max_size} bytes limit")
+        self.max_size = max_size
+
+
+def _handoff(func: Callable[..., T], *args: Any, **kwargs: Any) -> Callable[[], T]:
+    """
+    Bind a call for a worker thread and let go of it, and of its arguments, as it runs.
+    The executor keeps its work item until the thread picks the next one, which can be after the
+    event loop has moved on: an upload part would stay in memory next to the part read after it.
+    """
+    bound = [functools.partial(func, *args, **kwargs)]
+    return lambda: bound.pop()()
+
+
+@dataclass
+class StoredObject:
+    key: str
+    size: int
+    last_modified: datetime
+    content_type: str | None = None  # Only known from head_object
+
+
+class ObjectStorage(abc.ABC):
+    """
+    Async object storage. Every operation is timed per operation name for /utils/metrics.
+    """
+
+    def __init__(self) -> None:
+        self.latency: defaultdict[str, metrics.LatencyStats] = defaultdict(metrics.LatencyStats)
+
+    @abc.abstractmethod
+    async def _call(self, operation: str, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        ...
+
+    @abc.abstractmethod
+    async def put_object(
+        self, key: str, body: bytes, *, content_type: str | None = None, content_encoding: str | None = None
+    ) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def get_object(self, key: str) -> bytes:
+        ...
+
+    @abc.abstractmethod
+    async def head_object(self, key: str) -> StoredObject | None:
+        """
+        Metadata of the object, None if it does not exist.
+        """
+
+    @abc.abstractmethod
+    def iter_object(self, key: str, *, chunk_size: int = 1024 * 1024) -> AsyncIterator[bytes]:
+        """
+        The object's content in chunks, never holding more than one chunk in memory.
+        """
+
+    @abc.abstractmethod
+    async def delete_object(self, key: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def _delete_batch(self, keys: list[str]) -> list[str]:
+        ...
+
+    async def delete_objects(self, keys: list[str]) -> list[str]:
+        """
+        Delete keys DELETE_BATCH_SIZE at a time. Returns the keys that could not be deleted.
+        """
+        failed: list[str] = []
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            failed += await self._delete_batch(keys[start:start + DELETE_BATCH_SIZE])
+        return failed
+
+    @abc.abstractmethod
+    async def create_multipart_upload(self, key: str, *, content_type: str | None = None) -> str:
+        ...
+
+    @abc.abstractmethod
+    async def upload_part(self, key: str, upload_id: str, part_number: int, body: bytes) -> str:
+        """
+        Upload one part, returns its ETag.
+        """
+
+    @abc.abstractmethod
+    async def complete_multipart_upload(self, key: str, upload_id: str, parts: list[tuple[int, str]]) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def abort_multipart_upload(self, key: str, upload_id: str) -> None:
+        ...
+
+    async def upload_file(
+        self,
+        key: str,
+        file: UploadFile,
+        *,
+        content_type: str | None = None,
+        part_size: int,
+        concurrency: int,
+        max_size: int,
+    ) -> int:
+        """
+        Stream an upload to key in part_size parts, at most `concurrency` of them in flight,
+        so memory stays bounded by part_size * concurrency whatever the file size.
+        Files smaller than one part are sent with a single put_object.
+        The multipart upload is aborted on any failure. Returns the number of bytes stored.
+        """
+        chunk = await file.read(part_size)
+        if len(chunk) < part_size:
+            if len(chunk) > max_size:
+                raise UploadTooLarge(max_size)
+            await self.put_object(key, chunk, content_type=content_type)
+            return len(chunk)
+
+        upload_id = await self.create_multipart_upload(key, content_type=content_type)
+        slots = asyncio.Semaphore(concurrency)
+        etags: dict[int, str] = {}
+        tasks: set[asyncio.Task] = set()
+
+        async def _upload(part_number: int, body: bytes) -> None:
+            try:
+                etags[part_number] = await self.upload_part(key, upload_id, part_number, body)
+            finally:
+                slots.release()
+
+        size = 0
+        part_number = 0
+        try:
+            await slots.acquire()
+            while chunk:
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLarge(max_size)
+                part_number += 1
+                tasks.add(asyncio.create_task(_upload(part_number, chunk)))
+                chunk = b""
+                for task in [task for task in tasks if task.done()]:
+                    tasks.discard(task)
+                    task.result()  # Stop reading as soon as a part failed
+                # Only read the next part once it has a slot to be uploaded in
+                await slots.acquire()
+                chunk = await file.read(part_size)
+            slots.release()
+            await asyncio.gather(*tasks)
+            await self.complete_multipart_upload(key, upload_id, sorted(etags.items()))
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            try:
+                await self.abort_multipart_upload(key, upload_id)
+            except Exception:
+                logger.exception("Could not abort multipart upload of %s", key)
+            raise
+        return size
+
+    @abc.abstractmethod
+    async def list_objects(
+        self, prefix: str, *, continuation_token: str | None = None, max_keys: int = 1000
+    ) -> tuple[list[StoredObject], str | None]:
+        """
+        One page of the objects under prefix, in key order, and the token of the next page if any.
+        """
+
+    async def list_all(self, prefix: str) -> list[StoredObject]:
+        objects: list[StoredObject] = []
+        token = None
+        while True:
+            page, token = await self.list_objects(prefix, continuation_token=token)
+            objects += page
+            if token is None:
+                return objects
+
+    @abc.abstractmethod
+    async def presigned_url(self, key: str, *, expires_in: int, attachment: bool = True) -> str:
+        ...
+
+    @abc.abstractmethod
+    async def presigned_post(
+        self, key: str, *, expires_in: int, max_size: int, content_type: str | None = None
+    ) -> dict[str, Any]:
+        """
+        URL and form fields letting a client POST exactly this key, up to max_size bytes, straight to storage.
+        """
+
+    def close(self) -> None:
+        pass
+
+    def stats(self) -> dict[str, Any]:
+        return {operation: stats.snapshot() for operation, stats in sorted(self.latency.items())}
+
+
+class S3Storage(ObjectStorage):
+    """
+    boto3 calls run on a dedicated executor sized to the client's connection pool,
+    so S3 latency neither blocks the event loop nor competes with the default executor.
+    """
+
+    def __init__(self, *, bucket: str | None, max_pool_connections: int) -> None:
+        super().__init__()
+        self.bucket = bucket
+        self.max_pool_connections = max_pool_connections
+        self._client = None
+        self._executor = ThreadPoolExecutor(max_workers=max_pool_connections, thread_name_prefix="s3")
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = boto3.client(
+                "s3",
+                config=Config(max_pool_connections=self.max_pool_connections, retries={"mode": "standard"}),
+            )
+        return self._client
+
+    async def _call(self, operation: str, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        loop = asyncio.get_running_loop()
+        with self.latency[operation].time():
+            return await loop.run_in_executor(self._executor, _handoff(func, *args, **kwargs))
+
+    async def put_object(
+        self, key: str, body: bytes, *, content_type: str | None = None, content_encoding: str | None = None
+    ) -> None:
+        extra = {}
+        if content_type:
+            extra["ContentType"] = content_type
+        if content_encoding:
+            extra["ContentEncoding"] = content_encoding
+        await self._call("put_object", self.client.put_object, Bucket=self.bucket, Key=key, Body=body, **extra)
+
+    async def get_object(self, key: str) -> bytes:
+        def _get() -> bytes:
+            return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        return await self._call("get_object", _get)
+
+    async def head_object(self, key: str) -> StoredObject | None:
+        try:
+            response = await self._call("head_object", self.client.head_object, Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return StoredObject(
+            key=key,
+            size=response["ContentLength"],
+            last_modified=response["LastModified"],
+            content_type=response.get("ContentType"),
+        )
+
+    async def iter_object(self, key: str, *, chunk_size: int = 1024 * 1024) -> AsyncIterator[bytes]:
+        response = await self._call("get_object", self.client.get_object, Bucket=self.bucket, Key=key)
+        body = response["Body"]
+        loop = asyncio.get_running_loop()
+        try:
+            while chunk := await loop.run_in_executor(self._executor, body.read, chunk_size):
+                yield chunk
+        finally:
+            body.close()
+
+    async def delete_object(self, key: str) -> None:
+        await self._call("delete_object", self.client.delete_object, Bucket=self.bucket, Key=key)
+
+    async def _delete_batch(self, keys: list[str]) -> list[str]:
+        response = await self._call(
+            "delete_objects",
+            self.client.delete_objects,
+            Bucket=self.bucket,
+            Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+        )
+        # Quiet mode only reports failures
+        return [error["Key"] for error in response.get("Errors", [])]
+
+    async def create_multipart_upload(self, key: str, *, content_type: str | None = None) -> str:
+        extra = {"ContentType": content_type} if content_type else {}
+        response = await self._call(
+            "create_multipart_upload", self.client.create_multipart_upload, Bucket=self.bucket, Key=key, **extra
+        )
+        return response["UploadId"]
+
+    async def upload_part(self, key: str, upload_id: str, part_number: int, body: bytes) -> str:
+        response = await self._call(
+            "upload_part",
+            self.client.upload_part,
+            Bucket=self.bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        return response["ETag"]
+
+    async def complete_multipart_upload(self, key: str, upload_id: str, parts: list[tuple[int, str]]) -> None:
+        await self._call(
+            "complete_multipart_upload",
+            self.client.complete_multipart_upload,
+            Bucket=self.bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": [{"PartNumber": number, "ETag": etag} for number, etag in parts]},
+        )
+
+    async def abort_multipart_upload(self, key: str, upload_id: str) -> None:
+        await self._call(
+            "abort_multipart_upload", self.client.abort_multipart_upload, Bucket=self.bucket, Key=key, UploadId=upload_id
+        )
+
+    async def list_objects(
+        self, prefix: str, *, continuation_token: str | None = None, max_keys: int = 1000
+    ) -> tuple[list[StoredObject], str | None]:
+        params = {"Bucket": self.bucket, "Prefix": prefix, "MaxKeys": max_keys}
+        if continuation_token:
+            params["ContinuationToken"] = continuation_token
+        response = await self._call("list_objects", self.client.list_objects_v2, **params)
+        objects = [
+            StoredObject(key=obj["Key"], size=obj["Size"], last_modified=obj["LastModified"])
+            for obj in response.get("Contents", [])
+        ]
+        return objects, response.get("NextContinuationToken")
+
+    async def presigned_url(self, key: str, *, expires_in: int, attachment: bool = True) -> str:
+        # Signing is local, but resolving credentials the first time may hit the network
+        params = {"Bucket": self.bucket, "Key": key}
+        if attachment:
+            params["ResponseContentDisposition"] = "attachment"
+        return await self._call(
+            "presigned_url", self.client.generate_presigned_url, "get_object", Params=params, ExpiresIn=expires_in
+        )
+
+    async def presigned_post(
+        self, key: str, *, expires_in: int, max_size: int, content_type: str | None = None
+    ) -> dict[str, Any]:
+        fields: dict[str, str] = {}
+        conditions: list[Any] = [["content-length-range", 0, max_size]]
+        if content_type:
+            fields["Content-Type"] = content_type
+            conditions.append({"Content-Type": content_type})
+        return await self._call(
+            "presigned_post",
+            self.client.generate_presigned_post,
+            Bucket=self.bucket,
+            Key=key,
+            Fields=fields,
+            Conditions=conditions,
+            ExpiresIn=expires_in,
+        )
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+
+
+# Parts of unfinished multipart uploads of the local backend, hidden from listings
+MULTIPART_DIR = ".multipart"
+
+
+class LocalStorage(ObjectStorage):
+    """
+    Filesystem backed storage for local development and tests, keys map to paths under root.
+    """
+
+    def __init__(self, root: str | os.PathLike) -> None:
+        super().__init__()
+        self.root = Path(root)
+
+    async def _call(self, operation: str, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        with self.latency[operation].time():
+            return await asyncio.to_thread(_handoff(func, *args, **kwargs))
+
+    def _path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if not path.is_relative_to(self.root.resolve()):
+            raise ValueError(f"Invalid key: {key}")
+        return path
+
+    async def put_object(
+        self, key: str, body: bytes, *, content_type: str | None = None, content_encoding: str | None = None
+    ) -> None:
+        def _put() -> None:
+            path = self._path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(body)
+        await self._call("put_object", _put)
+
+    async def get_object(self, key: str) -> bytes:
+        return await self._call("get_object", lambda: self._path(key).read_bytes())
+
+    async def head_object(self, key: str) -> StoredObject | None:
+        def _head() -> StoredObject | None:
+            path = self._path(key)
+            if not path.is_file():
+                return None
+            stat = path.stat()
+            return StoredObject(
+                key=key,
+                size=stat.st_size,
+                last_modified=datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+                content_type=mimetypes.guess_type(key)[0],
+            )
+        return await self._call("head_object", _head)
+
+    async def iter_object(self, key: str, *, chunk_size: int = 1024 * 1024) -> AsyncIterator[bytes]:
+        file = await self._call("get_object", lambda: self._path(key).open("rb"))
+        try:
+            while chunk := await asyncio.to_thread(file.read, chunk_size):
+                yield chunk
+        finally:
+            file.close()
+
+    async def delete_object(self, key: str) -> None:
+        # Like S3, deleting a missing key is not an error
+        await self._call("delete_object", lambda: self._path(key).unlink(missing_ok=True))
+
+    async def _delete_batch(self, keys: list[str]) -> list[str]:
+        def _delete() -> list[str]:
+            failed = []
+            for key in keys:
+                try:
+                    self._path(key).unlink(missing_ok=True)
+                except (OSError, ValueError):
+                    failed.append(key)
+            return failed
+        return await self._call("delete_objects", _delete)
+
+    def _parts_dir(self, upload_id: str) -> Path:
+        return self.root / MULTIPART_DIR / uuid.UUID(upload_id).hex
+
+    async def create_multipart_upload(self, key: str, *, content_type: str | None = None) -> str:
+        upload_id = uuid.uuid4().hex
+        await self._call(
+            "create_multipart_upload", lambda: self._parts_dir(upload_id).mkdir(parents=True, exist_ok=True)
+        )
+        return upload_id
+
+    async def upload_part(self, key: str, upload_id: str, part_number: int, body: bytes) -> str:
+        def _upload() -> str:
+            (self._parts_dir(upload_id) / f"{part_number:05d}").write_bytes(body)
+            return hashlib.md5(body).hexdigest()
+        return await self._call("upload_part", _upload)
+
+    async def complete_multipart_upload(self, key: str, upload_id: str, parts: list[tuple[int, str]]) -> None:
+        def _complete() -> None:
+            parts_dir = self._parts_dir(upload_id)
+            path = self._path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with path.open("wb") as target:
+                for part_number, _ in parts:
+                    with (parts_dir / f"{part_number:05d}").open("rb") as part:
+                        shutil.copyfileobj(part, target)
+            shutil.rmtree(parts_dir)
+        await self._call("complete_multipart_upload", _complete)
+
+    async def abort_multipart_upload(self, key: str, upload_id: str) -> None:
+        await self._call(
+            "abort_multipart_upload", lambda: shutil.rmtree(self._parts_dir(upload_id), ignore_errors=True)
+        )
+
+    async def list_objects(
+        self, prefix: str, *, continuation_token: str | None = None, max_keys: int = 1000
+    ) -> tuple[list[StoredObject], str | None]:
+        def _list() -> tuple[list[StoredObject], str | None]:
+            # Walk only the deepest directory the prefix pins down
+            base = self.root / prefix.rpartition("/")[0]
+            if not base.is_dir():
+                return [], None
+            keys = sorted(
+                key for key in (path.relative_to(self.root).as_posix() for path in base.rglob("*") if path.is_file())
+                if key.startswith(prefix) and not key.startswith(f"{MULTIPART_DIR}/")
+                and (continuation_token is None or key > continuation_token)
+            )
+            objects = []
+            for key in keys[:max_keys]:
+                stat = (self.root / key).stat()
+                objects.append(
+                    StoredObject(
+                        key=key,
+                        size=stat.st_size,
+                        last_modified=datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+                    )
+                )
+            return objects, (keys[max_keys - 1] if len(keys) > max_keys else None)
+        return await self._call("list_objects", _list)
+
+    async def presigned_url(self, key: str, *, expires_in: int, attachment: bool = True) -> str:
+        return self._path(key).as_uri()
+
+    async def presigned_post(
+        self, key: str, *, expires_in: int, max_size: int, content_type: str | None = None
+    ) -> dict[str, Any]:
+        # Nothing listens for the POST locally, callers write the file with put_object themselves
+        fields = {"key": key, **({"Content-Type": content_type} if content_type else {})}
+        return {"url": self.root.resolve().as_uri(), "fields": fields}
+
+
+def create_storage() -> ObjectStorage:
+    if settings.STORAGE_BACKEND == "local":
+        return LocalStorage(settings.STORAGE_LOCAL_DIR)
+    return S3Storage(bucket=settings.S3_BUCKET_NAME, max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS)
+
+
+storage = create_storage()
+metrics.register("storage", storage.stats)
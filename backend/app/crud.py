@@ -1,19 +1,27 @@
-from typing import Any, Optional, List
+from typing import Any, Callable, Literal, Optional, List, TypeVar
 from datetime import datetime
+from uuid import UUID
 from fastapi import HTTPException
 from pydantic import BaseModel
+from tortoise.exceptions import IntegrityError
+from tortoise.expressions import Q, Subquery
 from tortoise.models import Model
 from tortoise.queryset import QuerySet
+from tortoise.transactions import in_transaction
 
-from app.core.security import get_secret_hash
+from app.core.security import get_secret_hash_async
+from app.log_ingestion import LogEntry, log_ingestor
+from app.utils import encode_log_cursor, decode_log_cursor
 from app.models.db_models import User, Service, AlertConfig, PublishConfig, Log
 from app.models.user_models import UserCreate, UserUpdate
 from app.models.service_models import AlertConfigCreate, PublishConfigCreate
 
+M = TypeVar("M", bound=Model)
+
 
 async def create_user(*, user_create: UserCreate) -> User:
     user_data = user_create.model_dump()
-    user_data['hashed_password'] = get_secret_hash(user_create.password)
+    user_data['hashed_password'] = await get_secret_hash_async(user_create.password)
     user = await User.create(**user_data)
     return user
 
@@ -23,6 +31,26 @@ async def update_instance(*, instance: Model, data_in: BaseModel) -> Model:
     await instance.save()
     return instance
 
+async def upsert_locked(model: type[M], keys: dict[str, Any], apply: Callable[[M], None]) -> M:
+    """
+    Read the row matching `keys` with SELECT ... FOR UPDATE, or start a new one from `keys`,
+    let `apply` change it and save it. The row lock makes concurrent writers from other workers
+    apply in turn, and a writer that loses the race to create the row retries as an update.
+    """
+    for attempt in range(2):
+        try:
+            async with in_transaction():
+                instance = await model.select_for_update().get_or_none(**keys)
+                if instance is None:
+                    instance = model(**keys)
+                apply(instance)
+                await instance.save()
+                return instance
+        except IntegrityError:
+            if attempt:
+                raise
+    raise AssertionError("unreachable")
+
 async def get_or_404(
     model: Model,
     prefetch_related: list[str] | None = None,
@@ -63,6 +91,111 @@ async def get_or_404(
     return obj
 
 
+async def get_service_or_404(
+    *,
+    user: User,
+    service_id: UUID,
+    privilege: Literal["read", "write"] = "read",
+    select_related: list[str] | None = None,
+) -> Service:
+    """
+    Fetch a service and check the user's privilege on it in a single statement.
+    For non-superusers the M2M association is resolved through a scalar subquery,
+    so a missing service (404) can still be told apart from a forbidden one (403).
+
+    Args:
+        user: The current user.
+        service_id: The ID of the service to fetch.
+        privilege: "read" requires the user to be associated with the service,
+            "write" additionally requires `can_edit`.
+        select_related: Optional list of related fields to select in the same query.
+
+    Returns:
+        Service instance if found and accessible.
+
+    Raises:
+        HTTPException: 404 if the service does not exist, 403 if the user lacks the privilege.
+    """
+    query: QuerySet = Service.filter(id=service_id)
+    if not user.is_superuser:
+        query = query.annotate(
+            associated_user_id=Subquery(
+                User.filter(id=user.id, services__id=service_id).limit(1).values("id")
+            )
+        )
+    if select_related:
+        query = query.select_related(*select_related)
+
+    service = await query.first()
+    if service is None:
+        raise HTTPException(status_code=404, detail="Service not found")
+
+    if not user.is_superuser:
+        is_associated = service.associated_user_id is not None
+        if not is_associated or (privilege == "write" and not user.can_edit):
+            raise HTTPException(status_code=403, detail="Not enough privileges")
+
+    return service
+
+
+async def get_logs_page(
+    *,
+    service_id: UUID,
+    limit: int,
+    cursor: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    order: Literal["asc", "desc"] = "desc",
+    skip: int | None = None,
+) -> tuple[list[Log], str | None]:
+    """
+    Page through a service's logs ordered by (start_time, id).
+
+    Keyset mode walks the (service_id, start_time, id) index from the cursor, so every
+    page costs the same regardless of depth. Passing `skip` falls back to the legacy
+    offset mode, which returns no cursor. Logs without a start_time are not reachable
+    in keyset mode.
+
+    Returns:
+        The page of logs and the cursor for the next page, or None on the last page.
+
+    Raises:
+        HTTPException: 400 if the cursor cannot be decoded.
+    """
+    query: QuerySet = Log.filter(service_id=service_id)
+    if since is not None:
+        query = query.filter(start_time__gte=since)
+    if until is not None:
+        query = query.filter(start_time__lt=until)
+    ordering = ("-start_time", "-id") if order == "desc" else ("start_time", "id")
+    query = query.order_by(*ordering)
+
+    if skip is not None:
+        return await query.offset(skip).limit(limit), None
+
+    query = query.filter(start_time__isnull=False)
+    if cursor is not None:
+        try:
+            last_start_time, last_id = decode_log_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if order == "desc":
+            query = query.filter(
+                Q(start_time__lt=last_start_time) | Q(start_time=last_start_time, id__lt=last_id)
+            )
+        else:
+            query = query.filter(
+                Q(start_time__gt=last_start_time) | Q(start_time=last_start_time, id__gt=last_id)
+            )
+
+    # Fetch one extra row to know whether there is a next page
+    logs = await query.limit(limit + 1)
+    if len(logs) <= limit:
+        return logs, None
+    logs = logs[:limit]
+    return logs, encode_log_cursor(logs[-1].start_time, logs[-1].id)
+
+
 async def create_or_update_config(service: Service, config_data: AlertConfigCreate | PublishConfigCreate):
     """
     Create or update the configuration for a given service.
@@ -86,22 +219,23 @@ async def create_or_update_config(service: Service, config_data: AlertConfigCrea
     
     return instance
 
-async def add_log_entry(service_name: str, service_sub_name: str, log_data: dict):
-    # Fetch the Service object by name and sub_name
-    service = await Service.filter(name=service_name, sub_name=service_sub_name).first()
-
-    if not service:
+async def add_log_entry(service_name: str, service_sub_name: str, log_data: dict) -> None:
+    """
+    Queue a log entry for the service identified by name and sub_name.
+    The row is written asynchronously by the log ingestor in the next batch.
+    """
+    key = (service_name, service_sub_name)
+    service_ids = await log_ingestor.resolve_service_ids({key})
+    if key not in service_ids:
         raise ValueError(f"Service with name '{service_name}' and sub_name '{service_sub_name}' not found.")
 
-    # Create a Log entry associated with the fetched Service
-    log_entry = await Log.create(
-        service=service,
-        start_time=log_data.get("start_time"),
-        end_time=log_data.get("end_time"),
-        elapsed_time=log_data.get("elapsed_time"),
-        is_ok=log_data.get("is_ok", True),
-        screenshot=log_data.get("screenshot"),
-        content=log_data.get("content"),
-    )
-
-    return log_entry
+    await log_ingestor.enqueue([
+        LogEntry(
+            service_id=service_ids[key],
+            start_time=log_data.get("start_time"),
+            end_time=log_data.get("end_time"),
+            is_ok=log_data.get("is_ok", True),
+            screenshot=log_data.get("screenshot"),
+            content=log_data.get("content"),
+        )
+    ])
@@ -0,0 +1,178 @@
+import asyncio, logging, math
+from datetime import timedelta
+from typing import Any
+
+from tortoise import timezone as tz
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from app.core import metrics
+from app.core.config import settings
+from app.core.mailer import MailError, Mailer, mailer
+from app.models.db_models import EmailOutbox
+
+logger = logging.getLogger(__name__)
+
+MAX_BACKOFF_SECONDS = 6 * 3600
+
+
+class EmailNotConfigured(Exception):
+    def __init__(self) -> None:
+        super().__init__("Email is not configured")
+
+
+async def enqueue_email(
+    *, email_to: str, subject: str, html_content: str, using_db: BaseDBAsyncClient | None = None
+) -> EmailOutbox:
+    """
+    Queue an email for the outbox worker. Pass the transaction so the email only exists if it commits.
+    Raises EmailNotConfigured without SendGrid settings: the worker only runs with them, the row would never be sent.
+    """
+    if not settings.emails_enabled:
+        raise EmailNotConfigured()
+    return await EmailOutbox.create(
+        email_to=email_to,
+        subject=subject,
+        html_content=html_content,
+        next_attempt_at=tz.now(),
+        using_db=using_db,
+    )
+
+
+class EmailOutboxWorker:
+    """
+    Sends queued emails in batches. A row is claimed by pushing its next_attempt_at forward (a lease),
+    so another worker (or this one after a crash) only picks it up once the lease runs out.
+    At most one send per pooled connection runs at a time, each cut off after half a lease, and a
+    batch is leased for as many rounds as it needs: a claimed row is always settled before its lease ends.
+    Network errors, timeouts, 429 and 5xx are retried with exponential backoff, up to `max_attempts`.
+    """
+
+    def __init__(
+        self, *, mailer: Mailer, batch_size: int, poll_interval: float, max_attempts: int, backoff: float
+    ) -> None:
+        self.mailer = mailer
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = timedelta(seconds=mailer.timeout * 3)
+        self.send_deadline = self.lease.total_seconds() / 2  # httpx applies its timeout per phase, not per send
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def wake(self) -> None:
+        # Send right away instead of at the next poll
+        self._wake.set()
+
+    def retry_delay(self, attempts: int) -> timedelta:
+        return timedelta(seconds=min(self.backoff * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS))
+
+    async def _claim(self) -> list[EmailOutbox]:
+        now = tz.now()
+        due = await EmailOutbox.filter(status="pending", next_attempt_at__lte=now).order_by("next_attempt_at").limit(self.batch_size)
+        rounds = math.ceil(len(due) / self.mailer.max_connections)
+        lease_until = now + self.lease * rounds
+        claimed = []
+        for email in due:
+            if await EmailOutbox.filter(id=email.id, status="pending", next_attempt_at__lte=now).update(next_attempt_at=lease_until):
+                email.next_attempt_at = lease_until
+                claimed.append(email)
+        return claimed
+
+    async def _send(self, email: EmailOutbox) -> None:
+        try:
+            await asyncio.wait_for(
+                self.mailer.send(email_to=email.email_to, subject=email.subject, html_content=email.html_content),
+                timeout=self.send_deadline,
+            )
+        except asyncio.TimeoutError as e:
+            raise MailError(f"No response within {self.send_deadline:g}s", retryable=True) from e
+
+    def _attempt_failed(self, email: EmailOutbox, error: str, retryable: bool) -> None:
+        email.last_error = error
+        if retryable and email.attempts < self.max_attempts:
+            email.next_attempt_at = tz.now() + self.retry_delay(email.attempts)
+            self.retried += 1
+        else:
+            email.status = "failed"
+            self.failed += 1
+            logger.warning("Email %s to %s failed: %s", email.id, email.email_to, error)
+
+    async def _deliver(self, email: EmailOutbox, slots: asyncio.Semaphore) -> None:
+        email.attempts += 1
+        try:
+            async with slots:
+                await self._send(email)
+        except MailError as e:
+            self._attempt_failed(email, str(e), e.retryable)
+        except Exception as e:
+            # Not the mail service's answer (a bug, a bad row): retry rather than drop the email
+            logger.exception("Sending email %s failed", email.id)
+            self._attempt_failed(email, f"{type(e).__name__}: {e}", True)
+        else:
+            email.status = "sent"
+            email.sent_at = tz.now()
+            email.last_error = None
+            email.html_content = ""  # Holds live setup and reset links, not needed once sent
+            self.sent += 1
+        try:
+            await email.save(
+                update_fields=["status", "attempts", "next_attempt_at", "last_error", "sent_at", "html_content"]
+            )
+        except Exception:
+            logger.exception("Could not save the outcome of email %s, it is picked up again once its lease ends", email.id)
+
+    async def run_once(self) -> int:
+        """
+        Send every email that is due. Returns the number of attempts made.
+        """
+        attempted = 0
+        slots = asyncio.Semaphore(self.mailer.max_connections)
+        while True:
+            batch = await self._claim()
+            await asyncio.gather(*(self._deliver(email, slots) for email in batch))
+            attempted += len(batch)
+            if len(batch) < self.batch_size:
+                return attempted
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Email outbox run failed")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict[str, Any]:
+        return {"sent": self.sent, "retried": self.retried, "failed": self.failed}
+
+
+email_outbox_worker = EmailOutboxWorker(
+    mailer=mailer,
+    batch_size=settings.EMAIL_OUTBOX_BATCH_SIZE,
+    poll_interval=settings.EMAIL_OUTBOX_POLL_INTERVAL_SECONDS,
+    max_attempts=settings.EMAIL_MAX_ATTEMPTS,
+    backoff=settings.EMAIL_RETRY_BACKOFF_SECONDS,
+)
+metrics.register("email_outbox", email_outbox_worker.stats)
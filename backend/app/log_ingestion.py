@@ -0,0 +1,190 @@
+import asyncio, logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Awaitable, Callable
+from uuid import UUID
+
+from tortoise import timezone as tz
+from tortoise.expressions import Q
+
+from app.core import metrics
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.models.db_models import Log, Service, elapsed_seconds
+
+logger = logging.getLogger(__name__)
+
+
+def _as_db_datetime(value: datetime | None) -> datetime | None:
+    # Match what the DB hands back, so hooks can compare entries with stored rows
+    if value is None:
+        return None
+    if tz.get_use_tz():
+        return tz.make_aware(value) if tz.is_naive(value) else value
+    return tz.make_naive(value) if tz.is_aware(value) else value
+
+
+@dataclass
+class LogEntry:
+    service_id: UUID
+    start_time: datetime | None = None
+    end_time: datetime | None = None
+    is_ok: bool = True
+    screenshot: str | None = None
+    content: str | None = None
+
+    def __post_init__(self) -> None:
+        self.start_time = _as_db_datetime(self.start_time)
+        self.end_time = _as_db_datetime(self.end_time)
+
+    def to_model(self) -> Log:
+        # bulk_create bypasses Log.save(), so elapsed_time is set here
+        return Log(
+            service_id=self.service_id,
+            start_time=self.start_time,
+            end_time=self.end_time,
+            elapsed_time=elapsed_seconds(self.start_time, self.end_time),
+            is_ok=self.is_ok,
+            screenshot=self.screenshot,
+            content=self.content,
+        )
+
+
+class LogIngestor:
+    """
+    Buffers log entries in memory and writes them with Log.bulk_create once
+    `batch_size` entries are queued or every `flush_interval` seconds.
+    The buffer is drained on shutdown.
+    """
+
+    def __init__(self, *, batch_size: int, flush_interval: float, max_buffer: int) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        # (name, sub_name) -> service id
+        self.service_ids: TTLCache[tuple[str, str], UUID] = TTLCache(
+            maxsize=1024, ttl=settings.SERVICE_ID_CACHE_TTL_SECONDS
+        )
+        self.queued = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self._buffer: list[LogEntry] = []
+        self._hooks: list[Callable[[list[LogEntry]], Awaitable[None]]] = []
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task: asyncio.Task | None = None
+
+    def add_hook(self, hook: Callable[[list[LogEntry]], Awaitable[None]]) -> None:
+        """
+        Register a coroutine called with every batch of entries once they are written.
+        """
+        self._hooks.append(hook)
+
+    async def resolve_service_ids(self, keys: set[tuple[str, str]]) -> dict[tuple[str, str], UUID]:
+        """
+        Map (name, sub_name) pairs to service ids, querying only the pairs not cached.
+        Unknown pairs are left out of the result.
+        """
+        resolved: dict[tuple[str, str], UUID] = {}
+        missing: list[tuple[str, str]] = []
+        for key in keys:
+            service_id = self.service_ids.get(key)
+            if service_id is None:
+                missing.append(key)
+            else:
+                resolved[key] = service_id
+        if missing:
+            condition = Q(*[Q(name=name, sub_name=sub_name) for name, sub_name in missing], join_type="OR")
+            for service_id, name, sub_name in await Service.filter(condition).values_list("id", "name", "sub_name"):
+                self.service_ids.set((name, sub_name), service_id)
+                resolved[(name, sub_name)] = service_id
+        return resolved
+
+    async def enqueue(self, entries: list[LogEntry]) -> None:
+        self._buffer.extend(entries)
+        self.queued += len(entries)
+        if len(self._buffer) >= self.max_buffer or self._task is None:
+            # Backpressure, or no background flusher running (scripts, tests without lifespan)
+            await self.flush()
+        elif len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            while self._buffer:
+                batch = self._buffer[:self.batch_size]
+                del self._buffer[:self.batch_size]
+                await self._write_batch(batch)
+
+    async def _write_batch(self, batch: list[LogEntry]) -> None:
+        try:
+            await Log.bulk_create([entry.to_model() for entry in batch])
+            written = batch
+        except Exception:
+            # Isolate the offending rows (e.g. a service deleted meanwhile) instead of losing the batch
+            logger.exception("Bulk insert of %d log entries failed, retrying one by one", len(batch))
+            written = []
+            for entry in batch:
+                try:
+                    await entry.to_model().save()
+                    written.append(entry)
+                except Exception:
+                    self.failed += 1
+        self.written += len(written)
+        self.batches += 1
+
+        for hook in self._hooks:
+            try:
+                await hook(written)
+            except Exception:
+                logger.exception("Log ingestion hook %s failed", getattr(hook, "__qualname__", hook))
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Log flush failed")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._flush_lock = asyncio.Lock()
+            self._wakeup = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Let the running flush finish, then drain whatever is still buffered.
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "queued": self.queued,
+            "written": self.written,
+            "failed": self.failed,
+            "batches": self.batches,
+            "buffered": len(self._buffer),
+            "service_id_cache": self.service_ids.stats(),
+        }
+
+
+log_ingestor = LogIngestor(
+    batch_size=settings.LOG_INGEST_BATCH_SIZE,
+    flush_interval=settings.LOG_INGEST_FLUSH_INTERVAL_SECONDS,
+    max_buffer=settings.LOG_INGEST_MAX_BUFFER,
+)
+metrics.register("log_ingestion", log_ingestor.stats)
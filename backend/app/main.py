@@ -1,10 +1,12 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from fastapi.routing import APIRoute
 from starlette.middleware.cors import CORSMiddleware
 
 from app.core.db import lifespan
 from app.api.main import api_router
 from app.core.config import settings
+from app.core.security import HashingPoolFull
 
 def custom_generate_unique_id(route: APIRoute) -> str:
     return f"{route.tags[0]} - {route.name}"
@@ -26,6 +28,12 @@ if settings.all_cors_origins:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Continuation-Token", "Location", "Upload-Offset", "Upload-Length", "Tus-Resumable"],
     )
 
+@app.exception_handler(HashingPoolFull)
+async def hashing_pool_full_handler(request: Request, exc: HashingPoolFull) -> JSONResponse:
+    # Raised from any route that hashes or verifies a secret while the pool is saturated
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
 app.include_router(api_router, prefix=settings.API_V1_STR)
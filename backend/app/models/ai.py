@@ -0,0 +1,18 @@
+from datetime import date
+from uuid import UUID
+
+from pydantic import BaseModel
+
+
+class AiUsageOut(BaseModel):
+    user_id: UUID
+    username: str
+    requests: int
+    prompt_tokens: int
+    completion_tokens: int
+    cached_tokens: int  # Answered from the cache, not billed
+
+class AiUsageReport(BaseModel):
+    start: date
+    end: date
+    data: list[AiUsageOut]
@@ -1,6 +1,15 @@
+from datetime import datetime
+
 from tortoise import fields
 from tortoise.models import Model
 
+
+def elapsed_seconds(start_time: datetime | None, end_time: datetime | None) -> float | None:
+    # Elapsed time of a check, None if either time is missing
+    if start_time and end_time:
+        return (end_time - start_time).total_seconds()
+    return None
+
 class User(Model):
     id = fields.UUIDField(primary_key=True)
     username = fields.CharField(max_length=255, unique=True)
@@ -29,8 +38,11 @@ class Service(Model):
     sub_name = fields.CharField(max_length=255)  # required
     has_alert_notification = fields.BooleanField(default=False)
     has_auto_publish = fields.BooleanField(default=False)
+    log_retention_days = fields.IntField(null=True)  # At least 1, None: settings.LOG_RETENTION_DAYS
+    retention_lease_until = fields.DatetimeField(null=True)  # Held by the worker archiving its logs
     alert_config: fields.OneToOneRelation["AlertConfig"]
     publish_config: fields.OneToOneRelation["PublishConfig"]
+    status: fields.OneToOneRelation["ServiceStatus"]
     log: fields.ReverseRelation["Log"]
     class Meta:
         table = "services"  # Explicitly set the table name
@@ -88,25 +100,123 @@ class Log(Model):
 
     class Meta:
         table = "service_logs"
+        indexes = (("service_id", "start_time", "id"),)  # Keyset pagination
 
     async def save(self, *args, **kwargs):
-        if self.start_time and self.end_time:
-            self.elapsed_time = (self.end_time - self.start_time).total_seconds()
-        else:
-            self.elapsed_time = None  # Reset elapsed_time if times are missing
+        self.elapsed_time = elapsed_seconds(self.start_time, self.end_time)
         await super().save(*args, **kwargs)
 
+class LogRollup(Model):
+    id = fields.IntField(primary_key=True)
+
+    service = fields.ForeignKeyField(
+        "models.Service", related_name="rollups", on_delete=fields.CASCADE
+    )
+    period = fields.CharField(max_length=4, constraints={"enum": ["hour", "day"]})
+    bucket_start = fields.DatetimeField()  # Start of the hour or day (UTC)
+    count = fields.IntField(default=0)
+    failures = fields.IntField(default=0)  # Checks with is_ok False
+    timed_count = fields.IntField(default=0)  # Checks with an elapsed_time
+    elapsed_sum = fields.FloatField(default=0)
+    elapsed_min = fields.FloatField(null=True)
+    elapsed_max = fields.FloatField(null=True)
+    histogram = fields.JSONField(default=list)  # Counts per app.rollups.LATENCY_BUCKETS bucket
+
+    class Meta:
+        table = "service_log_rollups"
+        unique_together = (("service", "period", "bucket_start"),)
+
+class ServiceStatus(Model):
+    id = fields.IntField(primary_key=True)
+
+    service = fields.OneToOneField(
+        "models.Service", related_name="status", on_delete=fields.CASCADE
+    )
+    last_check_time = fields.DatetimeField(null=True)  # start_time of the latest check
+    last_is_ok = fields.BooleanField(null=True)
+    last_elapsed_time = fields.FloatField(null=True)
+    consecutive_failures = fields.IntField(default=0)
+    updated_at = fields.DatetimeField(auto_now=True)
+
+    class Meta:
+        table = "service_status"
+
 class TempUser(Model):
     id = fields.UUIDField(primary_key=True)  # Primary key, auto-incremented
-    name = fields.CharField(max_length=255)  # required
-    pwd = fields.CharField(max_length=255)  # required
+    name = fields.CharField(max_length=255, unique=True)  # required
+    pwd = fields.CharField(max_length=255)  # bcrypt hash
     company_name = fields.CharField(max_length=255)
     type = fields.CharField(max_length=10, constraints={"enum": ["download", "upload"]}) 
     file_name = fields.CharField(max_length=255, null=True)
+    expires_at = fields.DatetimeField(db_index=True)  # Same expiry as the URL, swept afterwards
 
     class Meta:
         table = "temporary_users"
 
+class UploadSession(Model):
+    id = fields.UUIDField(primary_key=True)
+    temp_user = fields.ForeignKeyField(
+        "models.TempUser", related_name="upload_sessions", on_delete=fields.CASCADE
+    )
+    key = fields.CharField(max_length=512)
+    upload_id = fields.CharField(max_length=255)  # S3 multipart upload id
+    content_type = fields.CharField(max_length=255, null=True)
+    size = fields.BigIntField()  # Upload-Length
+    part_size = fields.IntField()
+    offset = fields.BigIntField(default=0)  # Bytes stored in completed parts, always part aligned
+    parts = fields.JSONField(default=list)  # [[part_number, etag], ...] of completed parts
+    created_at = fields.DatetimeField(auto_now_add=True)
+    updated_at = fields.DatetimeField(auto_now=True)
+
+    class Meta:
+        table = "upload_sessions"
+
+class TransferObject(Model):
+    id = fields.IntField(primary_key=True)
+    key = fields.CharField(max_length=512, unique=True)  # transfer/{folder}/{company}/{file_name}
+    folder = fields.CharField(max_length=32)  # to_customer or from_customer
+    company = fields.CharField(max_length=255)
+    file_name = fields.CharField(max_length=255, db_index=True)
+    size = fields.BigIntField()
+    content_type = fields.CharField(max_length=255, null=True)
+    uploader = fields.CharField(max_length=255, null=True)  # Operator username or temp user name
+    last_modified = fields.DatetimeField()  # As reported by S3
+    created_at = fields.DatetimeField(auto_now_add=True)
+    updated_at = fields.DatetimeField(auto_now=True)
+
+    class Meta:
+        table = "transfer_objects"
+        indexes = (("folder", "key"), ("company", "file_name"))
+
+class AiUsage(Model):
+    id = fields.IntField(primary_key=True)
+    user = fields.ForeignKeyField("models.User", related_name="ai_usage", on_delete=fields.CASCADE)
+    day = fields.DateField(db_index=True)  # UTC
+    requests = fields.IntField(default=0)
+    prompt_tokens = fields.IntField(default=0)
+    completion_tokens = fields.IntField(default=0)
+    cached_tokens = fields.IntField(default=0)  # Answered from the cache, not billed
+
+    class Meta:
+        table = "ai_usage"
+        unique_together = (("user", "day"),)
+
+class EmailOutbox(Model):
+    id = fields.IntField(primary_key=True)
+    email_to = fields.CharField(max_length=255)
+    subject = fields.CharField(max_length=255)
+    html_content = fields.TextField()
+    status = fields.CharField(max_length=7, default="pending", constraints={"enum": ["pending", "sent", "failed"]})
+    attempts = fields.IntField(default=0)
+    next_attempt_at = fields.DatetimeField()  # Also pushed forward while a worker holds the row
+    last_error = fields.TextField(null=True)
+    created_at = fields.DatetimeField(auto_now_add=True)
+    sent_at = fields.DatetimeField(null=True)
+
+    class Meta:
+        table = "email_outbox"
+        indexes = (("status", "next_attempt_at"),)
+
 class FcmToken(Model):
     id = fields.UUIDField(primary_key=True)
     token = fields.CharField(max_length=255, unique=True) 
@@ -2,7 +2,7 @@ import os
 from uuid import UUID
 from datetime import datetime
 from typing import Literal
-from pydantic import BaseModel, ConfigDict, field_validator
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 
 class Token(BaseModel):
     access_token: str
@@ -24,6 +24,39 @@ class S3Object(BaseModel):
     LastModified: datetime
     Size: int
 
+class PresignUpload(BaseModel):
+    file_name: str = Field(min_length=1, max_length=255)
+    content_type: str | None = None
+
+class PresignedUpload(BaseModel):
+    url: str
+    fields: dict[str, str]
+    key: str
+    expires_in: int
+
+class CompleteUpload(BaseModel):
+    key: str
+
+class CreateUploadSession(BaseModel):
+    file_name: str = Field(min_length=1, max_length=255)
+    size: int = Field(ge=1)
+    content_type: str | None = None
+
+class UploadSessionPublic(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: UUID
+    size: int
+    offset: int
+    part_size: int  # Send PATCH bodies in multiples of this, partial parts are not kept
+
+class BulkDelete(BaseModel):
+    file_names: list[str] = Field(min_length=1, max_length=10000)
+
+class BulkDeleteResult(BaseModel):
+    deleted: int
+    failed: list[str]
+
 class Validated(BaseModel):
     validation: Literal["download", "upload"]
 
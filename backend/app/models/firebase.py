@@ -1,3 +1,4 @@
+from datetime import datetime
 from pydantic import BaseModel, ConfigDict, Field
 
 
@@ -23,3 +24,31 @@ class MessageFromClient(BaseModel):
     os: str
     notification_id: str  # Add notification ID field for comparison
     is_silent: bool
+
+class DeliveryResultOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    token: str
+    success: bool
+    message_id: str | None = None
+    error_code: str | None = None
+    error: str | None = None
+
+class NotificationReport(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    notification_id: str
+    sent: int
+    failed: int
+    pruned: int
+    results: list[DeliveryResultOut]
+
+class RoundTripReportOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    notification_id: str
+    start_time: datetime
+    end_time: datetime
+    timed_out: bool
+    latency_ms: dict[str, float]  # OS -> round trip of its first ack
+    missing: list[str]
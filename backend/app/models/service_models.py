@@ -7,10 +7,12 @@ class ServiceBase(BaseModel):
     sub_name: str = Field(..., max_length=255)  # Unique and required
     has_alert_notification: bool = False
     has_auto_publish: bool = False
+    log_retention_days: int | None = Field(None, ge=1)  # Defaults to the server-wide retention
 
 class ServiceUpdate(BaseModel):
     has_alert_notification: bool = False
     has_auto_publish: bool = False
+    log_retention_days: int | None = Field(None, ge=1)
 
 class ServiceCreate(ServiceBase):
     pass
@@ -26,6 +28,23 @@ class ServicesPublic(BaseModel):
     data: list[ServicePublic]
     count: int
 
+class ServiceStatusPublic(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    last_check_time: datetime | None = None
+    last_is_ok: bool | None = None
+    last_elapsed_time: float | None = None
+    consecutive_failures: int = 0
+
+class ServiceOverview(ServicePublic):
+    status: ServiceStatusPublic | None = None
+
+class ServicesOverview(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    data: list[ServiceOverview]
+    count: int
+
 class AlertConfigBase(BaseModel):
     has_extra_email: bool | None = False
     has_teams_slack: bool | None = False
@@ -84,6 +103,18 @@ class ServiceConfig(ServicePublic):
     alert_config: AlertConfigPublic | None 
     publish_config: PublishConfigPublic | None
 
+class LogCreate(BaseModel):
+    service_name: str = Field(..., max_length=255)
+    service_sub_name: str = Field(..., max_length=255)
+    start_time: datetime | None = None
+    end_time: datetime | None = None
+    is_ok: bool = True
+    screenshot: str | None = Field(None, max_length=255)
+    content: str | None = None
+
+class LogsBulkCreate(BaseModel):
+    logs: list[LogCreate] = Field(..., min_length=1, max_length=1000)
+
 class LogPublic(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
@@ -97,4 +128,19 @@ class LogPublic(BaseModel):
 
 class ServiceLogs(ServicePublic):
 
-    logs: list[LogPublic] | None
\ No newline at end of file
+    logs: list[LogPublic] | None
+    next_cursor: str | None = None  # Pass back as `cursor` to fetch the next page
+
+class ServiceStats(BaseModel):
+    window: str
+    source: str  # "logs", "hourly" or "daily"
+    count: int
+    failures: int
+    uptime: float | None = None  # Ratio of successful checks
+    elapsed_min: float | None = None
+    elapsed_max: float | None = None
+    elapsed_mean: float | None = None
+    # Estimated from the latency histogram
+    elapsed_p50: float | None = None
+    elapsed_p95: float | None = None
+    elapsed_p99: float | None = None
@@ -0,0 +1,169 @@
+import asyncio, logging
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+
+from firebase_admin import messaging
+
+from app.core import metrics
+from app.core.config import settings
+from app.models.db_models import FcmToken
+
+logger = logging.getLogger(__name__)
+
+FCM_BATCH_LIMIT = 500  # Most messages FCM accepts in one send_each call
+
+SendBatch = Callable[[list[messaging.Message]], Awaitable[messaging.BatchResponse]]
+
+
+def create_message(id: str, registration_token: str, is_silent: bool) -> messaging.Message:
+    common_data = {
+        "notification_id": id,
+        "body": "無音通知" if is_silent else "音付き通知",
+    }
+    if is_silent:
+        return messaging.Message(
+            data=common_data,
+            token=registration_token,
+            android=messaging.AndroidConfig(priority="high", ttl=3600),
+            apns=messaging.APNSConfig(
+                payload=messaging.APNSPayload(
+                    aps=messaging.Aps(content_available=True)
+                )
+            ),
+        )
+    else:
+        return messaging.Message(
+            notification=messaging.Notification(
+                title="正常生確認", body="サーバから通知されました。"
+            ),
+            token=registration_token,
+            data=common_data,
+        )
+
+
+def error_code(exception: BaseException) -> str:
+    if isinstance(exception, messaging.UnregisteredError):
+        return "UNREGISTERED"
+    return getattr(exception, "code", None) or type(exception).__name__
+
+
+@dataclass
+class DeliveryResult:
+    token: str
+    success: bool
+    message_id: str | None = None
+    error_code: str | None = None
+    error: str | None = None
+
+
+@dataclass
+class DispatchReport:
+    notification_id: str
+    results: list[DeliveryResult] = field(default_factory=list)
+    pruned: int = 0
+
+    @property
+    def sent(self) -> int:
+        return sum(result.success for result in self.results)
+
+    @property
+    def failed(self) -> int:
+        return len(self.results) - self.sent
+
+    def dead_tokens(self) -> list[str]:
+        dead = [result.token for result in self.results if result.error_code == "UNREGISTERED"]
+        # INVALID_ARGUMENT also covers a malformed message, which fails every token alike.
+        # Only blame the tokens if the same message got through to someone else.
+        if self.sent:
+            dead += [result.token for result in self.results if result.error_code == "INVALID_ARGUMENT"]
+        return dead
+
+
+class NotificationDispatcher:
+    """
+    Sends one notification to many tokens with FCM's send_each, `batch_size` messages per call
+    and at most `max_concurrent_batches` calls in flight. The async client keeps the event loop free.
+    Tokens FCM reports as dead are deleted afterwards, so later sends only pay for live devices.
+    """
+
+    def __init__(
+        self, *, batch_size: int, max_concurrent_batches: int, send_batch: SendBatch | None = None
+    ) -> None:
+        self.batch_size = min(batch_size, FCM_BATCH_LIMIT)
+        self.max_concurrent_batches = max_concurrent_batches
+        self.send_batch: SendBatch = send_batch or messaging.send_each_async
+        self.sent = 0
+        self.failed = 0
+        self.pruned = 0
+        self.batch_latency = metrics.LatencyStats()
+
+    async def _send_chunk(
+        self, slots: asyncio.Semaphore, notification_id: str, tokens: list[str], is_silent: bool
+    ) -> list[DeliveryResult]:
+        async with slots:
+            # Built only once a slot is free, so queued batches hold tokens rather than messages
+            messages = [create_message(notification_id, token, is_silent) for token in tokens]
+            try:
+                with self.batch_latency.time():
+                    response = await self.send_batch(messages)
+            except Exception as e:
+                logger.exception("FCM batch of %d messages failed", len(messages))
+                return [
+                    DeliveryResult(token=token, success=False, error_code=error_code(e), error=str(e))
+                    for token in tokens
+                ]
+        # Responses come back in the order of the messages
+        return [
+            DeliveryResult(token=token, success=True, message_id=send_response.message_id)
+            if send_response.success
+            else DeliveryResult(
+                token=token,
+                success=False,
+                error_code=error_code(send_response.exception),
+                error=str(send_response.exception),
+            )
+            for token, send_response in zip(tokens, response.responses)
+        ]
+
+    async def prune(self, tokens: list[str]) -> int:
+        pruned = 0
+        for start in range(0, len(tokens), FCM_BATCH_LIMIT):
+            pruned += await FcmToken.filter(token__in=tokens[start:start + FCM_BATCH_LIMIT]).delete()
+        if pruned:
+            logger.info("Pruned %d dead FCM tokens", pruned)
+        self.pruned += pruned
+        return pruned
+
+    async def dispatch(
+        self, *, notification_id: str, tokens: list[str], is_silent: bool = False, prune: bool = True
+    ) -> DispatchReport:
+        slots = asyncio.Semaphore(self.max_concurrent_batches)
+        chunks = [tokens[start:start + self.batch_size] for start in range(0, len(tokens), self.batch_size)]
+        report = DispatchReport(notification_id=notification_id)
+        for results in await asyncio.gather(
+            *[self._send_chunk(slots, notification_id, chunk, is_silent) for chunk in chunks]
+        ):
+            report.results += results
+        self.sent += report.sent
+        self.failed += report.failed
+        if prune and (dead := report.dead_tokens()):
+            try:
+                report.pruned = await self.prune(dead)
+            except Exception:
+                logger.exception("Could not prune %d dead FCM tokens", len(dead))
+        return report
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "pruned": self.pruned,
+            "batches": self.batch_latency.snapshot(),
+        }
+
+
+notification_dispatcher = NotificationDispatcher(
+    batch_size=settings.FCM_BATCH_SIZE,
+    max_concurrent_batches=settings.FCM_MAX_CONCURRENT_BATCHES,
+)
+metrics.register("notifications", notification_dispatcher.stats)
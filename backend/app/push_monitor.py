@@ -0,0 +1,306 @@
+import abc, asyncio, json, logging, time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any
+
+import aioredis
+
+from app import crud
+from app.core import metrics
+from app.core.config import settings
+from app.notifications import NotificationDispatcher, notification_dispatcher
+from app.utils import generate_short_id
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Ack:
+    os: str
+    device: str
+    acked_at: float  # Epoch seconds, comparable across workers
+
+
+class AckSubscription(abc.ABC):
+    """
+    Wakes the waiting check whenever an ack for its notification arrives.
+    """
+
+    @abc.abstractmethod
+    async def wait(self, timeout: float) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def close(self) -> None:
+        ...
+
+
+class AckStore(abc.ABC):
+    """
+    Pending silent pushes and the acks devices sent back through /firebase/reply.
+    The ack can reach any worker, so the store has to be shared by all of them.
+    """
+
+    @abc.abstractmethod
+    async def open(self, notification_id: str, *, ttl: int) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def ack(self, notification_id: str, ack: Ack) -> bool:
+        """
+        Record the first ack per OS. False if the notification is unknown or already closed.
+        """
+
+    @abc.abstractmethod
+    async def acks(self, notification_id: str) -> dict[str, Ack]:
+        ...
+
+    @abc.abstractmethod
+    async def subscribe(self, notification_id: str) -> AckSubscription:
+        ...
+
+    @abc.abstractmethod
+    async def discard(self, notification_id: str) -> None:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+
+class _MemorySubscription(AckSubscription):
+    def __init__(self, store: "MemoryAckStore", notification_id: str) -> None:
+        self.store = store
+        self.notification_id = notification_id
+        self.event = asyncio.Event()
+
+    async def wait(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+
+    async def close(self) -> None:
+        self.store._subscriptions[self.notification_id].discard(self)
+
+
+class MemoryAckStore(AckStore):
+    """
+    In-process store, for tests and single worker setups.
+    """
+
+    def __init__(self) -> None:
+        self._pending: dict[str, dict[str, Ack]] = {}
+        self._subscriptions: defaultdict[str, set[_MemorySubscription]] = defaultdict(set)
+
+    async def open(self, notification_id: str, *, ttl: int) -> None:
+        self._pending[notification_id] = {}
+
+    async def ack(self, notification_id: str, ack: Ack) -> bool:
+        acks = self._pending.get(notification_id)
+        if acks is None:
+            return False
+        acks.setdefault(ack.os, ack)
+        for subscription in self._subscriptions[notification_id]:
+            subscription.event.set()
+        return True
+
+    async def acks(self, notification_id: str) -> dict[str, Ack]:
+        return dict(self._pending.get(notification_id, {}))
+
+    async def subscribe(self, notification_id: str) -> AckSubscription:
+        subscription = _MemorySubscription(self, notification_id)
+        self._subscriptions[notification_id].add(subscription)
+        return subscription
+
+    async def discard(self, notification_id: str) -> None:
+        self._pending.pop(notification_id, None)
+        self._subscriptions.pop(notification_id, None)
+
+
+class _RedisSubscription(AckSubscription):
+    def __init__(self, pubsub: aioredis.client.PubSub) -> None:
+        self.pubsub = pubsub
+
+    async def wait(self, timeout: float) -> None:
+        await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+
+    async def close(self) -> None:
+        await self.pubsub.unsubscribe()
+        await self.pubsub.close()
+
+
+class RedisAckStore(AckStore):
+    """
+    notification:{id} marks a pending push, notification:{id}:acks maps OS -> ack,
+    and every ack is published on notification:{id}:events for the waiting worker.
+    Keys expire on their own if the worker running the check dies.
+    """
+
+    def __init__(self, redis: aioredis.Redis) -> None:
+        self.redis = redis
+
+    async def open(self, notification_id: str, *, ttl: int) -> None:
+        key = f"notification:{notification_id}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            await pipe.set(key, 1, ex=ttl).delete(f"{key}:acks").execute()
+
+    async def ack(self, notification_id: str, ack: Ack) -> bool:
+        key = f"notification:{notification_id}"
+        ttl = await self.redis.ttl(key)
+        if ttl < 0:
+            return False
+        value = json.dumps({"device": ack.device, "acked_at": ack.acked_at})
+        async with self.redis.pipeline(transaction=True) as pipe:
+            await (
+                pipe.hsetnx(f"{key}:acks", ack.os, value)
+                .expire(f"{key}:acks", ttl)
+                .publish(f"{key}:events", ack.os)
+                .execute()
+            )
+        return True
+
+    async def acks(self, notification_id: str) -> dict[str, Ack]:
+        raw = await self.redis.hgetall(f"notification:{notification_id}:acks")
+        return {os: Ack(os=os, **json.loads(value)) for os, value in raw.items()}
+
+    async def subscribe(self, notification_id: str) -> AckSubscription:
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(f"notification:{notification_id}:events")
+        return _RedisSubscription(pubsub)
+
+    async def discard(self, notification_id: str) -> None:
+        key = f"notification:{notification_id}"
+        await self.redis.delete(key, f"{key}:acks")
+
+    async def close(self) -> None:
+        await self.redis.close()
+
+
+@dataclass
+class RoundTripReport:
+    notification_id: str
+    start_time: datetime
+    end_time: datetime
+    acks: dict[str, Ack] = field(default_factory=dict)
+    missing: list[str] = field(default_factory=list)
+
+    @property
+    def timed_out(self) -> bool:
+        return bool(self.missing)
+
+    @property
+    def latency_ms(self) -> dict[str, float]:
+        sent_at = self.start_time.timestamp()
+        return {os: round((ack.acked_at - sent_at) * 1000, 2) for os, ack in self.acks.items()}
+
+
+class RoundTripMonitor:
+    """
+    Sends a silent push and waits, without polling, until a device of every required OS acked it
+    or `timeout` seconds passed. The round trip per OS is written to service_logs.
+    """
+
+    def __init__(
+        self,
+        *,
+        store: AckStore,
+        dispatcher: NotificationDispatcher,
+        timeout: float,
+        required_os: list[str],
+    ) -> None:
+        self.store = store
+        self.dispatcher = dispatcher
+        self.timeout = timeout
+        self.required_os = required_os
+        self.checks = 0
+        self.timeouts = 0
+        self.round_trip: defaultdict[str, metrics.LatencyStats] = defaultdict(metrics.LatencyStats)
+
+    async def ack(self, *, notification_id: str, os: str, token: str) -> bool:
+        device = f"{token[:5]}...{token[-5:]}"
+        return await self.store.ack(notification_id, Ack(os=os, device=device, acked_at=time.time()))
+
+    async def _wait(self, notification_id: str, subscription: AckSubscription) -> dict[str, Ack]:
+        deadline = time.monotonic() + self.timeout
+        while True:
+            # Read after subscribing, so an ack landing in between is never missed
+            acks = await self.store.acks(notification_id)
+            remaining = deadline - time.monotonic()
+            if all(os in acks for os in self.required_os) or remaining <= 0:
+                return acks
+            await subscription.wait(remaining)
+
+    async def check(self, tokens: list[str]) -> RoundTripReport:
+        notification_id = generate_short_id()
+        await self.store.open(notification_id, ttl=int(self.timeout) + 10)
+        subscription = await self.store.subscribe(notification_id)
+        start_time = datetime.now()
+        try:
+            await self.dispatcher.dispatch(notification_id=notification_id, tokens=tokens, is_silent=True)
+            acks = await self._wait(notification_id, subscription)
+        finally:
+            await subscription.close()
+            await self.store.discard(notification_id)
+
+        report = RoundTripReport(
+            notification_id=notification_id,
+            start_time=start_time,
+            end_time=datetime.now(),
+            acks=acks,
+            missing=[os for os in self.required_os if os not in acks],
+        )
+        self.checks += 1
+        self.timeouts += report.timed_out
+        for os, latency_ms in report.latency_ms.items():
+            self.round_trip[os].record(latency_ms)
+        await self._log(report)
+        return report
+
+    async def _log(self, report: RoundTripReport) -> None:
+        for os, ack in report.acks.items():
+            await crud.add_log_entry(
+                service_name="Firebase",
+                service_sub_name="Cloud Messaging",
+                log_data={
+                    "start_time": report.start_time,
+                    "end_time": datetime.fromtimestamp(ack.acked_at),
+                    "is_ok": True,
+                    "content": f"[受信:通知ID {report.notification_id}] [{os}] [応答端末: {ack.device}]",
+                },
+            )
+        for os in report.missing:
+            await crud.add_log_entry(
+                service_name="Firebase",
+                service_sub_name="Cloud Messaging",
+                log_data={
+                    "start_time": report.start_time,
+                    "end_time": report.end_time,
+                    "is_ok": False,
+                    "content": f"[通知ID {report.notification_id}] [{os}] [タイムアウト]",
+                },
+            )
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "checks": self.checks,
+            "timeouts": self.timeouts,
+            "round_trip": {os: stats.snapshot() for os, stats in self.round_trip.items()},
+        }
+
+
+def create_ack_store() -> AckStore:
+    if settings.REDIS_DATABASE_URI:
+        return RedisAckStore(aioredis.from_url(settings.REDIS_DATABASE_URI, decode_responses=True))
+    # Acks reaching another worker would be lost, so only fit for a single worker
+    return MemoryAckStore()
+
+
+round_trip_monitor = RoundTripMonitor(
+    store=create_ack_store(),
+    dispatcher=notification_dispatcher,
+    timeout=settings.FCM_ROUNDTRIP_TIMEOUT_SECONDS,
+    required_os=settings.FCM_ROUNDTRIP_REQUIRED_OS,
+)
+metrics.register("push_round_trip", round_trip_monitor.stats)
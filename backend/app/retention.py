@@ -0,0 +1,242 @@
+import argparse, asyncio, gzip, json, logging, time
+from datetime import datetime, timedelta
+from typing import Any
+from uuid import UUID
+
+from tortoise import run_async, timezone as tz
+from tortoise.expressions import Q
+from tortoise.transactions import in_transaction
+
+from app.core import metrics
+from app.core.config import settings
+from app.core.storage import LocalStorage, ObjectStorage, storage
+from app.models.db_models import Log, Service
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FIELDS = ("id", "service_id", "start_time", "end_time", "elapsed_time", "is_ok", "screenshot", "content")
+
+
+class ArchiveStore:
+    """
+    Archive files stored under a key prefix of an object storage.
+    """
+
+    def __init__(self, storage: ObjectStorage, prefix: str = "") -> None:
+        self.storage = storage
+        self.prefix = prefix
+
+    async def put(self, key: str, body: bytes) -> None:
+        await self.storage.put_object(
+            f"{self.prefix}{key}", body, content_type="application/x-ndjson", content_encoding="gzip"
+        )
+
+    async def get(self, key: str) -> bytes:
+        return await self.storage.get_object(f"{self.prefix}{key}")
+
+    async def list(self, prefix: str) -> list[str]:
+        objects = await self.storage.list_all(f"{self.prefix}{prefix}")
+        return [obj.key[len(self.prefix):] for obj in objects if obj.key.endswith(".ndjson.gz")]
+
+
+def get_archive_store() -> ArchiveStore:
+    if settings.LOG_ARCHIVE_BACKEND == "s3":
+        return ArchiveStore(storage, f"{settings.LOG_ARCHIVE_S3_PREFIX}/")
+    return ArchiveStore(LocalStorage(settings.LOG_ARCHIVE_DIR))
+
+
+def _serialize(log: Log) -> str:
+    row = {}
+    for field in ARCHIVE_FIELDS:
+        value = getattr(log, field)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, UUID):
+            value = str(value)
+        row[field] = value
+    return json.dumps(row, ensure_ascii=False)
+
+
+class RetentionEngine:
+    """
+    Archives logs older than each service's retention period to gzipped NDJSON, then deletes them.
+    A log without start_time ages by its end_time; a log with neither is kept, its age is unknown.
+    A worker first leases the service (like the email outbox, by pushing retention_lease_until forward)
+    and renews the lease before each batch, so only one worker archives a service at a time.
+    The archive is uploaded outside any transaction and the rows are deleted afterwards in a short one.
+    """
+
+    def __init__(self, *, batch_size: int, interval: float, lease: float) -> None:
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lease = timedelta(seconds=lease)
+        self.rows_archived = 0
+        self.files_written = 0
+        self.bytes_written = 0
+        self.skipped_services = 0
+        self.last_run_rows = 0
+        self.last_run_seconds = 0.0
+        self._task: asyncio.Task | None = None
+
+    async def _claim(self, service_id: UUID, held: datetime | None) -> datetime | None:
+        """
+        Take the service's lease, or renew the one held until `held`. Returns the new lease end,
+        None if another worker holds it.
+        """
+        now = tz.now()
+        free = Q(retention_lease_until=held) if held else Q(retention_lease_until=None) | Q(retention_lease_until__lte=now)
+        lease_until = now + self.lease
+        if await Service.filter(free, id=service_id).update(retention_lease_until=lease_until):
+            return lease_until
+        return None
+
+    async def _archive_batch(self, store, service_id: UUID, cutoff: datetime) -> int:
+        expired = Q(start_time__lt=cutoff) | Q(start_time__isnull=True, end_time__lt=cutoff)
+        rows = await Log.filter(expired, service_id=service_id).order_by("start_time", "id").limit(self.batch_size)
+        if not rows:
+            return 0
+        # One file per day, so that restore --day finds every row of that day
+        days: dict[str, list[Log]] = {}
+        for row in rows:
+            days.setdefault((row.start_time or row.end_time).strftime("%Y%m%d"), []).append(row)
+        for day, day_rows in days.items():
+            body = gzip.compress("\n".join(_serialize(row) for row in day_rows).encode() + b"\n")
+            # Archive first: a failed delete leaves duplicates in the archive, never a gap
+            await store.put(f"{service_id}/{day}/{day_rows[0].id}-{day_rows[-1].id}.ndjson.gz", body)
+            self.files_written += 1
+            self.bytes_written += len(body)
+        async with in_transaction():
+            deleted = await Log.filter(id__in=[row.id for row in rows]).delete()
+        self.rows_archived += deleted
+        return len(rows)
+
+    async def _archive_service(self, store, service_id: UUID, cutoff: datetime) -> int:
+        archived = 0
+        held = None
+        try:
+            while True:
+                held = await self._claim(service_id, held)
+                if held is None:
+                    if not archived:
+                        self.skipped_services += 1  # Another worker is on it
+                    return archived
+                count = await self._archive_batch(store, service_id, cutoff)
+                archived += count
+                if count < self.batch_size:
+                    return archived
+                await asyncio.sleep(0)  # Small batches, let the requests in between
+        finally:
+            if held is not None:
+                await Service.filter(id=service_id, retention_lease_until=held).update(retention_lease_until=None)
+
+    async def run_once(self) -> int:
+        """
+        Archive and delete every expired log. Returns the number of rows archived.
+        """
+        started = time.monotonic()
+        store = get_archive_store()
+        archived = 0
+        now = tz.now()
+        services = await Service.all().values_list("id", "log_retention_days")
+        for service_id, retention_days in services:
+            if retention_days is None:
+                retention_days = settings.LOG_RETENTION_DAYS
+            # At least a day, as the API enforces, also for values set in the DB directly
+            cutoff = now - timedelta(days=max(retention_days, 1))
+            archived += await self._archive_service(store, service_id, cutoff)
+        self.last_run_rows = archived
+        self.last_run_seconds = time.monotonic() - started
+        return archived
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                archived = await self.run_once()
+                if archived:
+                    logger.info("Archived %d expired log rows in %.1fs", archived, self.last_run_seconds)
+            except Exception:
+                logger.exception("Log retention run failed")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "rows_archived": self.rows_archived,
+            "files_written": self.files_written,
+            "bytes_written": self.bytes_written,
+            "skipped_services": self.skipped_services,
+            "last_run_rows": self.last_run_rows,
+            "last_run_seconds": round(self.last_run_seconds, 3),
+            "last_run_rows_per_second": round(self.last_run_rows / self.last_run_seconds, 1) if self.last_run_seconds else 0.0,
+        }
+
+
+async def restore(*, service_id: UUID, day: str | None = None) -> int:
+    """
+    Re-insert archived logs of a service, optionally only those archived under one day (YYYYMMDD).
+    Rows whose id still exists are skipped, so restoring twice is harmless.
+    Restored rows are not fed to the ingestion hooks; rollups already account for them.
+    """
+    store = get_archive_store()
+    prefix = f"{service_id}/{day}/" if day else f"{service_id}/"
+    restored = 0
+    for key in await store.list(prefix):
+        lines = gzip.decompress(await store.get(key)).decode().splitlines()
+        rows = [json.loads(line) for line in lines if line]
+        existing = set(await Log.filter(id__in=[row["id"] for row in rows]).values_list("id", flat=True))
+        logs = [
+            Log(
+                **{
+                    **row,
+                    "start_time": datetime.fromisoformat(row["start_time"]) if row["start_time"] else None,
+                    "end_time": datetime.fromisoformat(row["end_time"]) if row["end_time"] else None,
+                }
+            )
+            for row in rows
+            if row["id"] not in existing
+        ]
+        await Log.bulk_create(logs, batch_size=1000)
+        restored += len(logs)
+    return restored
+
+
+retention_engine = RetentionEngine(
+    batch_size=settings.LOG_RETENTION_BATCH_SIZE,
+    interval=settings.LOG_RETENTION_INTERVAL_SECONDS,
+    lease=settings.LOG_RETENTION_LEASE_SECONDS,
+)
+metrics.register("log_retention", retention_engine.stats)
+
+
+if __name__ == "__main__":
+    # python -m app.retention run
+    # python -m app.retention restore <service_id> [--day YYYYMMDD]
+    parser = argparse.ArgumentParser(description="Service log retention")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("run", help="Archive and delete expired logs now")
+    restore_parser = commands.add_parser("restore", help="Restore archived logs of a service")
+    restore_parser.add_argument("service_id", type=UUID)
+    restore_parser.add_argument("--day", default=None, help="Only restore archives of this day (YYYYMMDD)")
+    args = parser.parse_args()
+
+    async def main() -> None:
+        from tortoise import Tortoise
+        await Tortoise.init(config=settings.TORTOISE_ORM)
+        if args.command == "run":
+            logger.info("Archived %d rows", await retention_engine.run_once())
+        else:
+            logger.info("Restored %d rows", await restore(service_id=args.service_id, day=args.day))
+
+    run_async(main())
@@ -0,0 +1,283 @@
+import argparse, bisect, logging, math
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Literal
+from uuid import UUID
+
+from tortoise import run_async, timezone as tz
+from tortoise.expressions import Q
+from tortoise.transactions import in_transaction
+
+from app import crud
+from app.core.config import settings
+from app.log_ingestion import LogEntry, log_ingestor
+from app.models.db_models import Log, LogRollup, Service, elapsed_seconds
+
+logger = logging.getLogger(__name__)
+
+Period = Literal["hour", "day"]
+PERIODS: tuple[Period, ...] = ("hour", "day")
+
+# Upper bounds (seconds) of the latency histogram buckets, ~25% apart from 5 ms to ~6 min.
+# Percentiles are estimated from these buckets, so they are accurate to one bucket width.
+LATENCY_BUCKETS: list[float] = [round(0.005 * 1.25 ** i, 6) for i in range(51)]
+
+# window -> (length, rollup period to read, None meaning raw logs)
+WINDOWS: dict[str, tuple[timedelta, Period | None]] = {
+    "1h": (timedelta(hours=1), None),
+    "24h": (timedelta(hours=24), "hour"),
+    "7d": (timedelta(days=7), "hour"),
+    "30d": (timedelta(days=30), "day"),
+    "90d": (timedelta(days=90), "day"),
+}
+
+
+def bucket_start(value: datetime, period: Period) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    value = value.replace(minute=0, second=0, microsecond=0)
+    if period == "day":
+        value = value.replace(hour=0)
+    return value
+
+
+@dataclass
+class Aggregate:
+    count: int = 0
+    failures: int = 0
+    timed_count: int = 0
+    elapsed_sum: float = 0.0
+    elapsed_min: float | None = None
+    elapsed_max: float | None = None
+    histogram: list[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+
+    def add(self, is_ok: bool, elapsed_time: float | None) -> None:
+        self.count += 1
+        if not is_ok:
+            self.failures += 1
+        if elapsed_time is None:
+            return
+        self.timed_count += 1
+        self.elapsed_sum += elapsed_time
+        self.elapsed_min = elapsed_time if self.elapsed_min is None else min(self.elapsed_min, elapsed_time)
+        self.elapsed_max = elapsed_time if self.elapsed_max is None else max(self.elapsed_max, elapsed_time)
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, elapsed_time)] += 1
+
+    def merge(self, other: "Aggregate") -> None:
+        self.count += other.count
+        self.failures += other.failures
+        self.timed_count += other.timed_count
+        self.elapsed_sum += other.elapsed_sum
+        for value in (other.elapsed_min, other.elapsed_max):
+            if value is not None:
+                self.elapsed_min = value if self.elapsed_min is None else min(self.elapsed_min, value)
+                self.elapsed_max = value if self.elapsed_max is None else max(self.elapsed_max, value)
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+    def percentile(self, q: float) -> float | None:
+        if not self.timed_count:
+            return None
+        rank = max(1, math.ceil(q * self.timed_count))
+        seen = 0
+        for index, bucket_count in enumerate(self.histogram):
+            seen += bucket_count
+            if seen >= rank:
+                upper = LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else self.elapsed_max
+                return min(max(upper, self.elapsed_min), self.elapsed_max)
+        return self.elapsed_max
+
+    @classmethod
+    def from_rollup(cls, rollup: LogRollup) -> "Aggregate":
+        histogram = list(rollup.histogram) or [0] * (len(LATENCY_BUCKETS) + 1)
+        return cls(
+            count=rollup.count,
+            failures=rollup.failures,
+            timed_count=rollup.timed_count,
+            elapsed_sum=rollup.elapsed_sum,
+            elapsed_min=rollup.elapsed_min,
+            elapsed_max=rollup.elapsed_max,
+            histogram=histogram,
+        )
+
+    def to_fields(self) -> dict:
+        return {
+            "count": self.count,
+            "failures": self.failures,
+            "timed_count": self.timed_count,
+            "elapsed_sum": self.elapsed_sum,
+            "elapsed_min": self.elapsed_min,
+            "elapsed_max": self.elapsed_max,
+            "histogram": self.histogram,
+        }
+
+
+RollupKey = tuple[UUID, Period, datetime]
+
+
+def aggregate_entries(entries: Iterable[LogEntry]) -> dict[RollupKey, Aggregate]:
+    aggregates: dict[RollupKey, Aggregate] = defaultdict(Aggregate)
+    for entry in entries:
+        if entry.start_time is None:
+            continue  # Cannot be placed in a bucket
+        elapsed_time = elapsed_seconds(entry.start_time, entry.end_time)
+        for period in PERIODS:
+            key = (entry.service_id, period, bucket_start(entry.start_time, period))
+            aggregates[key].add(entry.is_ok, elapsed_time)
+    return aggregates
+
+
+async def _merge_rollup(key: RollupKey, aggregate: Aggregate) -> None:
+    service_id, period, start = key
+
+    def apply(rollup: LogRollup) -> None:
+        merged = Aggregate.from_rollup(rollup)
+        merged.merge(aggregate)
+        rollup.update_from_dict(merged.to_fields())
+
+    await crud.upsert_locked(LogRollup, {"service_id": service_id, "period": period, "bucket_start": start}, apply)
+
+
+async def apply_rollups(entries: list[LogEntry]) -> None:
+    """
+    Fold freshly written log entries into the hourly and daily rollups.
+    Registered as a log ingestion hook.
+    """
+    for key, aggregate in aggregate_entries(entries).items():
+        await _merge_rollup(key, aggregate)
+
+log_ingestor.add_hook(apply_rollups)
+
+
+async def _replace_rollups(
+    service_id: UUID, floor: datetime, done: dict[Period, list[tuple[datetime, Aggregate]]], cleared: dict[Period, datetime]
+) -> int:
+    """
+    Write the rebuilt buckets of one service, completed in bucket_start order, replacing every rollup
+    from the end of the previous write up to the last of them. `cleared` tracks that end per period.
+    """
+    rows = []
+    async with in_transaction():
+        for period, buckets in done.items():
+            # A bucket that starts before the oldest log may have lost some of its logs, keep it as it is
+            buckets = [(start, aggregate) for start, aggregate in buckets if start >= floor]
+            if not buckets:
+                continue
+            stale = LogRollup.filter(service_id=service_id, period=period, bucket_start__lte=buckets[-1][0])
+            if period in cleared:
+                stale = stale.filter(bucket_start__gt=cleared[period])
+            else:
+                stale = stale.filter(bucket_start__gte=floor)
+            await stale.delete()
+            cleared[period] = buckets[-1][0]
+            rows += [
+                LogRollup(service_id=service_id, period=period, bucket_start=start, **aggregate.to_fields())
+                for start, aggregate in buckets
+            ]
+        await LogRollup.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+async def _backfill_service(service_id: UUID, cutoffs: dict[Period, datetime], page_size: int) -> int:
+    query = Log.filter(service_id=service_id, start_time__lt=cutoffs["hour"], start_time__isnull=False)
+    floor: datetime | None = None  # Oldest remaining log
+    current: dict[Period, tuple[datetime, Aggregate]] = {}  # Bucket being filled
+    cleared: dict[Period, datetime] = {}
+    written = 0
+    after: tuple[datetime, int] | None = None
+    while True:
+        # Keyset walk in time order: a bucket is complete once the walk moves past it
+        page = query
+        if after is not None:
+            page = page.filter(Q(start_time__gt=after[0]) | Q(start_time=after[0], id__gt=after[1]))
+        rows = await page.order_by("start_time", "id").limit(page_size).values_list(
+            "id", "start_time", "is_ok", "elapsed_time"
+        )
+        if not rows:
+            break
+        if floor is None:
+            floor = rows[0][1]
+        done: dict[Period, list[tuple[datetime, Aggregate]]] = defaultdict(list)
+        for _, start_time, is_ok, elapsed_time in rows:
+            for period in PERIODS:
+                start = bucket_start(start_time, period)
+                if start >= cutoffs[period]:
+                    continue
+                if period not in current or current[period][0] != start:
+                    if period in current:
+                        done[period].append(current[period])
+                    current[period] = (start, Aggregate())
+                current[period][1].add(is_ok, elapsed_time)
+        written += await _replace_rollups(service_id, floor, done, cleared)
+        after = (rows[-1][1], rows[-1][0])
+
+    if floor is None:
+        return 0  # No logs left, their rollups are the only record
+    written += await _replace_rollups(service_id, floor, {period: [bucket] for period, bucket in current.items()}, cleared)
+    async with in_transaction():
+        for period in PERIODS:
+            # Buckets past the last log, up to the cutoff, no longer have any log
+            stale = LogRollup.filter(service_id=service_id, period=period, bucket_start__lt=cutoffs[period])
+            if period in cleared:
+                stale = stale.filter(bucket_start__gt=cleared[period])
+            else:
+                stale = stale.filter(bucket_start__gte=floor)
+            await stale.delete()
+    return written
+
+
+async def backfill(*, service_id: UUID | None = None, page_size: int = 5000) -> int:
+    """
+    Rebuild rollups from the raw logs, up to the start of the current hour (hourly)
+    and of the current day (daily). Newer buckets are left to live ingestion.
+    Only buckets starting at or after a service's oldest remaining log are rebuilt: older raw logs
+    may have been archived by retention, and their rollups are the only record left.
+    Each service's logs are walked in time order and every bucket is written once complete,
+    so memory stays bounded by page_size whatever the length of the history.
+    Returns the number of rollup rows written.
+    """
+    now = tz.now()
+    cutoffs = {period: bucket_start(now, period) for period in PERIODS}
+    service_ids = [service_id] if service_id is not None else await Service.all().values_list("id", flat=True)
+    written = 0
+    for log_service_id in service_ids:
+        written += await _backfill_service(log_service_id, cutoffs, page_size)
+    return written
+
+
+async def get_stats(*, service_id: UUID, window: str) -> tuple[Aggregate, str]:
+    """
+    Aggregate a service's checks over the window.
+    Only the 1h window reads raw logs, longer windows are served from rollups.
+    Returns the aggregate and the source it was computed from.
+    """
+    length, period = WINDOWS[window]
+    since = tz.now() - length
+    aggregate = Aggregate()
+    if period is None:
+        rows = await Log.filter(service_id=service_id, start_time__gte=since).values_list("is_ok", "elapsed_time")
+        for is_ok, elapsed_time in rows:
+            aggregate.add(is_ok, elapsed_time)
+        return aggregate, "logs"
+
+    rollups = await LogRollup.filter(
+        service_id=service_id, period=period, bucket_start__gte=bucket_start(since, period)
+    )
+    for rollup in rollups:
+        aggregate.merge(Aggregate.from_rollup(rollup))
+    return aggregate, "hourly" if period == "hour" else "daily"
+
+
+if __name__ == "__main__":
+    # python -m app.rollups [--service <uuid>]
+    parser = argparse.ArgumentParser(description="Rebuild service log rollups from raw logs")
+    parser.add_argument("--service", type=UUID, default=None, help="Only rebuild this service")
+    args = parser.parse_args()
+
+    async def main() -> None:
+        from tortoise import Tortoise
+        await Tortoise.init(config=settings.TORTOISE_ORM)
+        written = await backfill(service_id=args.service)
+        logger.info("Wrote %d rollup rows", written)
+
+    run_async(main())
@@ -0,0 +1,35 @@
+from collections import defaultdict
+from uuid import UUID
+
+from app import crud
+from app.log_ingestion import LogEntry, log_ingestor
+from app.models.db_models import ServiceStatus, elapsed_seconds
+
+
+async def _update_status(service_id: UUID, entries: list[LogEntry]) -> None:
+    def apply(status: ServiceStatus) -> None:
+        for entry in entries:
+            if status.last_check_time is not None and entry.start_time <= status.last_check_time:
+                continue  # Late arrival, older than the current state
+            status.last_check_time = entry.start_time
+            status.last_is_ok = entry.is_ok
+            status.last_elapsed_time = elapsed_seconds(entry.start_time, entry.end_time)
+            status.consecutive_failures = 0 if entry.is_ok else status.consecutive_failures + 1
+
+    await crud.upsert_locked(ServiceStatus, {"service_id": service_id}, apply)
+
+
+async def apply_status(entries: list[LogEntry]) -> None:
+    """
+    Move each service's latest status forward with freshly written log entries.
+    Registered as a log ingestion hook.
+    """
+    by_service: dict[UUID, list[LogEntry]] = defaultdict(list)
+    for entry in entries:
+        if entry.start_time is not None:
+            by_service[entry.service_id].append(entry)
+    for service_id, service_entries in by_service.items():
+        service_entries.sort(key=lambda entry: entry.start_time)
+        await _update_status(service_id, service_entries)
+
+log_ingestor.add_hook(apply_status)
@@ -0,0 +1,84 @@
+import asyncio, logging
+from typing import Any
+
+from tortoise import timezone as tz
+
+from app import upload_sessions
+from app.core import metrics
+from app.core.config import settings
+from app.models.db_models import TempUser, UploadSession
+
+logger = logging.getLogger(__name__)
+
+
+class TempUserSweeper:
+    """
+    Deletes expired temp users in batches, aborting the resumable uploads they left behind.
+    """
+
+    def __init__(self, *, batch_size: int, interval: float) -> None:
+        self.batch_size = batch_size
+        self.interval = interval
+        self.deleted = 0
+        self.uploads_aborted = 0
+        self._task: asyncio.Task | None = None
+
+    async def _sweep_batch(self) -> int:
+        ids = await TempUser.filter(expires_at__lt=tz.now()).limit(self.batch_size).values_list("id", flat=True)
+        if not ids:
+            return 0
+        # Sessions go with their temp user (cascade), so free the S3 parts first
+        for session in await UploadSession.filter(temp_user_id__in=ids):
+            try:
+                await upload_sessions.abort(session)
+                self.uploads_aborted += 1
+            except Exception:
+                logger.exception("Could not abort upload session %s", session.id)
+        deleted = await TempUser.filter(id__in=ids).delete()
+        self.deleted += deleted
+        return len(ids)
+
+    async def run_once(self) -> int:
+        """
+        Delete every expired temp user. Returns the number of rows swept.
+        """
+        swept = 0
+        while True:
+            count = await self._sweep_batch()
+            swept += count
+            if count < self.batch_size:
+                return swept
+            await asyncio.sleep(0)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                swept = await self.run_once()
+                if swept:
+                    logger.info("Deleted %d expired temp users", swept)
+            except Exception:
+                logger.exception("Temp user sweep failed")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict[str, Any]:
+        return {"deleted": self.deleted, "uploads_aborted": self.uploads_aborted}
+
+
+temp_user_sweeper = TempUserSweeper(
+    batch_size=settings.TEMP_USER_SWEEP_BATCH_SIZE,
+    interval=settings.TEMP_USER_SWEEP_INTERVAL_SECONDS,
+)
+metrics.register("temp_user_sweeper", temp_user_sweeper.stats)
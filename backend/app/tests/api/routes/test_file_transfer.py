@@ -0,0 +1,459 @@
+import pytest, asyncio, io, os, tempfile, tracemalloc, zipfile
+from datetime import datetime, timedelta
+from fastapi import UploadFile
+from httpx import AsyncClient
+from tortoise import timezone as tz
+from unittest.mock import patch
+
+from app import transfer_objects, upload_sessions
+from app.temp_user_sweeper import temp_user_sweeper
+from app.api.routes import file_transfer
+from app.core.config import settings
+from app.core.storage import LocalStorage, MULTIPART_DIR, ObjectStorage, UploadTooLarge
+from app.models.db_models import TempUser, TransferObject, UploadSession
+
+
+@pytest.fixture
+def local_storage(tmp_path):
+    storage = LocalStorage(tmp_path)
+    with patch.object(file_transfer, "storage", storage), patch.object(upload_sessions, "storage", storage):
+        yield storage
+
+
+async def login_temp_user(
+    client: AsyncClient, superuser_token_headers: dict[str, str], company_name: str, type: str = "upload"
+) -> tuple[dict, dict[str, str]]:
+    r = await client.post(
+        f"{settings.API_V1_STR}/file-transfer/generate-url",
+        headers=superuser_token_headers,
+        json={"company_name": company_name, "expiry_hours": 1, "type": type},
+    )
+    credentials = r.json()
+    r = await client.post(
+        f"{settings.API_V1_STR}/file-transfer/login/access-token",
+        data={"username": credentials["username"], "password": credentials["password"]},
+    )
+    return credentials, {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+
+@pytest.mark.anyio
+async def test_upload_list_download_delete_file(
+    client: AsyncClient, superuser_token_headers: dict[str, str], local_storage: LocalStorage
+) -> None:
+    r = await client.post(
+        f"{settings.API_V1_STR}/file-transfer/upload/to-customer",
+        headers=superuser_token_headers,
+        files={"file": ("report.txt", b"hello", "text/plain")},
+    )
+    assert r.status_code == 200
+    username = settings.FIRST_USER_NAME.split()[0]
+    assert (local_storage.root / f"transfer/to_customer/{username}/report.txt").read_bytes() == b"hello"
+
+    r = await client.get(f"{settings.API_V1_STR}/file-transfer/files/to_customer", headers=superuser_token_headers)
+    assert r.status_code == 200
+    files = r.json()
+    assert [f["Key"] for f in files] == [f"to_customer/{username}/report.txt"]
+    assert files[0]["Size"] == 5
+
+    r = await client.get(
+        f"{settings.API_V1_STR}/file-transfer/download/to_customer/{username}/report.txt",
+        headers=superuser_token_headers,
+    )
+    assert r.status_code == 200
+    assert r.json()["url"].endswith("report.txt")
+
+    r = await client.delete(
+        f"{settings.API_V1_STR}/file-transfer/delete/to_customer/{username}/report.txt",
+        headers=superuser_token_headers,
+    )
+    assert r.status_code == 200
+    r = await client.get(f"{settings.API_V1_STR}/file-transfer/files/to_customer", headers=superuser_token_headers)
+    assert r.json() == []
+
+    stats = local_storage.stats()
+    assert stats["put_object"]["count"] == 1
+    assert "list_objects" not in stats  # Listing is served from transfer_objects
+    assert stats["delete_object"]["errors"] == 0
+
+
+@pytest.mark.anyio
+async def test_upload_from_customer(
+    client: AsyncClient, superuser_token_headers: dict[str, str], local_storage: LocalStorage
+) -> None:
+    credentials, headers = await login_temp_user(client, superuser_token_headers, "acme")
+
+    r = await client.post(
+        f"{settings.API_V1_STR}/file-transfer/upload/from-customer",
+        headers=headers,
+        files={"file": ("data.csv", b"a,b\n1,2\n", "text/csv")},
+    )
+    assert r.status_code == 200
+    assert (local_storage.root / "transfer/from_customer/acme/data.csv").read_bytes() == b"a,b\n1,2\n"
+    assert await TempUser.get_or_none(name=credentials["username"]) is None
+
+
+@pytest.mark.anyio
+async def test_direct_upload_from_customer(
+    client: AsyncClient, superuser_token_headers: dict[str, str], local_storage: LocalStorage
+) -> None:
+    credentials, headers = await login_temp_user(client, superuser_token_headers, "globex")
+
+    r = await client.post(
+        f"{settings.API_V1_STR}/file-transfer/upload/from-customer/presign",
+        headers=headers,
+        json={"file_name": "../../to_customer/evil/report.pdf", "content_type": "application/pdf"},
+    )
+    assert r.status_code == 200
+    presigned = r.json()
+    key = "transfer/from_customer/globex/report.pdf"
+    assert presigned["key"] == key
+    assert presigned["fields"]["key"] == key
+
+    # Completing before the file reached storage fails and keeps the temp user
+    r = await client.post(
+        f"{settings.API_V1_STR}/file-transfer/upload/from-customer/complete", headers=headers, json={"key": key}
+    )
+    assert r.status_code == 404
+    r = await client.post(
+        f"{settings.API_V1_STR}/file-transfer/upload/from-customer/complete",
+        headers=headers,
+        json={"key": "transfer/from_customer/acme/report.pdf"},
+    )
+    assert r.status_code == 403
+
+    await local_storage.put_object(key, b"%PDF", content_type="application/pdf")  # The client's POST to S3
+    r = await client.post(
+        f"{settings.API_V1_STR}/file-transfer/upload/from-customer/complete", headers=headers, json={"key": key}
+    )
+    assert r.status_code == 200
+    assert await TempUser.get_or_none(name=credentials["username"]) is None
+
+
+@pytest.mark.anyio
+async def test_list_files_pages_and_search(
+    client: AsyncClient, superuser_token_headers: dict[str, str], local_storage: LocalStorage
+) -> None:
+    for i in range(5):
+        await local_storage.put_object(f"transfer/from_customer/initech/{i}.txt", b"x" * (i + 1))
+    assert transfer_objects.parse_key("transfer/from_customer/initech/empty/") is None  # Folder marker
+    await local_storage.put_object("transfer/from_customer/initech/blank.txt", b"")
+    await TransferObject.create(
+        key="transfer/from_customer/initech/gone.txt",
+        folder="from_customer",
+        company="initech",
+        file_name="gone.txt",
+        size=1,
+        last_modified=datetime(2020, 1, 1),
+    )
+    await TransferObject.create(
+        key="transfer/from_customer/initech/0.txt",
+        folder="from_customer",
+        company="initech",
+        file_name="0.txt",
+        size=99,
+        last_modified=datetime(2020, 1, 1),
+    )
+    await asyncio.sleep(0.01)  # Rows above predate the run
+
+    counts = await transfer_objects.reconcile(store=local_storage, page_size=2)
+    assert counts["created"] == 5 and counts["updated"] == 1
+    assert await TransferObject.exists(key="transfer/from_customer/initech/blank.txt", size=0)
+    assert counts["deleted"] >= 1  # Also rows of other tests, whose files are not in this storage
+    assert not await TransferObject.exists(key="transfer/from_customer/initech/gone.txt")
+    assert await transfer_objects.reconcile(store=local_storage, page_size=2) == {"created": 0, "updated": 0, "deleted": 0}
+
+    keys, token = [], None
+    while True:
+        r = await client.get(
+            f"{settings.API_V1_STR}/file-transfer/files/from_customer",
+            headers=superuser_token_headers,
+            params={"limit": 2, **({"continuation_token": token} if token else {})},
+        )
+        assert r.status_code == 200
+        keys += [f["Key"] for f in r.json() if f["Key"].startswith("from_customer/initech/")]
+        token = r.headers.get("X-Continuation-Token")
+        if token is None:
+            break
+    assert keys == [f"from_customer/initech/{i}.txt" for i in range(5)] + ["from_customer/initech/blank.txt"]
+
+    r = await client.get(
+        f"{settings.API_V1_STR}/file-transfer/search",
+        headers=superuser_token_headers,
+        params={"company": "initech", "file_name": "3"},
+    )
+    assert [(f["Key"], f["Size"]) for f in r.json()] == [("from_customer/initech/3.txt", 4)]
+    r = await client.get(f"{settings.API_V1_STR}/file-transfer/search", headers=superuser_token_headers)
+    assert r.status_code == 400
+
+    r = await client.delete(
+        f"{settings.API_V1_STR}/file-transfer/delete/from_customer/initech/0.txt", headers=superuser_token_headers
+    )
+    assert r.status_code == 200
+    assert not await TransferObject.exists(key="transfer/from_customer/initech/0.txt")
+
+@pytest.mark.anyio
+async def test_transfer_reconciler_runs_at_startup(client: AsyncClient, local_storage: LocalStorage) -> None:
+    # An object written outside the API shows up without running the CLI
+    await local_storage.put_object("transfer/to_customer/hooli/outside.txt", b"abc")
+    reconciler = transfer_objects.TransferReconciler(store=local_storage, interval=3600)
+    reconciler.start()
+    try:
+        for _ in range(100):
+            if reconciler.runs:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        await reconciler.stop()
+    assert reconciler.runs == 1
+    row = await TransferObject.get(key="transfer/to_customer/hooli/outside.txt")
+    assert (row.folder, row.company, row.file_name, row.size) == ("to_customer", "hooli", "outside.txt", 3)
+
+@pytest.mark.anyio
+async def test_bulk_delete_and_folder_download(
+    client: AsyncClient, superuser_token_headers: dict[str, str], local_storage: LocalStorage
+) -> None:
+    contents = {f"report-{i}.txt": os.urandom(1500 * 1024 + i) for i in range(3)}
+    for name, body in contents.items():
+        await local_storage.put_object(f"transfer/from_customer/umbrella/{name}", body)
+    await local_storage.put_object("transfer/from_customer/umbrella/2024/nested.txt", b"nested")
+
+    r = await client.get(
+        f"{settings.API_V1_STR}/file-transfer/download-folder/from_customer/umbrella",
+        headers=superuser_token_headers,
+    )
+    assert r.status_code == 200
+    assert r.headers["content-disposition"] == 'attachment; filename="umbrella.zip"'
+    with zipfile.ZipFile(io.BytesIO(r.content)) as archive:
+        assert archive.testzip() is None
+        assert sorted(archive.namelist()) == sorted([*contents, "2024/nested.txt"])
+        for name, body in contents.items():
+            assert archive.read(name) == body
+
+    r = await client.get(
+        f"{settings.API_V1_STR}/file-transfer/download-folder/from_customer/nobody",
+        headers=superuser_token_headers,
+    )
+    assert r.status_code == 404
+
+    await transfer_objects.record_object(key="transfer/from_customer/umbrella/report-0.txt", size=1)
+    r = await client.post(
+        f"{settings.API_V1_STR}/file-transfer/delete",
+        headers=superuser_token_headers,
+        json={"file_names": [f"from_customer/umbrella/{name}" for name in contents]},
+    )
+    assert r.status_code == 200
+    assert r.json() == {"deleted": 3, "failed": []}
+    assert [obj.key for obj in await local_storage.list_all("transfer/")] == ["transfer/from_customer/umbrella/2024/nested.txt"]
+    assert not await TransferObject.exists(key="transfer/from_customer/umbrella/report-0.txt")
+
+
+@pytest.mark.anyio
+async def test_delete_objects_batches(tmp_path) -> None:
+    storage = LocalStorage(tmp_path)
+    keys = [f"transfer/to_customer/bulk/{i}.txt" for i in range(2500)]
+    assert await storage.delete_objects(keys + ["../outside.txt"]) == ["../outside.txt"]
+    assert storage.stats()["delete_objects"]["count"] == 3
+
+
+@pytest.mark.anyio
+async def test_resumable_upload(
+    client: AsyncClient, superuser_token_headers: dict[str, str], local_storage: LocalStorage
+) -> None:
+    credentials, headers = await login_temp_user(client, superuser_token_headers, "hooli")
+    body = os.urandom(2600)
+    with patch.object(settings, "UPLOAD_PART_SIZE_BYTES", 1024):
+        r = await client.post(
+            f"{settings.API_V1_STR}/file-transfer/uploads",
+            headers=headers,
+            json={"file_name": "backup.tar", "size": len(body)},
+        )
+    assert r.status_code == 201
+    session = r.json()
+    assert session["offset"] == 0 and session["part_size"] == 1024
+    url = r.headers["location"]
+    assert url.endswith(session["id"])
+    patch_headers = {**headers, "Content-Type": "application/offset+octet-stream"}
+
+    # Interrupted after 1500 bytes: only the whole first part is kept
+    r = await client.patch(url, headers={**patch_headers, "Upload-Offset": "0"}, content=body[:1500])
+    assert r.status_code == 204
+    assert r.headers["upload-offset"] == "1024"
+    r = await client.patch(url, headers={**patch_headers, "Upload-Offset": "0"}, content=body[:1500])
+    assert r.status_code == 409
+    r = await client.head(url, headers=headers)
+    assert r.headers["upload-offset"] == "1024"
+    assert r.headers["upload-length"] == "2600"
+
+    r = await client.patch(url, headers={**patch_headers, "Upload-Offset": "1024"}, content=body[1024:])
+    assert r.status_code == 204
+    assert r.headers["upload-offset"] == "2600"
+    assert (local_storage.root / "transfer/from_customer/hooli/backup.tar").read_bytes() == body
+    assert await TransferObject.exists(key="transfer/from_customer/hooli/backup.tar", size=2600)
+    assert not await UploadSession.exists(id=session["id"])
+    assert await TempUser.get_or_none(name=credentials["username"]) is None
+
+
+@pytest.mark.anyio
+async def test_resumable_upload_abort(
+    client: AsyncClient, superuser_token_headers: dict[str, str], local_storage: LocalStorage
+) -> None:
+    _, headers = await login_temp_user(client, superuser_token_headers, "hooli")
+    r = await client.post(
+        f"{settings.API_V1_STR}/file-transfer/uploads", headers=headers, json={"file_name": "big.iso", "size": 10**20}
+    )
+    assert r.status_code == 413
+
+    with patch.object(settings, "UPLOAD_PART_SIZE_BYTES", 1024):
+        r = await client.post(
+            f"{settings.API_V1_STR}/file-transfer/uploads", headers=headers, json={"file_name": "big.iso", "size": 4096}
+        )
+    url = r.headers["location"]
+    r = await client.patch(
+        url,
+        headers={**headers, "Content-Type": "application/offset+octet-stream", "Upload-Offset": "0"},
+        content=b"x" * 2048,
+    )
+    assert r.headers["upload-offset"] == "2048"
+    r = await client.delete(url, headers=headers)
+    assert r.status_code == 204
+    assert not await UploadSession.exists(id=url.rsplit("/", 1)[1])
+    assert not any((local_storage.root / MULTIPART_DIR).iterdir())
+
+
+@pytest.mark.anyio
+async def test_temp_user_password_hashed_and_expiry(
+    client: AsyncClient, superuser_token_headers: dict[str, str], local_storage: LocalStorage
+) -> None:
+    credentials, headers = await login_temp_user(client, superuser_token_headers, "wonka")
+    temp_user = await TempUser.get(name=credentials["username"])
+    assert temp_user.pwd != credentials["password"]
+    assert timedelta(minutes=59) < temp_user.expires_at - tz.now() <= timedelta(hours=1)
+
+    r = await client.post(
+        f"{settings.API_V1_STR}/file-transfer/login/access-token",
+        data={"username": credentials["username"], "password": "wrong"},
+    )
+    assert r.status_code == 401
+
+    temp_user.expires_at = tz.now() - timedelta(minutes=1)
+    await temp_user.save()
+    r = await client.get(f"{settings.API_V1_STR}/file-transfer/me", headers=headers)
+    assert r.status_code == 401
+    r = await client.post(
+        f"{settings.API_V1_STR}/file-transfer/login/access-token",
+        data={"username": credentials["username"], "password": credentials["password"]},
+    )
+    assert r.status_code == 401
+
+    session = await upload_sessions.create_session(temp_user=temp_user, key="transfer/from_customer/wonka/a.bin", size=10)
+    alive = await TempUser.create(
+        name="alive-user", pwd="x", company_name="wonka", type="upload", expires_at=tz.now() + timedelta(hours=1)
+    )
+    with patch.object(temp_user_sweeper, "batch_size", 1):
+        assert await temp_user_sweeper.run_once() >= 1
+    assert not await TempUser.exists(id=temp_user.id)
+    assert not await UploadSession.exists(id=session.id)
+    assert await TempUser.exists(id=alive.id)
+    assert not any((local_storage.root / MULTIPART_DIR).iterdir())
+
+
+@pytest.mark.anyio
+async def test_local_storage_pagination(tmp_path) -> None:
+    storage = LocalStorage(tmp_path)
+    for i in range(5):
+        await storage.put_object(f"transfer/from_customer/acme/{i}.txt", b"x")
+    await storage.put_object("transfer/from_customer_other/skip.txt", b"x")
+
+    page, token = await storage.list_objects("transfer/from_customer/", max_keys=2)
+    keys = [obj.key for obj in page]
+    while token:
+        page, token = await storage.list_objects("transfer/from_customer/", continuation_token=token, max_keys=2)
+        keys += [obj.key for obj in page]
+    assert keys == [f"transfer/from_customer/acme/{i}.txt" for i in range(5)]
+
+    with pytest.raises(ValueError):
+        await storage.get_object("../outside.txt")
+
+
+def make_upload(size: int) -> UploadFile:
+    file = tempfile.TemporaryFile()
+    chunk = os.urandom(1024 * 1024)
+    for _ in range(size // len(chunk)):
+        file.write(chunk)
+    file.write(chunk[:size % len(chunk)])
+    file.seek(0)
+    return UploadFile(file, size=size, filename="big.bin")
+
+
+@pytest.mark.anyio
+async def test_multipart_upload_memory_is_bounded(tmp_path) -> None:
+    storage = LocalStorage(tmp_path)
+    part_size, concurrency, size = 1024 * 1024, 3, 24 * 1024 * 1024 + 123
+    upload = make_upload(size)
+
+    tracemalloc.start()
+    try:
+        stored = await storage.upload_file(
+            "transfer/big.bin", upload, part_size=part_size, concurrency=concurrency, max_size=size
+        )
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert stored == size
+    assert (tmp_path / "transfer/big.bin").stat().st_size == size
+    assert storage.stats()["upload_part"]["count"] == 25
+    # Parts in flight plus the one being read, far below the 24 MiB file
+    assert peak < part_size * (concurrency + 2)
+    upload.file.seek(0)
+    assert (tmp_path / "transfer/big.bin").read_bytes() == upload.file.read()
+    assert not any((tmp_path / MULTIPART_DIR).iterdir())
+
+
+def test_storage_backend_must_implement_every_operation() -> None:
+    class PartialStorage(ObjectStorage):
+        async def put_object(self, key, body, *, content_type=None, content_encoding=None) -> None:
+            pass
+
+    # Refused when constructed, not deep inside an upload
+    with pytest.raises(TypeError, match="upload_part"):
+        PartialStorage()
+
+
+class FailingStorage(LocalStorage):
+    async def upload_part(self, key: str, upload_id: str, part_number: int, body: bytes) -> str:
+        if part_number == 3:
+            raise OSError("connection reset")
+        return await super().upload_part(key, upload_id, part_number, body)
+
+
+@pytest.mark.anyio
+async def test_multipart_upload_aborts_on_failure(tmp_path) -> None:
+    storage = FailingStorage(tmp_path)
+    with pytest.raises(OSError):
+        await storage.upload_file(
+            "transfer/big.bin", make_upload(6 * 1024 * 1024), part_size=1024 * 1024, concurrency=2, max_size=2**30
+        )
+    assert not (tmp_path / "transfer/big.bin").exists()
+    assert not any((tmp_path / MULTIPART_DIR).iterdir())
+    assert storage.stats()["abort_multipart_upload"]["count"] == 1
+
+    with pytest.raises(UploadTooLarge):
+        await storage.upload_file(
+            "transfer/big.bin", make_upload(3 * 1024 * 1024), part_size=1024 * 1024, concurrency=2, max_size=2 * 1024 * 1024
+        )
+    assert not (tmp_path / "transfer/big.bin").exists()
+
+
+@pytest.mark.anyio
+async def test_upload_over_size_cap_is_rejected(
+    client: AsyncClient, superuser_token_headers: dict[str, str], local_storage: LocalStorage
+) -> None:
+    with patch.object(settings, "UPLOAD_MAX_SIZE_BYTES", 4):
+        r = await client.post(
+            f"{settings.API_V1_STR}/file-transfer/upload/to-customer",
+            headers=superuser_token_headers,
+            files={"file": ("report.txt", b"hello", "text/plain")},
+        )
+    assert r.status_code == 413
+    assert not list(local_storage.root.rglob("report.txt"))
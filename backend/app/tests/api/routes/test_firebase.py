@@ -0,0 +1,205 @@
+import pytest, asyncio, time
+from firebase_admin import exceptions, messaging
+from httpx import AsyncClient
+from unittest.mock import patch
+
+from app.core.config import settings
+from app.log_ingestion import log_ingestor
+from app.models.db_models import FcmToken, Log, Service
+from app.notifications import NotificationDispatcher, notification_dispatcher
+from app.push_monitor import MemoryAckStore, RoundTripMonitor, round_trip_monitor
+from app.tests.utils.user import create_random_user
+
+
+class StubFCM:
+    """
+    Stands in for FCM's send_each: fixed latency per call, tokens starting with "dead" are unregistered
+    and tokens starting with "bad" are rejected as invalid.
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.calls: list[int] = []
+        self.notification_ids: list[str] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def __call__(self, messages: list[messaging.Message]) -> messaging.BatchResponse:
+        self.calls.append(len(messages))
+        self.notification_ids.append(messages[0].data["notification_id"])
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        return messaging.BatchResponse([self.respond(message.token) for message in messages])
+
+    @staticmethod
+    def respond(token: str) -> messaging.SendResponse:
+        if token.startswith("dead"):
+            return messaging.SendResponse(None, messaging.UnregisteredError("Requested entity was not found."))
+        if token.startswith("bad"):
+            return messaging.SendResponse(None, exceptions.InvalidArgumentError("Invalid registration token"))
+        return messaging.SendResponse({"name": f"projects/test/messages/{token}"}, None)
+
+
+@pytest.mark.anyio
+async def test_health_check_returns_per_token_results(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    await FcmToken.create(token="live-token-1", user_id=await create_random_user())
+    await FcmToken.create(token="dead-token-1", user_id=await create_random_user())
+    stub = StubFCM()
+    with patch.object(notification_dispatcher, "send_batch", stub):
+        r = await client.get(f"{settings.API_V1_STR}/firebase/all", headers=superuser_token_headers)
+    assert r.status_code == 200
+    report = r.json()
+    assert report["sent"] >= 1 and report["failed"] >= 1
+    results = {result["token"]: result for result in report["results"]}
+    assert results["live-token-1"]["success"] is True
+    assert results["live-token-1"]["message_id"] == "projects/test/messages/live-token-1"
+    assert results["dead-token-1"]["error_code"] == "UNREGISTERED"
+
+
+@pytest.mark.anyio
+async def test_dead_tokens_are_pruned_after_send(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    await FcmToken.create(token="live-token-2", user_id=await create_random_user())
+    await FcmToken.create(token="dead-token-2", user_id=await create_random_user())
+    await FcmToken.create(token="bad-token-2", user_id=await create_random_user())
+    pruned_before = notification_dispatcher.stats()["pruned"]
+    stub = StubFCM()
+    with patch.object(notification_dispatcher, "send_batch", stub):
+        r = await client.get(f"{settings.API_V1_STR}/firebase/all", headers=superuser_token_headers)
+        assert r.status_code == 200
+        assert r.json()["pruned"] >= 2
+        assert not await FcmToken.filter(token__in=["dead-token-2", "bad-token-2"]).exists()
+        assert await FcmToken.filter(token="live-token-2").exists()
+        assert notification_dispatcher.stats()["pruned"] >= pruned_before + 2
+
+        # The next run no longer sends to them
+        await client.get(f"{settings.API_V1_STR}/firebase/all", headers=superuser_token_headers)
+        assert stub.calls[-1] == await FcmToken.all().count()
+
+
+@pytest.mark.anyio
+async def test_invalid_argument_for_every_token_prunes_nothing() -> None:
+    await FcmToken.create(token="bad-token-3", user_id=await create_random_user())
+    dispatcher = NotificationDispatcher(batch_size=500, max_concurrent_batches=1, send_batch=StubFCM())
+    # Every token failing alike points at the message, not the tokens
+    report = await dispatcher.dispatch(notification_id="123456", tokens=["bad-token-3", "bad-token-4"])
+    assert report.failed == 2 and report.pruned == 0
+    assert await FcmToken.filter(token="bad-token-3").exists()
+
+
+async def reply(client: AsyncClient, headers: dict[str, str], notification_id: str, os: str) -> int:
+    r = await client.post(
+        f"{settings.API_V1_STR}/firebase/reply",
+        headers=headers,
+        json={"token": f"{os}-device-token-".ljust(40, "x"), "os": os, "notification_id": notification_id, "is_silent": True},
+    )
+    return r.status_code
+
+
+@pytest.mark.anyio
+async def test_round_trip_check_ends_on_acks(
+    client: AsyncClient, superuser_token_headers: dict[str, str], normal_user_token_headers: dict[str, str]
+) -> None:
+    await Service.get_or_create(name="Firebase", sub_name="Cloud Messaging")
+    await FcmToken.create(token="live-token-4", user_id=await create_random_user())
+    stub = StubFCM()
+    dispatcher = NotificationDispatcher(batch_size=500, max_concurrent_batches=1, send_batch=stub)
+    with patch.object(round_trip_monitor, "store", MemoryAckStore()), \
+            patch.object(round_trip_monitor, "dispatcher", dispatcher):
+        started = time.perf_counter()
+        check = asyncio.create_task(
+            client.get(f"{settings.API_V1_STR}/firebase/check-firebase", headers=superuser_token_headers)
+        )
+        while not stub.notification_ids:
+            await asyncio.sleep(0.01)
+        notification_id = stub.notification_ids[-1]
+        # Acks come in through /reply like they would on any worker
+        assert await reply(client, normal_user_token_headers, notification_id, "Android") == 200
+        assert await reply(client, normal_user_token_headers, notification_id, "iOS") == 200
+        r = await check
+        elapsed = time.perf_counter() - started
+        # Closed checks reject late acks
+        assert await reply(client, normal_user_token_headers, notification_id, "iOS") == 400
+
+    assert r.status_code == 200
+    report = r.json()
+    assert report["notification_id"] == notification_id
+    assert report["timed_out"] is False and report["missing"] == []
+    assert set(report["latency_ms"]) == {"Android", "iOS"}
+    assert elapsed < round_trip_monitor.timeout
+    await log_ingestor.flush()
+    logs = await Log.filter(content__contains=f"通知ID {notification_id}")
+    assert len(logs) == 2 and all(log.is_ok and log.elapsed_time is not None for log in logs)
+
+
+@pytest.mark.anyio
+async def test_round_trip_check_times_out() -> None:
+    await Service.get_or_create(name="Firebase", sub_name="Cloud Messaging")
+    store = MemoryAckStore()
+    stub = StubFCM()
+    monitor = RoundTripMonitor(
+        store=store,
+        dispatcher=NotificationDispatcher(batch_size=500, max_concurrent_batches=1, send_batch=stub),
+        timeout=0.3,
+        required_os=["Android", "iOS"],
+    )
+    # A second monitor on the same store stands in for the worker receiving the ack
+    other_worker = RoundTripMonitor(store=store, dispatcher=monitor.dispatcher, timeout=0.3, required_os=[])
+
+    async def android_answers() -> None:
+        while not stub.notification_ids:
+            await asyncio.sleep(0.01)
+        assert await other_worker.ack(notification_id=stub.notification_ids[-1], os="Android", token="a" * 40)
+
+    started = time.perf_counter()
+    report, _ = await asyncio.gather(monitor.check(["live-token-5"]), android_answers())
+    assert 0.3 <= time.perf_counter() - started < 1
+    assert report.timed_out and report.missing == ["iOS"]
+    assert list(report.latency_ms) == ["Android"]
+    assert monitor.stats()["timeouts"] == 1
+    assert monitor.stats()["round_trip"]["Android"]["count"] == 1
+    assert await store.acks(report.notification_id) == {}
+
+    await log_ingestor.flush()
+    timed_out = await Log.get(content__contains=f"通知ID {report.notification_id}] [iOS]")
+    assert timed_out.is_ok is False
+
+
+@pytest.mark.anyio
+@pytest.mark.filterwarnings("ignore:Message.token is deprecated")  # Recording 2100 warnings skews the timing
+async def test_dispatcher_batches_concurrently_without_blocking() -> None:
+    stub = StubFCM(latency=0.2)
+    dispatcher = NotificationDispatcher(batch_size=500, max_concurrent_batches=2, send_batch=stub)
+    tokens = [f"token-{i}" for i in range(2100)]
+
+    gaps = []
+    async def ticker() -> None:
+        last = time.perf_counter()
+        while True:
+            await asyncio.sleep(0.005)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+
+    ticking = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    report = await dispatcher.dispatch(notification_id="123456", tokens=tokens)
+    elapsed = time.perf_counter() - started
+    ticking.cancel()
+
+    assert [result.token for result in report.results] == tokens
+    assert report.sent == 2100
+    assert stub.calls == [500, 500, 500, 500, 100]
+    assert stub.max_in_flight == 2
+    # 5 batches two at a time is 3 rounds of latency, one call per token would be 2100
+    assert elapsed < 0.2 * 4
+    # A blocking send would stall the loop for a whole batch latency; allow for a GC pause
+    assert max(gaps) < stub.latency
+    assert dispatcher.stats()["batches"]["count"] == 5
@@ -1,10 +1,10 @@
 import pytest, jwt
 from httpx import AsyncClient
-from unittest.mock import patch, AsyncMock
+from unittest.mock import patch
 
 from app import crud, utils
 from app.core import security
-from app.models.db_models import User
+from app.models.db_models import EmailOutbox, User
 from app.models.user_models import UserCreate
 from app.utils import generate_utils_token
 from app.core.config import settings
@@ -51,6 +51,32 @@ async def test_get_access_token_inactive_user(client: AsyncClient) -> None:
     assert r.status_code == 400
     assert r.json() == {"detail": "Inactive user"}
 
+@pytest.mark.anyio
+async def test_get_access_token_hashing_pool_full(client: AsyncClient) -> None:
+    login_data = {
+        "username": settings.FIRST_SUPERUSER,
+        "password": settings.FIRST_SUPERUSER_PASSWORD,
+    }
+    with patch.object(security.hashing_pool, "max_in_flight", 0):
+        r = await client.post(f"{settings.API_V1_STR}/login/access-token", data=login_data)
+    assert r.status_code == 503
+    assert r.headers["Retry-After"] == "1"
+    assert r.json() == {"detail": "Server is busy, try again later"}
+
+@pytest.mark.anyio
+async def test_hashing_pool_counts_failures_apart() -> None:
+    pool = security.HashingPool(kind="thread", workers=1, max_in_flight=1)
+    try:
+        assert await pool.run(security.get_secret_hash, "secret")
+        with pytest.raises(ValueError):
+            await pool.run(security.verify_secret, "secret", "not a hash")
+        with patch.object(pool, "max_in_flight", 0), pytest.raises(security.HashingPoolFull):
+            await pool.run(security.get_secret_hash, "secret")
+    finally:
+        pool.shutdown()
+    stats = pool.stats()
+    assert (stats["completed"], stats["failed"], stats["rejected"], stats["in_flight"]) == (1, 1, 1, 0)
+
 # @pytest.mark.anyio
 # async def test_validate_totp(client: AsyncClient) -> None:
 #     email = random_email()
@@ -100,23 +126,27 @@ async def test_refresh_access_token(
 
 
 @pytest.mark.anyio
-async def test_recovery_password(client: AsyncClient) -> None:
+async def test_recovery_password(client: AsyncClient, emails_enabled: None) -> None:
     email = random_email()
     username = random_lower_string()
     password = random_lower_string()
     user_in = UserCreate(email=email, username=username, password=password)
     await crud.create_user(user_create=user_in)
 
-    mock_email_response = AsyncMock()
-    mock_email_response.status_code = 200
+    r = await client.post(
+        f"{settings.API_V1_STR}/password-recovery/{email}",
+    )
+    assert r.status_code == 200
+    assert r.json() == {"message": "Password recovery email sent"}
+    queued = await EmailOutbox.get(email_to=email)
+    assert queued.status == "pending"
+    assert "reset-password?token=" in queued.html_content
 
-    # Mock only the email sending function, skip the rest
-    with patch("app.utils.send_email", return_value=mock_email_response):  # Skipping actual email send
-        r = await client.post(
-            f"{settings.API_V1_STR}/password-recovery/{email}",
-        )
-        assert r.status_code == 200
-        assert r.json() == {"message": "Password recovery email sent"}
+@pytest.mark.anyio
+async def test_recovery_password_without_email_config(client: AsyncClient) -> None:
+    r = await client.post(f"{settings.API_V1_STR}/password-recovery/{settings.FIRST_SUPERUSER}")
+    assert r.status_code == 503
+    assert r.json() == {"detail": "Email is not configured"}
 
 @pytest.mark.anyio
 async def test_recovery_password_non_existing_user(client: AsyncClient) -> None:
@@ -162,21 +192,16 @@ async def test_set_up_password(client: AsyncClient) -> None:
     token = generate_utils_token(to_encode=settings.FIRST_SUPERUSER, action="setup")
     new_password = random_lower_string()
     data = {"token": token, "new_password": new_password}
-    mock_email_response = AsyncMock()
-    mock_email_response.status_code = 200
-
-    # Mock only the email sending function, skip the rest
-    with patch("app.utils.send_email", return_value=mock_email_response):  # Skipping actual email send
-        r = await client.post(
-            f"{settings.API_V1_STR}/setup-password",
-            json=data
-        )
-        assert r.status_code == 200
-        assert r.json() == {"message": "Password set up is successful"}
+    r = await client.post(
+        f"{settings.API_V1_STR}/setup-password",
+        json=data
+    )
+    assert r.status_code == 200
+    assert r.json() == {"message": "Password set up is successful"}
 
-        user = await User.get(email=settings.FIRST_SUPERUSER)
-        assert user
-        assert verify_secret(data["new_password"], user.hashed_password)
+    user = await User.get(email=settings.FIRST_SUPERUSER)
+    assert user
+    assert verify_secret(data["new_password"], user.hashed_password)
 
 @pytest.mark.anyio
 async def test_setup_password_invalid_token(client: AsyncClient) -> None:
@@ -1,11 +1,16 @@
-import pytest
+import pytest, re
+from datetime import datetime, timedelta
 from httpx import AsyncClient
+from unittest.mock import patch
+from tortoise import timezone as tz
 
-from app import crud
+from app import crud, retention, rollups
 from app.core.config import settings
-from app.models.db_models import Service
+from app.log_ingestion import LogEntry, log_ingestor
+from app.models.db_models import Service, Log, LogRollup
 from app.tests.utils.services import create_random_service 
-from app.tests.utils.utils import random_email, random_lower_string
+from app.tests.utils.user import create_user_and_login
+from app.tests.utils.utils import random_email, random_lower_string, count_queries
 
 
 
@@ -245,3 +250,512 @@ async def test_get_service_logs(
     assert r.status_code == 200
     service_response = r.json()
     service_response["logs"] == None
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path", ["", "/config"])
+async def test_get_service_single_query(
+    client: AsyncClient, superuser_token_headers: dict[str, str], path: str
+) -> None:
+    service_request = await create_random_service()
+    url = f"{settings.API_V1_STR}/services/{service_request.id}{path}"
+    await client.get(url, headers=superuser_token_headers)  # Warm the user cache
+
+    async with count_queries() as queries:
+        r = await client.get(url, headers=superuser_token_headers)
+    assert r.status_code == 200
+    assert len(queries) == 1
+
+@pytest.mark.anyio
+async def test_get_service_non_superuser_single_query(
+    client: AsyncClient
+) -> None:
+    user, headers = await create_user_and_login(client)
+    service_request = await create_random_service()
+    await user.services.add(service_request)
+    url = f"{settings.API_V1_STR}/services/{service_request.id}"
+    await client.get(url, headers=headers)  # Warm the user cache
+
+    async with count_queries() as queries:
+        r = await client.get(url, headers=headers)
+    assert r.status_code == 200
+    assert len(queries) == 1
+
+@pytest.mark.anyio
+async def test_get_service_non_associated_user(
+    client: AsyncClient
+) -> None:
+    _, headers = await create_user_and_login(client)
+    service_request = await create_random_service()
+    url = f"{settings.API_V1_STR}/services/{service_request.id}"
+    await client.get(url, headers=headers)  # Warm the user cache
+
+    async with count_queries() as queries:
+        r = await client.get(url, headers=headers)
+    assert r.status_code == 403
+    assert len(queries) == 1
+
+def service_lookups(queries: list[str]) -> list[str]:
+    # The service and the privilege check come in one statement, the rest are the route's own work
+    return [query for query in queries if re.match(r'SELECT .* FROM "services"', query)]
+
+@pytest.mark.anyio
+async def test_update_service_single_lookup(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    service_request = await create_random_service()
+    url = f"{settings.API_V1_STR}/services/{service_request.id}"
+    await client.get(url, headers=superuser_token_headers)  # Warm the user cache
+
+    async with count_queries() as queries:
+        r = await client.patch(url, headers=superuser_token_headers, json={"has_alert_notification": True})
+    assert r.status_code == 200
+    assert len(service_lookups(queries)) == 1
+    assert len(queries) == 2  # The lookup and the UPDATE
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("config, data", [
+    ("alert", {"mail_to": "ops@example.com"}),
+    ("publish", {"alert_publish_title": "Outage"}),
+])
+async def test_update_service_config_single_lookup(
+    client: AsyncClient, superuser_token_headers: dict[str, str], config: str, data: dict
+) -> None:
+    service_request = await create_random_service()
+    url = f"{settings.API_V1_STR}/services/{service_request.id}/config/{config}"
+    await client.put(url, headers=superuser_token_headers, json=data)  # Creates the config
+
+    async with count_queries() as queries:
+        r = await client.put(url, headers=superuser_token_headers, json=data)
+    assert r.status_code == 200
+    assert len(service_lookups(queries)) == 1
+    assert len(queries) == 3  # The lookup, then reading and updating the config
+
+@pytest.mark.anyio
+async def test_get_service_users_single_lookup(
+    client: AsyncClient
+) -> None:
+    user, headers = await create_user_and_login(client)
+    service_request = await create_random_service()
+    await user.services.add(service_request)
+    url = f"{settings.API_V1_STR}/services/{service_request.id}/users"
+    await client.get(url, headers=headers)  # Warm the user cache
+
+    async with count_queries() as queries:
+        r = await client.get(url, headers=headers)
+    assert r.status_code == 200
+    assert len(service_lookups(queries)) == 1
+    assert len(queries) == 2  # The lookup and the usernames
+
+@pytest.mark.anyio
+async def test_delete_service_single_lookup(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    service_request = await create_random_service()
+    url = f"{settings.API_V1_STR}/services/{service_request.id}"
+    await client.get(url, headers=superuser_token_headers)  # Warm the user cache
+
+    async with count_queries() as queries:
+        r = await client.delete(url, headers=superuser_token_headers)
+    assert r.status_code == 200
+    assert len(service_lookups(queries)) == 1
+    assert len(queries) == 2  # The lookup and the DELETE
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("method, path, data", [
+    ("PATCH", "", {"has_alert_notification": True}),
+    ("PUT", "/config/alert", {"mail_to": "ops@example.com"}),
+    ("PUT", "/config/publish", {"alert_publish_title": "Outage"}),
+])
+async def test_write_service_non_editor_single_query(
+    client: AsyncClient, method: str, path: str, data: dict
+) -> None:
+    user, headers = await create_user_and_login(client)
+    service_request = await create_random_service()
+    await user.services.add(service_request)
+    url = f"{settings.API_V1_STR}/services/{service_request.id}{path}"
+    await client.get(f"{settings.API_V1_STR}/services/{service_request.id}", headers=headers)  # Warm the user cache
+
+    async with count_queries() as queries:
+        r = await client.request(method, url, headers=headers, json=data)
+    assert r.status_code == 403
+    assert len(queries) == 1
+
+@pytest.mark.anyio
+async def test_update_service_non_editor(
+    client: AsyncClient
+) -> None:
+    user, headers = await create_user_and_login(client)
+    service_request = await create_random_service()
+    await user.services.add(service_request)
+    r = await client.patch(
+        f"{settings.API_V1_STR}/services/{service_request.id}",
+        headers=headers,
+        json={"has_alert_notification": True},
+        )
+    assert r.status_code == 403
+
+@pytest.mark.anyio
+async def test_get_service_logs_queries(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    service_request = await create_random_service()
+    url = f"{settings.API_V1_STR}/services/{service_request.id}/logs"
+    await client.get(url, headers=superuser_token_headers)  # Warm the user cache
+
+    async with count_queries() as queries:
+        r = await client.get(url, headers=superuser_token_headers)
+    assert r.status_code == 200
+    # One statement for the service and privileges, one for the page of logs
+    assert len(queries) == 2
+
+@pytest.mark.anyio
+async def test_get_service_logs_cursor_pagination(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    service_request = await create_random_service()
+    start = datetime(2025, 1, 1)
+    for minutes in range(5):
+        await Log.create(service=service_request, start_time=start + timedelta(minutes=minutes))
+    url = f"{settings.API_V1_STR}/services/{service_request.id}/logs"
+
+    r = await client.get(url, headers=superuser_token_headers, params={"limit": 3})
+    assert r.status_code == 200
+    first_page = r.json()
+    assert len(first_page["logs"]) == 3
+    assert first_page["logs"][0]["start_time"].startswith("2025-01-01T00:04:00")
+    assert first_page["next_cursor"]
+
+    r = await client.get(
+        url, 
+        headers=superuser_token_headers, 
+        params={"limit": 3, "cursor": first_page["next_cursor"]},
+        )
+    second_page = r.json()
+    assert [log["start_time"][:19] for log in second_page["logs"]] == [
+        "2025-01-01T00:01:00", "2025-01-01T00:00:00"
+    ]
+    assert second_page["next_cursor"] is None
+
+    r = await client.get(
+        url, 
+        headers=superuser_token_headers, 
+        params={"since": "2025-01-01T00:01:00", "until": "2025-01-01T00:03:00", "order": "asc"},
+        )
+    assert [log["start_time"][:19] for log in r.json()["logs"]] == [
+        "2025-01-01T00:01:00", "2025-01-01T00:02:00"
+    ]
+
+@pytest.mark.anyio
+async def test_get_service_logs_invalid_cursor(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    service_request = await create_random_service()
+    r = await client.get(
+        f"{settings.API_V1_STR}/services/{service_request.id}/logs",
+        headers=superuser_token_headers,
+        params={"cursor": "not-a-cursor"},
+        )
+    assert r.status_code == 400
+
+@pytest.mark.anyio
+async def test_create_service_logs_bulk(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    service_request = await create_random_service()
+    start = datetime(2025, 1, 1)
+    data = {
+        "logs": [
+            {
+                "service_name": service_request.name,
+                "service_sub_name": service_request.sub_name,
+                "start_time": (start + timedelta(minutes=i)).isoformat(),
+                "end_time": (start + timedelta(minutes=i, seconds=2)).isoformat(),
+                "is_ok": i % 2 == 0,
+            }
+            for i in range(300)
+        ]
+    }
+    r = await client.post(
+        f"{settings.API_V1_STR}/services/logs/bulk",
+        headers=superuser_token_headers,
+        json=data,
+        )
+    assert r.status_code == 202
+
+    await log_ingestor.flush()
+    logs = await Log.filter(service_id=service_request.id)
+    assert len(logs) == 300
+    assert all(log.elapsed_time == 2 for log in logs)
+
+@pytest.mark.anyio
+async def test_update_service_invalidates_service_id_cache(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    service_request = await create_random_service()
+    key = (service_request.name, service_request.sub_name)
+    assert await log_ingestor.resolve_service_ids({key}) == {key: service_request.id}
+    assert log_ingestor.service_ids.get(key) == service_request.id
+
+    r = await client.patch(
+        f"{settings.API_V1_STR}/services/{service_request.id}",
+        headers=superuser_token_headers,
+        json={"has_alert_notification": True},
+        )
+    assert r.status_code == 200
+    assert log_ingestor.service_ids.get(key) is None
+
+@pytest.mark.anyio
+async def test_create_service_logs_bulk_unknown_service(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    data = {"logs": [{"service_name": random_lower_string(), "service_sub_name": random_lower_string()}]}
+    r = await client.post(
+        f"{settings.API_V1_STR}/services/logs/bulk",
+        headers=superuser_token_headers,
+        json=data,
+        )
+    assert r.status_code == 404
+
+@pytest.mark.anyio
+async def test_create_service_logs_bulk_unknown_service_is_not_revealed(
+    client: AsyncClient
+) -> None:
+    service_request = await create_random_service()
+    for can_edit in (False, True):
+        user, headers = await create_user_and_login(client)
+        user.can_edit = can_edit
+        await user.save()
+        await user.services.add(service_request)
+        unknown = random_lower_string()
+        data = {"logs": [
+            {"service_name": service_request.name, "service_sub_name": service_request.sub_name},
+            {"service_name": unknown, "service_sub_name": unknown},
+        ]}
+        r = await client.post(f"{settings.API_V1_STR}/services/logs/bulk", headers=headers, json=data)
+        assert r.status_code == 403
+        assert unknown not in r.text
+
+@pytest.mark.anyio
+async def test_create_service_logs_bulk_non_associated_user(
+    client: AsyncClient, normal_user_token_headers: dict[str, str]
+) -> None:
+    service_request = await create_random_service()
+    data = {"logs": [{"service_name": service_request.name, "service_sub_name": service_request.sub_name}]}
+    r = await client.post(
+        f"{settings.API_V1_STR}/services/logs/bulk",
+        headers=normal_user_token_headers,
+        json=data,
+        )
+    assert r.status_code == 403
+
+@pytest.mark.anyio
+async def test_get_service_stats_from_rollups(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    service_request = await create_random_service()
+    start = tz.now() - timedelta(hours=3)
+    await log_ingestor.enqueue([
+        LogEntry(
+            service_id=service_request.id,
+            start_time=start + timedelta(minutes=i),
+            end_time=start + timedelta(minutes=i, seconds=1 if i < 90 else 10),
+            is_ok=i % 10 != 0,
+        )
+        for i in range(100)
+    ])
+    await log_ingestor.flush()
+    url = f"{settings.API_V1_STR}/services/{service_request.id}/stats"
+    await client.get(url, headers=superuser_token_headers)  # Warm the user cache
+
+    async with count_queries() as queries:
+        r = await client.get(url, headers=superuser_token_headers, params={"window": "24h"})
+    assert r.status_code == 200
+    assert not any(re.search(r"\bservice_logs\b", query) for query in queries)
+    stats = r.json()
+    assert stats["source"] == "hourly"
+    assert stats["count"] == 100
+    assert stats["failures"] == 10
+    assert stats["uptime"] == 0.9
+    assert stats["elapsed_min"] == 1
+    assert stats["elapsed_max"] == 10
+    assert stats["elapsed_mean"] == pytest.approx(1.9)
+    assert 0.8 <= stats["elapsed_p50"] <= 1.25
+    assert 8 <= stats["elapsed_p95"] <= 10
+
+@pytest.mark.anyio
+async def test_rollup_backfill_matches_live_rollups(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    service_request = await create_random_service()
+    start = tz.now() - timedelta(days=3)
+    await log_ingestor.enqueue([
+        LogEntry(
+            service_id=service_request.id,
+            start_time=start + timedelta(minutes=30 * i),
+            end_time=start + timedelta(minutes=30 * i, seconds=i),
+            is_ok=i % 3 != 0,
+        )
+        for i in range(20)
+    ])
+    await log_ingestor.flush()
+    live = await LogRollup.filter(service_id=service_request.id).order_by("period", "bucket_start").values()
+
+    # A stale rollup past the last log, and pages smaller than a bucket
+    await LogRollup.create(
+        service_id=service_request.id,
+        period="hour",
+        bucket_start=rollups.bucket_start(start + timedelta(hours=20), "hour"),
+        count=7,
+    )
+    await rollups.backfill(service_id=service_request.id, page_size=3)
+    rebuilt = await LogRollup.filter(service_id=service_request.id).order_by("period", "bucket_start").values()
+    strip = lambda rows: [{k: v for k, v in row.items() if k != "id"} for row in rows]
+    assert strip(rebuilt) == strip(live)
+
+@pytest.mark.anyio
+async def test_rollup_backfill_keeps_rollups_of_archived_logs(
+    client: AsyncClient, tmp_path
+) -> None:
+    service_request = await create_random_service()
+    service_request.log_retention_days = 30
+    await service_request.save()
+    now = tz.now()
+    await log_ingestor.enqueue([
+        LogEntry(service_id=service_request.id, start_time=now - timedelta(days=days, hours=1), is_ok=True)
+        for days in (60, 45, 10, 2)
+    ])
+    await log_ingestor.flush()
+    live = await LogRollup.filter(service_id=service_request.id, period="day").order_by("bucket_start").values()
+
+    with patch.object(settings, "LOG_ARCHIVE_DIR", str(tmp_path)):
+        assert await retention.retention_engine.run_once() >= 2
+    await rollups.backfill(service_id=service_request.id)
+
+    rebuilt = await LogRollup.filter(service_id=service_request.id, period="day").order_by("bucket_start").values()
+    strip = lambda rows: [{k: v for k, v in row.items() if k != "id"} for row in rows]
+    assert strip(rebuilt) == strip(live)
+    stats, _ = await rollups.get_stats(service_id=service_request.id, window="90d")
+    assert stats.count == 4
+
+@pytest.mark.anyio
+async def test_get_services_overview(
+    client: AsyncClient
+) -> None:
+    user, headers = await create_user_and_login(client)
+    service_request = await create_random_service()
+    await create_random_service()  # Not visible to the user
+    await user.services.add(service_request)
+    start = tz.now() - timedelta(minutes=10)
+    await log_ingestor.enqueue([
+        LogEntry(
+            service_id=service_request.id,
+            start_time=start + timedelta(minutes=i),
+            end_time=start + timedelta(minutes=i, seconds=2),
+            is_ok=i < 2,
+        )
+        for i in range(5)
+    ])
+    # Late arrival must not overwrite the latest state
+    await log_ingestor.enqueue([LogEntry(service_id=service_request.id, start_time=start, is_ok=True)])
+    await log_ingestor.flush()
+    url = f"{settings.API_V1_STR}/services/overview"
+    await client.get(url, headers=headers)  # Warm the user cache
+
+    async with count_queries() as queries:
+        r = await client.get(url, headers=headers)
+    assert r.status_code == 200
+    assert len(queries) == 1
+    overview = r.json()
+    assert overview["count"] == 1
+    status = overview["data"][0]["status"]
+    assert overview["data"][0]["id"] == str(service_request.id)
+    assert status["last_is_ok"] is False
+    assert status["last_elapsed_time"] == 2
+    assert status["consecutive_failures"] == 3
+
+@pytest.mark.anyio
+async def test_retention_archives_and_restores_logs(
+    client: AsyncClient, tmp_path
+) -> None:
+    service_request = await create_random_service()
+    service_request.log_retention_days = 7
+    await service_request.save()
+    now = tz.now()
+    expired = [
+        await Log.create(service=service_request, start_time=now - timedelta(days=10, minutes=i), content=f"old {i}")
+        for i in range(3)
+    ]
+    recent = await Log.create(service=service_request, start_time=now - timedelta(days=1))
+
+    with patch.object(settings, "LOG_ARCHIVE_DIR", str(tmp_path)):
+        archived = await retention.retention_engine.run_once()
+        assert archived >= 3
+        remaining = await Log.filter(service_id=service_request.id).values_list("id", flat=True)
+        assert remaining == [recent.id]
+        assert list(tmp_path.glob(f"{service_request.id}/*/*.ndjson.gz"))
+
+        restored = await retention.restore(service_id=service_request.id)
+        assert restored == 3
+        assert await retention.restore(service_id=service_request.id) == 0
+
+    logs = await Log.filter(id__in=[log.id for log in expired]).order_by("id")
+    assert [log.content for log in logs] == [log.content for log in expired]
+
+@pytest.mark.anyio
+async def test_retention_of_logs_without_start_time(
+    client: AsyncClient, tmp_path
+) -> None:
+    service_request = await create_random_service()
+    service_request.log_retention_days = 1
+    await service_request.save()
+    now = tz.now()
+    expired = await Log.create(service=service_request, start_time=now - timedelta(days=2))
+    ended = await Log.create(service=service_request, end_time=now - timedelta(days=2))
+    recent = await Log.create(service=service_request, end_time=now - timedelta(hours=1))
+    undated = await Log.create(service=service_request)
+
+    with patch.object(settings, "LOG_ARCHIVE_DIR", str(tmp_path)):
+        await retention.retention_engine.run_once()
+        remaining = await Log.filter(service_id=service_request.id).order_by("id").values_list("id", flat=True)
+        assert remaining == [recent.id, undated.id]  # Undated: no age to go by, kept
+
+        assert await retention.restore(service_id=service_request.id) == 2
+    assert await Log.filter(id__in=[expired.id, ended.id]).count() == 2
+
+@pytest.mark.anyio
+async def test_retention_splits_archives_by_day(
+    client: AsyncClient, tmp_path
+) -> None:
+    service_request = await create_random_service()
+    midnight = tz.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=400)
+    await Log.create(service=service_request, start_time=midnight - timedelta(minutes=1))
+    after = await Log.create(service=service_request, start_time=midnight + timedelta(minutes=1))
+    days = [(midnight - timedelta(days=1)).strftime("%Y%m%d"), midnight.strftime("%Y%m%d")]
+
+    with patch.object(settings, "LOG_ARCHIVE_DIR", str(tmp_path)):
+        await retention.retention_engine.run_once()
+        assert not await Log.filter(service_id=service_request.id).exists()
+        assert [path.parent.name for path in sorted(tmp_path.glob(f"{service_request.id}/*/*.ndjson.gz"))] == days
+        assert await retention.restore(service_id=service_request.id, day=days[1]) == 1
+    assert await Log.filter(service_id=service_request.id).values_list("id", flat=True) == [after.id]
+
+@pytest.mark.anyio
+async def test_retention_skips_services_leased_by_another_worker(
+    client: AsyncClient, tmp_path
+) -> None:
+    service_request = await create_random_service()
+    log = await Log.create(service=service_request, start_time=tz.now() - timedelta(days=400))
+    other_worker = retention.RetentionEngine(batch_size=10, interval=3600, lease=600)
+    assert await other_worker._claim(service_request.id, None)
+
+    with patch.object(settings, "LOG_ARCHIVE_DIR", str(tmp_path)):
+        skipped = retention.retention_engine.skipped_services
+        await retention.retention_engine.run_once()
+        assert retention.retention_engine.skipped_services == skipped + 1
+        assert await Log.exists(id=log.id)
+
+        await Service.filter(id=service_request.id).update(retention_lease_until=tz.now() - timedelta(seconds=1))
+        await retention.retention_engine.run_once()  # The lease ran out
+        assert not await Log.exists(id=log.id)
+    service = await Service.get(id=service_request.id)
+    assert service.retention_lease_until is None
@@ -1,13 +1,17 @@
-import uuid
+import asyncio, json, uuid
+import httpx
 import pytest
 from httpx import AsyncClient
+from tortoise import timezone as tz
 from unittest.mock import patch, AsyncMock
 
-from app import crud
-from app.models.db_models import User
+from app import crud, email_outbox
+from app.core.mailer import Mailer
+from app.models.db_models import EmailOutbox, User
+from app.core.cache import user_cache
 from app.core.config import settings
 from app.core.security import verify_secret
-from app.tests.utils.user import create_random_user
+from app.tests.utils.user import create_random_user, create_user_and_login
 from app.tests.utils.services import create_random_service
 from app.tests.utils.utils import random_email, random_lower_string, random_integer
 
@@ -78,27 +82,165 @@ async def test_get_existing_user_permissions_error(
 
 @pytest.mark.anyio
 async def test_register_user(
-    client: AsyncClient, superuser_token_headers: dict
+    client: AsyncClient, superuser_token_headers: dict, emails_enabled: None
 ) -> None:
     email = random_email()
     username = random_lower_string()
 
     data = {"email": email, "username": username}
 
-    mock_email_response = AsyncMock()
-    mock_email_response.status_code = 200
-    # Mock only the email sending function, skip the rest
-    with patch("app.utils.send_email", return_value=mock_email_response):  # Skipping actual email send
-        r = await client.post(
-            f"{settings.API_V1_STR}/users/adduser", 
-            headers=superuser_token_headers, 
-            json=data
-        )
-        assert 200 <= r.status_code < 300
-        created_user = await User.get(email=email)
-        assert created_user is not None
-        assert created_user.email == email
-        assert created_user.username == username
+    r = await client.post(
+        f"{settings.API_V1_STR}/users/adduser", 
+        headers=superuser_token_headers, 
+        json=data
+    )
+    assert 200 <= r.status_code < 300
+    created_user = await User.get(email=email)
+    assert created_user is not None
+    assert created_user.email == email
+    assert created_user.username == username
+    assert await EmailOutbox.exists(email_to=email)
+
+@pytest.mark.anyio
+async def test_register_user_queues_email(
+    client: AsyncClient, superuser_token_headers: dict, emails_enabled: None
+) -> None:
+    email = random_email()
+    data = {"email": email, "username": random_lower_string()}
+    with patch.object(email_outbox.mailer, "send", AsyncMock()) as send:
+        r = await client.post(f"{settings.API_V1_STR}/users/adduser", headers=superuser_token_headers, json=data)
+    assert r.status_code == 200
+    assert r.json() == {"message": "Password set up email sent"}
+    # Committed with the user, nothing sent while the request was open
+    send.assert_not_awaited()
+    queued = await EmailOutbox.get(email_to=email)
+    assert queued.status == "pending"
+    assert "setup-password?token=" in queued.html_content
+
+
+@pytest.mark.anyio
+async def test_register_user_without_email_config(
+    client: AsyncClient, superuser_token_headers: dict
+) -> None:
+    email = random_email()
+    data = {"email": email, "username": random_lower_string()}
+    r = await client.post(f"{settings.API_V1_STR}/users/adduser", headers=superuser_token_headers, json=data)
+    assert r.status_code == 503
+    assert r.json() == {"detail": "Email is not configured"}
+    # Nothing committed: the user could never have set a password
+    assert not await User.exists(email=email)
+    assert not await EmailOutbox.exists(email_to=email)
+
+
+@pytest.mark.anyio
+async def test_email_outbox_retries(client: AsyncClient, emails_enabled: None) -> None:
+    calls: dict[str, int] = {}
+
+    def sendgrid_stub(request: httpx.Request) -> httpx.Response:
+        to = json.loads(request.content)["personalizations"][0]["to"][0]["email"]
+        calls[to] = calls.get(to, 0) + 1
+        if to.startswith("flaky") and calls[to] == 1:
+            return httpx.Response(503, text="try later")
+        if to.startswith("rejected"):
+            return httpx.Response(400, text="bad address")
+        return httpx.Response(202)
+
+    mailer = Mailer(
+        api_url="http://sendgrid.test/v3/mail/send", api_key="key", from_email="from@example.com",
+        max_connections=2, timeout=5, transport=httpx.MockTransport(sendgrid_stub),
+    )
+    worker = email_outbox.EmailOutboxWorker(mailer=mailer, batch_size=10, poll_interval=60, max_attempts=3, backoff=0)
+    flaky = await email_outbox.enqueue_email(email_to=f"flaky-{random_email()}", subject="s", html_content="<p>1</p>")
+    rejected = await email_outbox.enqueue_email(email_to=f"rejected-{random_email()}", subject="s", html_content="<p>2</p>")
+
+    await worker.run_once()
+    await flaky.refresh_from_db()
+    await rejected.refresh_from_db()
+    assert (flaky.status, flaky.attempts) == ("pending", 1)
+    assert flaky.last_error == "503: try later"
+    assert (rejected.status, rejected.attempts) == ("failed", 1)  # 4xx is not retried
+
+    await worker.run_once()
+    await flaky.refresh_from_db()
+    assert (flaky.status, flaky.attempts) == ("sent", 2)
+    assert flaky.sent_at is not None and flaky.last_error is None
+    assert flaky.html_content == ""  # Links in it are live, not kept once sent
+    assert calls[flaky.email_to] == 2 and calls[rejected.email_to] == 1
+    await mailer.close()
+
+
+@pytest.mark.anyio
+async def test_email_outbox_bounds_concurrency_and_send_time(client: AsyncClient, emails_enabled: None) -> None:
+    active = peak = 0
+
+    async def sendgrid_stub(request: httpx.Request) -> httpx.Response:
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        try:
+            hang = json.loads(request.content)["personalizations"][0]["to"][0]["email"].startswith("hang")
+            await asyncio.sleep(10 if hang else 0.01)
+        finally:
+            active -= 1
+        return httpx.Response(202)
+
+    mailer = Mailer(
+        api_url="http://sendgrid.test/v3/mail/send", api_key="key", from_email="from@example.com",
+        max_connections=3, timeout=0.1, transport=httpx.MockTransport(sendgrid_stub),
+    )
+    worker = email_outbox.EmailOutboxWorker(mailer=mailer, batch_size=20, poll_interval=60, max_attempts=3, backoff=60)
+    hanging = await email_outbox.enqueue_email(email_to=f"hang-{random_email()}", subject="s", html_content="<p>h</p>")
+    queued = [
+        await email_outbox.enqueue_email(email_to=random_email(), subject="s", html_content=f"<p>{i}</p>") for i in range(10)
+    ]
+    await worker.run_once()
+    assert peak <= 3
+
+    await hanging.refresh_from_db()
+    assert (hanging.status, hanging.attempts) == ("pending", 1)
+    assert hanging.last_error == "No response within 0.15s"
+    for email in queued:
+        await email.refresh_from_db()
+        assert email.status == "sent"
+    await mailer.close()
+
+
+@pytest.mark.anyio
+async def test_email_outbox_retries_unexpected_errors(client: AsyncClient, emails_enabled: None) -> None:
+    async def send(*, email_to: str, **_) -> int:
+        if email_to.startswith("broken"):
+            raise RuntimeError("boom")
+        return 202
+
+    broken = await email_outbox.enqueue_email(email_to=f"broken-{random_email()}", subject="s", html_content="<p>b</p>")
+    fine = await email_outbox.enqueue_email(email_to=random_email(), subject="s", html_content="<p>f</p>")
+    worker = email_outbox.EmailOutboxWorker(mailer=email_outbox.mailer, batch_size=10, poll_interval=60, max_attempts=3, backoff=60)
+    with patch.object(email_outbox.mailer, "send", send):
+        await worker.run_once()
+    await broken.refresh_from_db()
+    await fine.refresh_from_db()
+    assert (broken.status, broken.attempts, broken.last_error) == ("pending", 1, "RuntimeError: boom")
+    assert broken.next_attempt_at > tz.now()  # Retried after the backoff
+    assert fine.status == "sent"
+
+
+@pytest.mark.anyio
+async def test_email_outbox_claims_once(client: AsyncClient, emails_enabled: None) -> None:
+    sent: list[str] = []
+
+    async def send(*, email_to: str, **_) -> int:
+        await asyncio.sleep(0.01)
+        sent.append(email_to)
+        return 202
+
+    queued = await email_outbox.enqueue_email(email_to=random_email(), subject="s", html_content="<p>x</p>")
+    workers = [
+        email_outbox.EmailOutboxWorker(mailer=email_outbox.mailer, batch_size=10, poll_interval=60, max_attempts=3, backoff=0)
+        for _ in range(3)
+    ]
+    with patch.object(email_outbox.mailer, "send", send):
+        await asyncio.gather(*(worker.run_once() for worker in workers))
+    assert sent.count(queued.email_to) == 1
 
 @pytest.mark.anyio
 async def test_register_user_permission_error(
@@ -108,17 +250,13 @@ async def test_register_user_permission_error(
 
     data = {"email": username}
 
-    mock_email_response = AsyncMock()
-    mock_email_response.status_code = 200
-    # Mock only the email sending function, skip the rest
-    with patch("app.utils.send_email", return_value=mock_email_response):  # Skipping actual email send
-        r = await client.post(
-            f"{settings.API_V1_STR}/users/adduser", 
-            headers=normal_user_token_headers, 
-            json=data
-        )
-        assert r.status_code == 403
-        assert r.json() == {"detail": "The user doesn't have enough privileges"}
+    r = await client.post(
+        f"{settings.API_V1_STR}/users/adduser", 
+        headers=normal_user_token_headers, 
+        json=data
+    )
+    assert r.status_code == 403
+    assert r.json() == {"detail": "The user doesn't have enough privileges"}
 
 @pytest.mark.anyio
 async def test_register_user_existing_username(
@@ -127,19 +265,15 @@ async def test_register_user_existing_username(
     user = await create_random_user()
     data = {"email": user.email, "username": user.username}
 
-    mock_email_response = AsyncMock()
-    mock_email_response.status_code = 200
-
-    # Mock only the email sending function, skip the rest
-    with patch("app.utils.send_email", return_value=mock_email_response):  # Skipping actual email send
-        r = await client.post(
-            f"{settings.API_V1_STR}/users/adduser", 
-            headers=superuser_token_headers, 
-            json=data
-        )
+    r = await client.post(
+        f"{settings.API_V1_STR}/users/adduser", 
+        headers=superuser_token_headers, 
+        json=data
+    )
     created_user = r.json()
     assert r.status_code == 400
     assert "_id" not in created_user
+    assert not await EmailOutbox.exists(email_to=user.email)
 
 @pytest.mark.anyio
 async def test_register_user_normal_user(
@@ -148,16 +282,11 @@ async def test_register_user_normal_user(
     user = await create_random_user()
     data = {"email": user.email}
 
-    mock_email_response = AsyncMock()
-    mock_email_response.status_code = 200
-
-    # Mock only the email sending function, skip the rest
-    with patch("app.utils.send_email", return_value=mock_email_response):  # Skipping actual email send
-        r = await client.post(
-            f"{settings.API_V1_STR}/users/adduser", 
-            headers=normal_user_token_headers, 
-            json=data
-        )
+    r = await client.post(
+        f"{settings.API_V1_STR}/users/adduser", 
+        headers=normal_user_token_headers, 
+        json=data
+    )
     assert r.status_code == 403
 
 @pytest.mark.anyio
@@ -403,3 +532,33 @@ async def test_add_services_to_user(
 
     services = r.json()
     assert sorted(data["added_services"]) == sorted([service["id"] for service in services])
+
+@pytest.mark.anyio
+async def test_current_user_is_cached(
+    client: AsyncClient, normal_user_token_headers: dict[str, str]
+) -> None:
+    await client.get(f"{settings.API_V1_STR}/users/me", headers=normal_user_token_headers)
+    hits = user_cache.hits
+    r = await client.get(f"{settings.API_V1_STR}/users/me", headers=normal_user_token_headers)
+    assert r.status_code == 200
+    assert user_cache.hits == hits + 1
+
+@pytest.mark.anyio
+async def test_update_user_invalidates_cached_user(
+    client: AsyncClient, superuser_token_headers: dict[str, str]
+) -> None:
+    user, headers = await create_user_and_login(client)
+    r = await client.get(f"{settings.API_V1_STR}/users/me", headers=headers)
+    assert r.status_code == 200
+
+    data = {"username": random_lower_string(), "is_active": "false"}
+    r = await client.patch(
+        f"{settings.API_V1_STR}/users/{user.id}",
+        headers=superuser_token_headers,
+        json=data,
+    )
+    assert r.status_code == 200
+
+    r = await client.get(f"{settings.API_V1_STR}/users/me", headers=headers)
+    assert r.status_code == 400
+    assert r.json()["detail"] == "Inactive user"
@@ -0,0 +1,55 @@
+import os, time
+from pathlib import Path
+
+from jinja2 import Template
+
+from app import utils
+
+CONTEXT = {
+    "project_name": "Monitoring",
+    "username": "operator",
+    "email": "operator@example.com",
+    "valid_time": 30,
+    "link": "http://localhost:5173/reset-password?token=abc",
+}
+
+
+def render_from_disk(template_name: str) -> str:
+    # How render_email_template worked before: read and compile on every email
+    return Template((utils.EMAIL_TEMPLATES_DIR / template_name).read_text()).render(CONTEXT)
+
+
+def test_email_templates_render_like_before() -> None:
+    template_names = sorted(path.name for path in utils.EMAIL_TEMPLATES_DIR.glob("*.html"))
+    assert template_names == sorted(utils.email_templates.list_templates())
+    for template_name in template_names:
+        assert utils.render_email_template(template_name=template_name, context=CONTEXT) == render_from_disk(template_name)
+
+
+def test_email_template_render_cost() -> None:
+    rounds = 200
+    started = time.perf_counter()
+    for _ in range(rounds):
+        render_from_disk("reset_password.html")
+    before = (time.perf_counter() - started) / rounds
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        utils.render_email_template(template_name="reset_password.html", context=CONTEXT)
+    after = (time.perf_counter() - started) / rounds
+
+    # Compiling dominated the cost per email
+    assert after * 10 < before
+
+
+def test_email_templates_reload_when_edited(tmp_path: Path) -> None:
+    template = tmp_path / "hello.html"
+    template.write_text("Hello {{ username }}")
+    reloading = utils.create_email_environment(tmp_path, auto_reload=True)
+    fixed = utils.create_email_environment(tmp_path, auto_reload=False)
+
+    template.write_text("Goodbye {{ username }}!")
+    later = time.time() + 5  # Jinja compares mtimes
+    os.utime(template, (later, later))
+    assert reloading.get_template("hello.html").render(CONTEXT) == "Goodbye operator!"
+    assert fixed.get_template("hello.html").render(CONTEXT) == "Hello operator"
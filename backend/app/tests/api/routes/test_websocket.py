@@ -0,0 +1,406 @@
+import pytest, asyncio, json, time
+from fastapi import WebSocketDisconnect, status
+from httpx import AsyncClient
+from types import SimpleNamespace
+from typing import Callable, Iterator
+from unittest.mock import AsyncMock, patch
+from uuid import uuid4
+from websockets.frames import Frame, Opcode
+
+from app import ai
+from app.ai_usage import UsageRecorder
+from app.api.routes.websocket import MuxSession, send_ai_response, websocket_openai
+from app.core.config import settings
+from app.models.db_models import AiUsage
+from app.tests.utils.ai import FakeOpenAI
+from app.tests.utils.user import create_random_user
+from app.tests.utils.utils import count_queries
+
+
+class Socket:
+    """
+    Collects the frames sent and serialises them the way uvicorn's websockets protocol
+    puts them on the wire, so bytes and CPU match what the server pays per frame.
+    """
+
+    def __init__(self) -> None:
+        self.frames: list[str] = []
+        self.bytes_sent = 0
+
+    async def send_text(self, text: str) -> None:
+        self.frames.append(text)
+        self.bytes_sent += len(Frame(Opcode.TEXT, text.encode()).serialize(mask=False, extensions=[]))
+
+
+@pytest.fixture(autouse=True)
+def empty_response_cache() -> None:
+    ai.response_cache.answers.clear()
+
+
+@pytest.fixture(autouse=True)
+def recorder() -> Iterator[UsageRecorder]:
+    # Fresh counters per test, no quota unless a test sets one
+    recorder = UsageRecorder(flush_interval=60, daily_quota=0)
+    with patch("app.api.routes.websocket.usage_recorder", recorder):
+        yield recorder
+
+
+async def relay(mode: str, fake: FakeOpenAI, message: str = "hello") -> tuple[Socket, float]:
+    socket = Socket()
+    with patch("app.ai.get_openai_client", return_value=fake):
+        started = time.process_time()
+        await send_ai_response(socket.send_text, message, mode)
+        return socket, time.process_time() - started
+
+
+@pytest.mark.anyio
+async def test_full_mode_sends_the_growing_answer() -> None:
+    socket, _ = await relay("full", FakeOpenAI(tokens=3))
+    assert socket.frames == ["word ", "word word ", "word word word "]
+
+
+@pytest.mark.anyio
+async def test_delta_mode_sends_pieces_then_done() -> None:
+    socket, _ = await relay("delta", FakeOpenAI(tokens=3, token="答え "))
+    frames = [json.loads(frame) for frame in socket.frames]
+    assert frames == [{"type": "delta", "content": "答え "}] * 3 + [{"type": "done"}]
+    assert "".join(frame.get("content", "") for frame in frames) == "答え 答え 答え "
+
+
+@pytest.mark.anyio
+async def test_delta_mode_bytes_and_cpu_per_response() -> None:
+    # A 2,000 token answer
+    full, full_cpu = await relay("full", FakeOpenAI(tokens=2000), "first question")
+    delta, delta_cpu = await relay("delta", FakeOpenAI(tokens=2000), "second question")
+    assert full.frames[-1] == "".join(json.loads(frame).get("content", "") for frame in delta.frames)
+    # Full mode is quadratic: ~10 MB for a ~10 kB answer, delta mode stays linear
+    assert full.bytes_sent > 2000 * 2001 // 2 * len("word ")
+    assert delta.bytes_sent < 2001 * (len('{"type":"delta","content":"word "}') + 2)
+    assert delta.bytes_sent * 100 < full.bytes_sent
+    # Server CPU is mostly per frame overhead, the same frame count in both modes:
+    # the JSON envelope must not cost more than the copies full mode does
+    assert delta_cpu < full_cpu * 1.5
+
+
+class MuxSocket:
+    """
+    Client side of a mux connection: frames queued by the test, frames sent back decoded.
+    """
+
+    def __init__(self) -> None:
+        self.incoming: asyncio.Queue[str | None] = asyncio.Queue()
+        self.frames: list[dict] = []
+
+    async def receive_text(self) -> str:
+        raw = await self.incoming.get()
+        if raw is None:
+            raise WebSocketDisconnect()
+        return raw
+
+    async def send_text(self, text: str) -> None:
+        self.frames.append(json.loads(text))
+
+    def send(self, **frame: str) -> None:
+        self.incoming.put_nowait(json.dumps(frame))
+
+    def of(self, request_id: str) -> list[dict]:
+        return [frame for frame in self.frames if frame["id"] == request_id]
+
+    def last_type(self, request_id: str) -> str | None:
+        frames = self.of(request_id)
+        return frames[-1]["type"] if frames else None
+
+
+async def until(predicate: Callable[[], bool], timeout: float = 2.0) -> None:
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        assert time.perf_counter() < deadline, "Timed out"
+        await asyncio.sleep(0.005)
+
+
+@pytest.fixture
+def fake_openai() -> Iterator[FakeOpenAI]:
+    fake = FakeOpenAI(tokens=10, delay=0.02)
+    with patch("app.ai.get_openai_client", return_value=fake):
+        yield fake
+
+
+@pytest.mark.anyio
+async def test_mux_answers_prompts_concurrently(fake_openai: FakeOpenAI) -> None:
+    socket = MuxSocket()
+    session = asyncio.create_task(MuxSession(socket, uuid4()).run())
+    started = time.perf_counter()
+    for request_id in ("a", "b", "c"):
+        socket.send(type="prompt", id=request_id, content=f"question {request_id}")
+    await until(lambda: all(socket.last_type(request_id) == "done" for request_id in "abc"))
+    # One answer takes 0.2s, three in a row would take 0.6s
+    assert time.perf_counter() - started < 0.4
+    for request_id in "abc":
+        assert "".join(frame.get("content", "") for frame in socket.of(request_id)) == "word " * 10
+    assert {socket.frames[i]["id"] for i in range(3)} == {"a", "b", "c"}  # Interleaved
+    socket.incoming.put_nowait(None)
+    await session
+
+
+@pytest.mark.anyio
+async def test_mux_cancel_aborts_upstream(fake_openai: FakeOpenAI) -> None:
+    fake_openai.tokens = 1000
+    socket = MuxSocket()
+    session = asyncio.create_task(MuxSession(socket, uuid4()).run())
+    socket.send(type="prompt", id="long", content="tell me everything")
+    await until(lambda: socket.last_type("long") == "delta")
+    fake_openai.tokens = 10
+    socket.send(type="prompt", id="short", content="hi")
+    await until(lambda: socket.of("short"))
+    socket.send(type="cancel", id="long")
+    await until(lambda: socket.last_type("long") == "cancelled", timeout=0.5)
+    assert fake_openai.streams[0].closed
+    deltas = len(socket.of("long"))
+    # The other prompt carries on
+    await until(lambda: socket.last_type("short") == "done")
+    assert len(socket.of("long")) == deltas
+    await until(lambda: ai.prompt_limiter.stats()["in_flight"] == 0)
+    socket.incoming.put_nowait(None)
+    await session
+
+
+@pytest.mark.anyio
+async def test_mux_caps_prompts_per_user(fake_openai: FakeOpenAI) -> None:
+    user_id = uuid4()
+    first, second = MuxSocket(), MuxSocket()
+    sessions = [asyncio.create_task(MuxSession(socket, user_id).run()) for socket in (first, second)]
+    with patch.object(ai.prompt_limiter, "max_per_user", 2):
+        first.send(type="prompt", id="a", content="one")
+        second.send(type="prompt", id="b", content="two")
+        await until(lambda: first.of("a") and second.of("b"))
+        # The cap counts the user's prompts over both sockets
+        first.send(type="prompt", id="c", content="three")
+        await until(lambda: first.of("c"))
+        assert first.of("c") == [{"id": "c", "type": "error", "detail": "Too many prompts in flight"}]
+        await until(lambda: first.last_type("a") == "done" and second.last_type("b") == "done")
+        first.send(type="prompt", id="c", content="three")
+        await until(lambda: first.last_type("c") == "done")
+    for socket in (first, second):
+        socket.incoming.put_nowait(None)
+    await asyncio.gather(*sessions)
+
+
+@pytest.mark.anyio
+async def test_mux_disconnect_closes_upstream_streams(fake_openai: FakeOpenAI) -> None:
+    fake_openai.tokens = 1000
+    socket = MuxSocket()
+    session = asyncio.create_task(MuxSession(socket, uuid4()).run())
+    socket.send(type="prompt", id="a", content="one")
+    socket.send(type="prompt", id="b", content="two")
+    await until(lambda: socket.of("a") and socket.of("b"))
+    socket.incoming.put_nowait(None)
+    await asyncio.wait_for(session, 0.5)
+    assert all(stream.closed for stream in fake_openai.streams)
+    assert ai.prompt_limiter.stats()["in_flight"] == 0
+
+
+@pytest.mark.anyio
+async def test_mux_rejects_bad_frames(fake_openai: FakeOpenAI) -> None:
+    socket = MuxSocket()
+    session = asyncio.create_task(MuxSession(socket, uuid4()).run())
+    socket.incoming.put_nowait("not json")
+    socket.send(type="prompt", id="x" * 65, content="hi")
+    socket.send(type="prompt", id="a", content="")
+    socket.send(type="stop", id="a")
+    socket.incoming.put_nowait(None)
+    await session
+    assert [frame["detail"] for frame in socket.frames] == [
+        "Invalid frame", "Invalid id", "Invalid content", "Unknown type"
+    ]
+    assert fake_openai.requests == []
+
+
+class ClosedSocket(MuxSocket):
+    async def send_text(self, text: str) -> None:
+        raise RuntimeError('Cannot call "send" once a close message has been sent.')
+
+
+@pytest.mark.anyio
+async def test_mux_failed_answer_on_closed_socket(fake_openai: FakeOpenAI) -> None:
+    session = MuxSession(ClosedSocket(), uuid4())
+    # The failed delta is logged and the error frame dropped, nothing escapes the task
+    await session.answer("a", "hi")
+
+
+class ClientSocket(MuxSocket):
+    """
+    What websocket_openai sees of a client in the full and delta modes.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.closed: tuple[int, str] | None = None
+
+    async def accept(self) -> None:
+        pass
+
+    async def send_text(self, text: str) -> None:
+        self.frames.append(text)
+
+    async def close(self, code: int = 1000, reason: str | None = None) -> None:
+        self.closed = (code, reason)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("mode", ["full", "delta"])
+async def test_quota_exceeded_is_not_mistaken_for_an_answer(
+    recorder: UsageRecorder, fake_openai: FakeOpenAI, mode: str
+) -> None:
+    socket = ClientSocket()
+    socket.incoming.put_nowait("hello")
+    socket.incoming.put_nowait(None)
+    with patch.object(recorder, "within_quota", AsyncMock(return_value=False)):
+        await websocket_openai(socket, SimpleNamespace(id=uuid4()), mode=mode)
+    if mode == "full":
+        assert socket.frames == []
+        assert socket.closed == (status.WS_1008_POLICY_VIOLATION, "Daily token quota exceeded")
+    else:
+        assert [json.loads(frame) for frame in socket.frames] == [{"type": "error", "detail": "Daily token quota exceeded"}]
+        assert socket.closed is None
+    assert fake_openai.requests == []
+
+
+async def ask(message: str) -> tuple[str, ai.Usage]:
+    usage = ai.Usage()
+    answer = "".join([piece async for piece in ai.stream_completion(message, usage=usage)])
+    return answer, usage
+
+
+@pytest.mark.anyio
+async def test_prompt_is_sent_upstream_as_typed() -> None:
+    fake = FakeOpenAI(tokens=1)
+    message = "Why does this fail?\n\ndef check():\n    return ping('vpn')\n"
+    with patch("app.ai.get_openai_client", return_value=fake):
+        await ask(message)
+    assert fake.requests[0]["messages"][1]["content"] == message
+
+
+@pytest.mark.anyio
+async def test_repeated_prompt_is_replayed_from_cache() -> None:
+    fake = FakeOpenAI(tokens=5)
+    stats = ai.response_cache.stats()
+    with patch("app.ai.get_openai_client", return_value=fake):
+        first, _ = await relay("delta", fake, "What is the  SLA of ＶＰＮ?")
+        # Same question once whitespace and full-width letters are normalised
+        second, _ = await relay("delta", fake, " What is the SLA of VPN? ")
+        answer, usage = await ask("What is the SLA of VPN?")
+    assert len(fake.requests) == 1
+    assert fake.requests[0]["messages"][1]["content"] == "What is the  SLA of ＶＰＮ?"  # Sent as typed
+    assert second.frames == first.frames
+    assert answer == "word " * 5
+    assert usage == ai.Usage(prompt_tokens=usage.prompt_tokens, completion_tokens=5, cached=True)
+    after = ai.response_cache.stats()
+    assert after["hits"] - stats["hits"] == 2
+    assert after["saved_tokens"] - stats["saved_tokens"] == 2 * (usage.prompt_tokens + 5)
+
+    with patch("app.ai.get_openai_client", return_value=fake):
+        await ask("What is the SLA of VPN?!")
+    assert len(fake.requests) == 2
+
+
+@pytest.mark.anyio
+async def test_identical_concurrent_prompts_share_one_call() -> None:
+    fake = FakeOpenAI(tokens=10, delay=0.02)
+    coalesced = ai.response_cache.stats()["coalesced"]
+    with patch("app.ai.get_openai_client", return_value=fake):
+        results = await asyncio.gather(*[ask("Is the mail server up?") for _ in range(5)])
+    assert len(fake.requests) == 1
+    assert {answer for answer, _ in results} == {"word " * 10}
+    # Only the first is billed
+    assert [usage.cached for _, usage in results].count(False) == 1
+    assert all(usage.completion_tokens == 10 for _, usage in results)
+    assert ai.response_cache.stats()["coalesced"] - coalesced == 4
+
+
+@pytest.mark.anyio
+async def test_shared_call_outlives_a_cancelled_prompt(fake_openai: FakeOpenAI) -> None:
+    socket = MuxSocket()
+    session = asyncio.create_task(MuxSession(socket, uuid4()).run())
+    socket.send(type="prompt", id="a", content="Is the mail server up?")
+    socket.send(type="prompt", id="b", content="Is the mail server up?")
+    await until(lambda: socket.of("a") and socket.of("b"))
+    socket.send(type="cancel", id="a")
+    await until(lambda: socket.last_type("b") == "done")
+    assert socket.last_type("a") == "cancelled"
+    assert "".join(frame.get("content", "") for frame in socket.of("b")) == "word " * 10
+    assert len(fake_openai.requests) == 1
+    socket.incoming.put_nowait(None)
+    await session
+
+
+@pytest.mark.anyio
+async def test_usage_is_buffered_then_reported(
+    client: AsyncClient, superuser_token_headers: dict[str, str], recorder: UsageRecorder, fake_openai: FakeOpenAI
+) -> None:
+    user = await create_random_user()
+    socket = MuxSocket()
+    session = asyncio.create_task(MuxSession(socket, user.id).run())
+    for request_id in ("a", "b"):
+        socket.send(type="prompt", id=request_id, content="How is the VPN?")
+        await until(lambda: socket.last_type(request_id) == "done")
+    socket.incoming.put_nowait(None)
+    await session
+    # Nothing written while answering
+    assert not await AiUsage.filter(user_id=user.id).exists()
+
+    with patch("app.api.routes.utils.usage_recorder", recorder):
+        r = await client.get(f"{settings.API_V1_STR}/utils/ai-usage", headers=superuser_token_headers)
+    assert r.status_code == 200
+    usage = next(row for row in r.json()["data"] if row["user_id"] == str(user.id))
+    assert usage["username"] == user.username
+    assert usage["requests"] == 2
+    assert usage["completion_tokens"] == 10
+    # The second answer came from the cache
+    assert usage["cached_tokens"] == usage["prompt_tokens"] + 10 > 10
+
+    # Later flushes add to the same row
+    recorder.record(user.id, ai.Usage(prompt_tokens=1, completion_tokens=2))
+    await recorder.flush()
+    row = await AiUsage.get(user_id=user.id)
+    assert (row.requests, row.completion_tokens) == (3, 12)
+
+
+@pytest.mark.anyio
+async def test_usage_of_a_failed_flush_is_retried(client: AsyncClient, recorder: UsageRecorder) -> None:
+    user = await create_random_user()
+    recorder.record(user.id, ai.Usage(prompt_tokens=3, completion_tokens=4))
+    with patch.object(recorder, "_merge", AsyncMock(side_effect=RuntimeError("DB down"))):
+        await recorder.flush()
+    assert recorder.failed == 1
+    assert not await AiUsage.filter(user_id=user.id).exists()
+    assert await recorder.used_today(user.id) == 7  # Still counted against the quota
+
+    await recorder.flush()
+    row = await AiUsage.get(user_id=user.id)
+    assert (row.requests, row.prompt_tokens, row.completion_tokens) == (1, 3, 4)
+    assert await recorder.used_today(user.id) == 7
+
+
+@pytest.mark.anyio
+async def test_quota_is_checked_in_memory_and_across_workers(
+    client: AsyncClient, recorder: UsageRecorder, fake_openai: FakeOpenAI
+) -> None:
+    user = await create_random_user()
+    recorder.daily_quota = 15
+    socket = MuxSocket()
+    session = asyncio.create_task(MuxSession(socket, user.id).run())
+    socket.send(type="prompt", id="a", content="How is the VPN?")
+    await until(lambda: socket.last_type("a") == "done")
+    async with count_queries() as queries:
+        socket.send(type="prompt", id="b", content="And the mail server?")
+        await until(lambda: socket.of("b"))
+    assert socket.of("b") == [{"id": "b", "type": "error", "detail": "Daily token quota exceeded"}]
+    assert queries == []  # Answered from the in-memory counter
+    socket.incoming.put_nowait(None)
+    await session
+
+    other_worker = UsageRecorder(flush_interval=60, daily_quota=15)
+    assert await other_worker.within_quota(user.id)
+    await recorder.flush()
+    other_worker = UsageRecorder(flush_interval=60, daily_quota=15)
+    assert not await other_worker.within_quota(user.id)
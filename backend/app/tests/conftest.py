@@ -4,6 +4,7 @@ from httpx import AsyncClient, ASGITransport
 from asgi_lifespan import LifespanManager
 from contextlib import asynccontextmanager
 from typing import AsyncGenerator
+from unittest.mock import patch
 
 from app.main import app 
 from app.core.config import settings
@@ -37,4 +38,9 @@ async def superuser_token_headers(client: AsyncClient) -> dict[str, str]:
 
 @pytest.fixture(scope="module")
 async def normal_user_token_headers(client: AsyncClient) -> dict[str, str]:
-    return await get_normal_user_token_headers(client, settings.EMAIL_TEST_USER)
\ No newline at end of file
+    return await get_normal_user_token_headers(client, settings.EMAIL_TEST_USER)
+
+@pytest.fixture
+def emails_enabled():
+    with patch.object(settings, "SENDGRID_API_KEY", "test-key"), patch.object(settings, "EMAILS_FROM_EMAIL", "noreply@example.com"):
+        yield
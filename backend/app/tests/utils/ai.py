@@ -0,0 +1,77 @@
+import asyncio
+from typing import Any, AsyncIterator
+
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import Choice, ChoiceDelta
+
+
+class FakeStream:
+    """
+    Like openai's AsyncStream: iterates the chunks, close() releases the connection.
+    """
+
+    def __init__(self, chunks: AsyncIterator[ChatCompletionChunk]) -> None:
+        self.chunks = chunks
+        self.closed = False
+
+    def __aiter__(self) -> AsyncIterator[ChatCompletionChunk]:
+        return self.chunks
+
+    async def close(self) -> None:
+        self.closed = True
+        await self.chunks.aclose()
+
+
+class FakeOpenAI:
+    """
+    Local stand-in for AsyncOpenAI's streaming chat completions: answers every prompt
+    with `tokens` chunks of `token`, `delay` seconds apart, and reports one prompt token per word.
+    """
+
+    def __init__(self, tokens: int = 20, token: str = "word ", delay: float = 0.0) -> None:
+        self.tokens = tokens
+        self.token = token
+        self.delay = delay
+        self.requests: list[dict[str, Any]] = []
+        self.streams: list[FakeStream] = []
+        self.chat = self
+        self.completions = self
+
+    def chunk(self, content: str | None, finish_reason: str | None = None) -> ChatCompletionChunk:
+        return ChatCompletionChunk(
+            id="chatcmpl-fake",
+            object="chat.completion.chunk",
+            created=0,
+            model="fake",
+            choices=[Choice(index=0, delta=ChoiceDelta(content=content), finish_reason=finish_reason)],
+        )
+
+    async def stream(self, prompt_tokens: int = 0, include_usage: bool = False) -> AsyncIterator[ChatCompletionChunk]:
+        yield self.chunk("")
+        token_chunk = self.chunk(self.token)  # Built once, so the fake itself costs little CPU
+        for _ in range(self.tokens):
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            yield token_chunk
+        yield self.chunk(None, finish_reason="stop")
+        if include_usage:
+            yield ChatCompletionChunk(
+                id="chatcmpl-fake",
+                object="chat.completion.chunk",
+                created=0,
+                model="fake",
+                choices=[],
+                usage=CompletionUsage(
+                    prompt_tokens=prompt_tokens,
+                    completion_tokens=self.tokens,
+                    total_tokens=prompt_tokens + self.tokens,
+                ),
+            )
+
+    async def create(self, **kwargs: Any) -> FakeStream:
+        self.requests.append(kwargs)
+        prompt_tokens = sum(len(message["content"].split()) for message in kwargs["messages"])
+        include_usage = kwargs.get("stream_options", {}).get("include_usage", False)
+        self.streams.append(FakeStream(self.stream(prompt_tokens, include_usage)))
+        return self.streams[-1]
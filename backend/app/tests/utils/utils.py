@@ -1,5 +1,10 @@
 import random
 import string
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator
+from unittest.mock import patch
+
+from tortoise import connections
 
 def random_integer() -> int:
     return random.randint(1, 100)
@@ -13,3 +18,22 @@ def random_email() -> str:
     return f"{random_lower_string()}@{random_lower_string()}.com"
 
 
+@asynccontextmanager
+async def count_queries() -> AsyncGenerator[list[str], None]:
+    """Record every SQL statement sent through the default connection."""
+    conn = connections.get("default")
+    queries: list[str] = []
+    execute_query = conn.execute_query
+    execute_query_dict = conn.execute_query_dict
+
+    async def recording_execute_query(query, values=None):
+        queries.append(query)
+        return await execute_query(query, values)
+
+    async def recording_execute_query_dict(query, values=None):
+        queries.append(query)
+        return await execute_query_dict(query, values)
+
+    with patch.object(conn, "execute_query", recording_execute_query), \
+         patch.object(conn, "execute_query_dict", recording_execute_query_dict):
+        yield queries
@@ -0,0 +1,189 @@
+import argparse, asyncio, base64, logging
+from datetime import datetime
+from typing import Any
+
+from tortoise import run_async, timezone as tz
+
+from app.core import metrics
+from app.core.config import settings
+from app.core.storage import ObjectStorage, storage
+from app.models.db_models import TransferObject
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "transfer"  # Parent dir in S3, see app.api.routes.file_transfer
+
+
+def parse_key(key: str) -> tuple[str, str, str] | None:
+    """
+    transfer/{folder}/{company}/{file_name} -> (folder, company, file_name), None for any other key.
+    Folder markers (keys ending with /) are not files, empty files are.
+    """
+    parts = key.split("/", 3)
+    if len(parts) != 4 or parts[0] != PREFIX or not all(parts[1:]) or key.endswith("/"):
+        return None
+    if len(key) > 512 or len(parts[2]) > 255 or len(parts[3]) > 255:
+        return None  # Would not fit the columns
+    return parts[1], parts[2], parts[3]
+
+
+def encode_key_cursor(key: str) -> str:
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_key_cursor(cursor: str) -> str:
+    try:
+        return base64.urlsafe_b64decode(cursor.encode()).decode()
+    except Exception as e:
+        raise ValueError("Invalid continuation token") from e
+
+
+async def record_object(
+    *,
+    key: str,
+    size: int,
+    content_type: str | None = None,
+    uploader: str | None = None,
+    last_modified: datetime | None = None,
+) -> TransferObject | None:
+    """
+    Insert or refresh the row of an object written to storage. Keys outside transfer/ are ignored.
+    """
+    parsed = parse_key(key)
+    if parsed is None:
+        return None
+    folder, company, file_name = parsed
+    transfer_object, _ = await TransferObject.update_or_create(
+        defaults={
+            "folder": folder,
+            "company": company,
+            "file_name": file_name,
+            "size": size,
+            "content_type": content_type,
+            "uploader": uploader,
+            "last_modified": last_modified or tz.now(),
+        },
+        key=key,
+    )
+    return transfer_object
+
+
+async def forget_object(key: str) -> None:
+    await TransferObject.filter(key=key).delete()
+
+
+async def reconcile(*, store: ObjectStorage = storage, page_size: int = 1000) -> dict[str, int]:
+    """
+    Sync transfer_objects with the bucket: list transfer/ page by page, insert missing rows,
+    refresh changed ones, then delete rows whose object is gone.
+    Rows written by the API after the run started are never deleted.
+    """
+    started = tz.now()
+    counts = {"created": 0, "updated": 0, "deleted": 0}
+    seen: set[str] = set()
+    token = None
+    while True:
+        page, token = await store.list_objects(f"{PREFIX}/", continuation_token=token, max_keys=page_size)
+        objects = {obj.key: obj for obj in page if parse_key(obj.key)}
+        seen.update(objects)
+        existing = {row.key: row for row in await TransferObject.filter(key__in=list(objects))}
+        missing = []
+        for key, obj in objects.items():
+            row = existing.get(key)
+            if row is None:
+                folder, company, file_name = parse_key(key)
+                missing.append(
+                    TransferObject(
+                        key=key,
+                        folder=folder,
+                        company=company,
+                        file_name=file_name,
+                        size=obj.size,
+                        last_modified=obj.last_modified,
+                    )
+                )
+            elif row.size != obj.size:
+                row.size = obj.size
+                row.last_modified = obj.last_modified
+                await row.save(update_fields=["size", "last_modified", "updated_at"])
+                counts["updated"] += 1
+        await TransferObject.bulk_create(missing, ignore_conflicts=True)  # Another worker may reconcile too
+        counts["created"] += len(missing)
+        if token is None:
+            break
+
+    last_id = 0
+    while True:
+        rows = await TransferObject.filter(id__gt=last_id, updated_at__lt=started) \
+            .order_by("id").limit(page_size).values_list("id", "key")
+        if not rows:
+            break
+        stale = [row_id for row_id, key in rows if key not in seen]
+        if stale:
+            counts["deleted"] += await TransferObject.filter(id__in=stale).delete()
+        last_id = rows[-1][0]
+    return counts
+
+
+
+class TransferReconciler:
+    """
+    Runs reconcile() at startup and then every `interval` seconds, so listings pick up objects
+    written outside the API and a fresh deploy fills the table.
+    """
+
+    def __init__(self, *, store: ObjectStorage, interval: float) -> None:
+        self.store = store
+        self.interval = interval
+        self.runs = 0
+        self.last_counts = {"created": 0, "updated": 0, "deleted": 0}
+        self._task: asyncio.Task | None = None
+
+    async def run_once(self) -> dict[str, int]:
+        self.last_counts = await reconcile(store=self.store)
+        self.runs += 1
+        return self.last_counts
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                counts = await self.run_once()
+                if any(counts.values()):
+                    logger.info("Reconciled transfer objects: %s", counts)
+            except Exception:
+                logger.exception("Transfer object reconcile failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict[str, Any]:
+        return {"runs": self.runs, **{f"last_{name}": count for name, count in self.last_counts.items()}}
+
+
+transfer_reconciler = TransferReconciler(store=storage, interval=settings.TRANSFER_RECONCILE_INTERVAL_SECONDS)
+metrics.register("transfer_reconciler", transfer_reconciler.stats)
+
+
+if __name__ == "__main__":
+    # python -m app.transfer_objects [--page-size 1000]
+    parser = argparse.ArgumentParser(description="Reconcile transfer_objects with the S3 bucket")
+    parser.add_argument("--page-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    async def main() -> None:
+        from tortoise import Tortoise
+        await Tortoise.init(config=settings.TORTOISE_ORM)
+        logger.info("Reconciled transfer objects: %s", await reconcile(page_size=args.page_size))
+
+    run_async(main())
@@ -0,0 +1,85 @@
+import math
+from typing import AsyncIterator
+
+from app import transfer_objects
+from app.core.config import settings
+from app.core.storage import storage
+from app.models.db_models import TempUser, UploadSession
+
+S3_MAX_PARTS = 10000
+
+
+class OffsetConflict(Exception):
+    """
+    Another request moved the session's offset first.
+    """
+
+
+def session_part_size(size: int) -> int:
+    # Grow parts for huge files so they still fit in S3's part limit
+    return max(settings.UPLOAD_PART_SIZE_BYTES, math.ceil(size / S3_MAX_PARTS))
+
+
+async def create_session(
+    *, temp_user: TempUser, key: str, size: int, content_type: str | None = None
+) -> UploadSession:
+    upload_id = await storage.create_multipart_upload(key, content_type=content_type)
+    return await UploadSession.create(
+        temp_user=temp_user,
+        key=key,
+        upload_id=upload_id,
+        content_type=content_type,
+        size=size,
+        part_size=session_part_size(size),
+    )
+
+
+async def _commit_part(session: UploadSession, body: bytes) -> None:
+    part_number = len(session.parts) + 1
+    etag = await storage.upload_part(session.key, session.upload_id, part_number, body)
+    parts = [*session.parts, [part_number, etag]]
+    offset = session.offset + len(body)
+    # Conditional on the offset this request started from, so of two concurrent PATCHes
+    # (possibly on different workers) only one can commit the part
+    updated = await UploadSession.filter(id=session.id, offset=session.offset).update(offset=offset, parts=parts)
+    if not updated:
+        raise OffsetConflict()
+    session.offset = offset
+    session.parts = parts
+
+
+async def append(session: UploadSession, chunks: AsyncIterator[bytes]) -> None:
+    """
+    Store the chunks from session.offset on, one S3 part at a time.
+    Only whole parts and the final part are kept: a trailing partial part is dropped,
+    and the client resends it from the new offset.
+    """
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        if session.offset + len(buffer) > session.size:
+            raise ValueError("Upload exceeds its declared length")
+        while len(buffer) >= session.part_size:
+            part = bytes(buffer[:session.part_size])
+            del buffer[:session.part_size]
+            await _commit_part(session, part)
+    if buffer and session.offset + len(buffer) == session.size:
+        await _commit_part(session, bytes(buffer))
+
+
+async def complete(session: UploadSession, *, uploader: str | None = None) -> None:
+    """
+    Assemble the parts once every byte is stored and record the object.
+    """
+    await storage.complete_multipart_upload(
+        session.key, session.upload_id, [(number, etag) for number, etag in session.parts]
+    )
+    await transfer_objects.record_object(
+        key=session.key, size=session.size, content_type=session.content_type, uploader=uploader
+    )
+    await session.delete()
+
+
+async def abort(session: UploadSession) -> None:
+    await storage.abort_multipart_upload(session.key, session.upload_id)
+    await session.delete()
@@ -1,18 +1,14 @@
-import logging, jwt, random, string
+import base64, logging, jwt, random, string
 from datetime import timedelta, datetime, timezone
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Any, Literal
-from jinja2 import Template
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from jwt.exceptions import InvalidTokenError
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-from firebase_admin import messaging, exceptions
 
 from app.core import security
 from app.core.config import settings
-from app.models.db_models import User
-from app.models.db_models import FcmToken
+from app.core.mailer import MailError, mailer
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -23,11 +19,29 @@ class EmailData:
     subject: str
 
 
+EMAIL_TEMPLATES_DIR = Path(__file__).parent / "email-templates" / "build"
+
+
+def create_email_environment(directory: Path, *, auto_reload: bool) -> Environment:
+    """
+    Compile every template in `directory` up front. The bytecode cache (in the temp dir) spares
+    the other workers and later restarts the compilation; auto_reload picks up edited files.
+    """
+    environment = Environment(
+        loader=FileSystemLoader(directory),
+        bytecode_cache=FileSystemBytecodeCache(),
+        auto_reload=auto_reload,
+    )
+    for template_name in environment.list_templates():
+        environment.get_template(template_name)
+    return environment
+
+
+email_templates = create_email_environment(EMAIL_TEMPLATES_DIR, auto_reload=settings.is_local)
+
+
 def render_email_template(*, template_name: str, context: dict[str, Any]) -> str:
-    template_str = (
-        Path(__file__).parent / "email-templates" / "build" / template_name
-    ).read_text()
-    html_content = Template(template_str).render(context)
+    html_content = email_templates.get_template(template_name).render(context)
     return html_content
 
 
@@ -36,18 +50,15 @@ async def send_email(
     email_to: str,
     subject: str = "",
     html_content: str = "",
-) -> str | None:
+) -> int | None:
+    """
+    Send right away, bypassing the outbox. Returns the HTTP status, None when SendGrid refused it.
+    """
     assert settings.emails_enabled, "no provided configuration for email variables"
-    message = Mail(
-        from_email=settings.EMAILS_FROM_EMAIL,
-        to_emails=email_to,
-        subject=subject,
-        html_content=html_content)
     try:
-        sg = SendGridAPIClient(settings.SENDGRID_API_KEY)
-        response = sg.send(message)
-        return response.status_code
-    except Exception:
+        return await mailer.send(email_to=email_to, subject=subject, html_content=html_content)
+    except MailError as e:
+        logger.warning("Email to %s failed: %s", email_to, e)
         return None
 
 
@@ -136,42 +147,21 @@ def verify_password_reset_token(token: str) -> str | None:
         return None
     
 
-async def check_privileges(*, user: User, service_id: int, privilege: str = "read") -> bool:
+def encode_log_cursor(start_time: datetime, log_id: int) -> str:
     """
-    Checks a user's privileges (read or write) for a specific service.
-
-    Args:
-        user (User): The current user object.
-        service_id (int): The ID of the service to check privileges for.
-        privilege (str): The type of privilege to check ("read" or "write").
+    Opaque keyset cursor pointing at the (start_time, id) of the last log on a page.
+    """
+    raw = f"{start_time.isoformat()}|{log_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
 
-    Returns:
-        bool: True if the user has the specified privilege, False otherwise.
 
-    Raises:
-        ValueError: If an invalid privilege type is provided.
-    """
-    if privilege not in {"read", "write"}:
-        raise ValueError("Invalid privilege type. Use 'read' or 'write'.")
-    
-    if user.is_superuser:
-        # Superusers can access and edit all services
-        return True
-    
-    # Check if the user is associated with the service
-    is_associated = await user.services.filter(id=service_id).exists()
-    if not is_associated:
-        return False
-
-    if privilege == "read":
-        # Read privilege: User only needs to be associated
-        return True
-
-    if privilege == "write":
-        # Write privilege: User must also have can_edit set to True
-        return user.can_edit
-    
-    return False  # Default fallback
+def decode_log_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        start_time, log_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(start_time), int(log_id)
+    except ValueError as e:
+        raise ValueError("Invalid cursor") from e
 
 
 # 通知IDに使用するランドムジェネレーター
@@ -179,39 +169,3 @@ def generate_short_id(length: int = 6) -> str:
     """Generate a short, numeric ID."""
     return ''.join(random.choices(string.digits, k=length))
 
-def create_message(id: str, registration_token: str, is_silent: bool) -> messaging.Message:
-    common_data = {
-        "notification_id": id,
-        "body": "無音通知" if is_silent else "音付き通知",
-    }
-    if is_silent:
-        return messaging.Message(
-            data=common_data,
-            token=registration_token,
-            android=messaging.AndroidConfig(priority="high", ttl=3600),
-            apns=messaging.APNSConfig(
-                payload=messaging.APNSPayload(
-                    aps=messaging.Aps(content_available=True)
-                )
-            ),
-        )
-    else:
-        return messaging.Message(
-            notification=messaging.Notification(
-                title="正常生確認", body="サーバから通知されました。"
-            ),
-            token=registration_token,
-            data=common_data,
-        )
-
-async def send_notif(id: str, registration_tokens: list, is_silent: bool = False):
-    all_result = ""
-    for registration_token in registration_tokens:
-        try:
-            message = create_message(id, registration_token, is_silent)
-            messaging.send(message)
-            all_result += f"Sent: {registration_token[:5]}"
-        except Exception as e:
-            all_result += f"Error: {registration_token[:5]}: {str(e)}"
-    return all_result
-
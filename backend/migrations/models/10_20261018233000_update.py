@@ -0,0 +1,24 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS `upload_sessions` (
+    `id` CHAR(36) NOT NULL PRIMARY KEY,
+    `key` VARCHAR(512) NOT NULL,
+    `upload_id` VARCHAR(255) NOT NULL,
+    `content_type` VARCHAR(255),
+    `size` BIGINT NOT NULL,
+    `part_size` INT NOT NULL,
+    `offset` BIGINT NOT NULL,
+    `parts` JSON NOT NULL,
+    `created_at` DATETIME(6) NOT NULL,
+    `updated_at` DATETIME(6) NOT NULL,
+    `temp_user_id` CHAR(36) NOT NULL,
+    CONSTRAINT `fk_upload_s_temporar_5d0d9026` FOREIGN KEY (`temp_user_id`) REFERENCES `temporary_users` (`id`) ON DELETE CASCADE
+) CHARACTER SET utf8mb4;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS `upload_sessions`;"""
@@ -0,0 +1,18 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    # Links created before expiry was stored get one more day before the sweeper removes them
+    return """
+        ALTER TABLE `temporary_users` ADD `expires_at` DATETIME(6);
+        UPDATE `temporary_users` SET `expires_at` = DATE_ADD(NOW(6), INTERVAL 1 DAY);
+        ALTER TABLE `temporary_users` MODIFY COLUMN `expires_at` DATETIME(6) NOT NULL;
+        ALTER TABLE `temporary_users` ADD INDEX `idx_temporary_u_expires_b5e3ac` (`expires_at`);
+        ALTER TABLE `temporary_users` ADD UNIQUE INDEX `name` (`name`);"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE `temporary_users` DROP INDEX `name`;
+        ALTER TABLE `temporary_users` DROP INDEX `idx_temporary_u_expires_b5e3ac`;
+        ALTER TABLE `temporary_users` DROP COLUMN `expires_at`;"""
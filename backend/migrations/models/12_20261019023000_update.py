@@ -0,0 +1,22 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS `ai_usage` (
+    `id` INT NOT NULL PRIMARY KEY AUTO_INCREMENT,
+    `day` DATE NOT NULL,
+    `requests` INT NOT NULL,
+    `prompt_tokens` INT NOT NULL,
+    `completion_tokens` INT NOT NULL,
+    `cached_tokens` INT NOT NULL,
+    `user_id` CHAR(36) NOT NULL,
+    UNIQUE KEY `uid_ai_usage_user_id_ee9c8a` (`user_id`, `day`),
+    CONSTRAINT `fk_ai_usage_users_ca733ca5` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE CASCADE,
+    KEY `idx_ai_usage_day_97608d` (`day`)
+) CHARACTER SET utf8mb4;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS `ai_usage`;"""
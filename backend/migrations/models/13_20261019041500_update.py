@@ -0,0 +1,23 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS `email_outbox` (
+    `id` INT NOT NULL PRIMARY KEY AUTO_INCREMENT,
+    `email_to` VARCHAR(255) NOT NULL,
+    `subject` VARCHAR(255) NOT NULL,
+    `html_content` LONGTEXT NOT NULL,
+    `status` VARCHAR(7) NOT NULL,
+    `attempts` INT NOT NULL,
+    `next_attempt_at` DATETIME(6) NOT NULL,
+    `last_error` LONGTEXT,
+    `created_at` DATETIME(6) NOT NULL,
+    `sent_at` DATETIME(6),
+    KEY `idx_email_outbo_status_dd88ee` (`status`, `next_attempt_at`)
+) CHARACTER SET utf8mb4;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS `email_outbox`;"""
@@ -0,0 +1,11 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE `service_logs` ADD INDEX `idx_service_log_service_b066c0` (`service_id`, `start_time`, `id`);"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE `service_logs` DROP INDEX `idx_service_log_service_b066c0`;"""
@@ -0,0 +1,25 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS `service_log_rollups` (
+    `id` INT NOT NULL PRIMARY KEY AUTO_INCREMENT,
+    `period` VARCHAR(4) NOT NULL,
+    `bucket_start` DATETIME(6) NOT NULL,
+    `count` INT NOT NULL  DEFAULT 0,
+    `failures` INT NOT NULL  DEFAULT 0,
+    `timed_count` INT NOT NULL  DEFAULT 0,
+    `elapsed_sum` DOUBLE NOT NULL  DEFAULT 0,
+    `elapsed_min` DOUBLE,
+    `elapsed_max` DOUBLE,
+    `histogram` JSON NOT NULL,
+    `service_id` CHAR(36) NOT NULL,
+    UNIQUE KEY `uid_service_log_service_1627f7` (`service_id`, `period`, `bucket_start`),
+    CONSTRAINT `fk_service__services_c1b23aa4` FOREIGN KEY (`service_id`) REFERENCES `services` (`id`) ON DELETE CASCADE
+) CHARACTER SET utf8mb4;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS `service_log_rollups`;"""
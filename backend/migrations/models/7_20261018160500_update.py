@@ -0,0 +1,20 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS `service_status` (
+    `id` INT NOT NULL PRIMARY KEY AUTO_INCREMENT,
+    `last_check_time` DATETIME(6),
+    `last_is_ok` BOOL,
+    `last_elapsed_time` DOUBLE,
+    `consecutive_failures` INT NOT NULL  DEFAULT 0,
+    `updated_at` DATETIME(6) NOT NULL  DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+    `service_id` CHAR(36) NOT NULL UNIQUE,
+    CONSTRAINT `fk_service__services_3e828326` FOREIGN KEY (`service_id`) REFERENCES `services` (`id`) ON DELETE CASCADE
+) CHARACTER SET utf8mb4;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS `service_status`;"""
@@ -0,0 +1,26 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS `transfer_objects` (
+    `id` INT NOT NULL PRIMARY KEY AUTO_INCREMENT,
+    `key` VARCHAR(512) NOT NULL UNIQUE,
+    `folder` VARCHAR(32) NOT NULL,
+    `company` VARCHAR(255) NOT NULL,
+    `file_name` VARCHAR(255) NOT NULL,
+    `size` BIGINT NOT NULL,
+    `content_type` VARCHAR(255),
+    `uploader` VARCHAR(255),
+    `last_modified` DATETIME(6) NOT NULL,
+    `created_at` DATETIME(6) NOT NULL,
+    `updated_at` DATETIME(6) NOT NULL,
+    KEY `idx_transfer_ob_file_na_4d6e8b` (`file_name`),
+    KEY `idx_transfer_ob_folder_b70eec` (`folder`, `key`),
+    KEY `idx_transfer_ob_company_7f7464` (`company`, `file_name`)
+) CHARACTER SET utf8mb4;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS `transfer_objects`;"""